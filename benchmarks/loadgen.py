@@ -0,0 +1,335 @@
+import argparse
+import json
+import math
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from client_core import Session  # noqa: E402
+from protocol import RequestError  # noqa: E402
+from transfer import parse_size  # noqa: E402
+
+# load generator: N simulated clients on loopback, each with its own client_core.Session, run a
+# weighted mix of list/upload/download/delete against a freshly started engine. reports per command
+# throughput and p50/p99/p999 latency, the connection setup rate and the server's cpu and rss.
+#
+#   python benchmarks/loadgen.py --clients 32 --duration 30 --mix upload=3,download=5,list=1,delete=1
+#   python benchmarks/loadgen.py --sizes 4k=60,256k=30,8m=10 --json results.json
+#
+# --json writes the numbers to a file so runs of different releases can be compared.
+
+COMMANDS = ("list", "upload", "download", "delete")
+SAMPLE_INTERVAL = 0.5  # seconds between server cpu/rss samples
+
+
+def parse_weights(text, parse_key=str):
+    # "a=3,b=1" -> [(a, 3.0), (b, 1.0)]
+    weights = []
+    for part in text.split(","):
+        if not part.strip():
+            continue
+        key, _, weight = part.partition("=")
+        weights.append((parse_key(key.strip()), float(weight or 1)))
+    if not weights or sum(weight for _, weight in weights) <= 0:
+        raise ValueError(f"no weights in {text!r}")
+    return weights
+
+
+def percentile(ordered, fraction):
+    # nearest rank on a sorted list
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def make_file(path, size):
+    block = os.urandom(min(size, 4 * 1024 * 1024) or 1)
+    with open(path, "wb") as f:
+        written = 0
+        while written < size:
+            written += f.write(block[:min(len(block), size - written)])
+
+
+class Stats:
+    # latencies and bytes per command, shared by all client threads
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.bytes = {}
+
+    def record(self, command, seconds, size=0):
+        with self.lock:
+            self.latencies.setdefault(command, []).append(seconds)
+            self.bytes[command] = self.bytes.get(command, 0) + size
+
+    def error(self, command):
+        with self.lock:
+            self.errors[command] = self.errors.get(command, 0) + 1
+
+    def summary(self, elapsed):
+        rows = {}
+        for command in sorted(set(self.latencies) | set(self.errors)):
+            ordered = sorted(self.latencies.get(command, []))
+            rows[command] = {
+                "count": len(ordered),
+                "errors": self.errors.get(command, 0),
+                "ops_per_s": len(ordered) / elapsed if elapsed else 0.0,
+                "mib_per_s": self.bytes.get(command, 0) / elapsed / 1024 ** 2 if elapsed else 0.0,
+                "p50_ms": percentile(ordered, 0.50) * 1000,
+                "p99_ms": percentile(ordered, 0.99) * 1000,
+                "p999_ms": percentile(ordered, 0.999) * 1000,
+            }
+        return rows
+
+
+class ProcessSampler:
+    # cpu time and resident memory of the server from /proc, linux only
+    def __init__(self, pid):
+        self.pid = pid
+        self.ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+        self.peak_rss = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.start_cpu = None
+        self.start_time = None
+
+    def cpu_seconds(self):
+        with open(f"/proc/{self.pid}/stat") as f:
+            fields = f.read().rpartition(")")[2].split()
+        return (int(fields[11]) + int(fields[12])) / self.ticks  # utime + stime
+
+    def rss(self):
+        with open(f"/proc/{self.pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+    def available(self):
+        return os.path.exists(f"/proc/{self.pid}/stat")
+
+    def start(self):
+        self.start_cpu = self.cpu_seconds()
+        self.start_time = time.perf_counter()
+        self.thread.start()
+
+    def run(self):
+        while not self.stop_event.wait(SAMPLE_INTERVAL):
+            try:
+                self.peak_rss = max(self.peak_rss, self.rss())
+            except OSError:
+                return
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        cpu = self.cpu_seconds() - self.start_cpu
+        elapsed = time.perf_counter() - self.start_time
+        self.peak_rss = max(self.peak_rss, self.rss())
+        return {"cpu_seconds": cpu, "cpu_percent": 100 * cpu / elapsed if elapsed else 0.0,
+                "peak_rss_mib": self.peak_rss / 1024 ** 2}
+
+
+class Workload:
+    # what the simulated clients share: the command mix, the stats and the files anyone may download
+    def __init__(self, args, payloads, workdir):
+        self.args = args
+        self.payloads = payloads  # [(size, path, weight)]
+        self.workdir = workdir
+        self.mix = parse_weights(args.mix)
+        for command, _ in self.mix:
+            if command not in COMMANDS:
+                raise ValueError(f"unknown command {command}")
+        self.stats = Stats()
+        self.lock = threading.Lock()
+        self.files = []  # (name, owner, size) uploaded and not deleted yet
+        self.deadline = None
+
+    def connect(self, name):
+        return Session(self.args.host, self.args.port, name, streams=self.args.streams)
+
+    def client(self, index):
+        rng = random.Random(self.args.seed + index)
+        name = f"load{index}"
+        downloads = os.path.join(self.workdir, "downloads", name)
+        os.makedirs(downloads, exist_ok=True)
+        own = []
+        session = self.connect(name)
+        session.connect()
+        counter = 0
+        try:
+            while time.perf_counter() < self.deadline:
+                command = rng.choices([c for c, _ in self.mix], [w for _, w in self.mix])[0]
+                start = time.perf_counter()
+                size = 0
+                try:
+                    if command == "upload":
+                        size, path, _ = rng.choices(self.payloads, [w for _, _, w in self.payloads])[0]
+                        counter += 1
+                        filename = f"f{counter}.bin"
+                        session.upload_file(path, filename)
+                        own.append((filename, size))
+                        with self.lock:
+                            self.files.append((filename, name, size))
+                    elif command == "download":
+                        with self.lock:
+                            target = rng.choice(self.files) if self.files else None
+                        if target is None:
+                            continue
+                        filename, owner, size = target
+                        session.download_file(filename, owner, downloads, streams=1)
+                        os.remove(os.path.join(downloads, filename))
+                    elif command == "delete":
+                        if not own:
+                            continue
+                        filename, _ = own.pop(rng.randrange(len(own)))
+                        with self.lock:
+                            self.files = [entry for entry in self.files if entry[:2] != (filename, name)]
+                        session.delete_file(filename)
+                    else:
+                        session.list_page(self.args.list_limit)
+                except (RequestError, OSError):
+                    self.stats.error(command)  # a download racing a delete lands here too
+                    continue
+                self.stats.record(command, time.perf_counter() - start, size)
+        finally:
+            session.close()
+
+    def churn(self, index, rounds):
+        # connection setup: full login of a fresh session, closed right away
+        for round_ in range(rounds):
+            start = time.perf_counter()
+            session = self.connect(f"conn{index}_{round_}")
+            try:
+                session.connect()
+            except (RequestError, OSError):
+                self.stats.error("connect")
+                continue
+            finally:
+                session.close()
+            self.stats.record("connect", time.perf_counter() - start)
+
+
+def run_threads(target, count, *args):
+    errors = []
+
+    def guarded(index):
+        try:
+            target(index, *args)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=guarded, args=(index,), daemon=True) for index in range(count)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, errors
+
+
+def print_table(title, rows):
+    print(title)
+    print(f"{'command':<10}{'count':>8}{'errors':>8}{'ops/s':>10}{'MiB/s':>9}{'p50 ms':>10}{'p99 ms':>10}{'p999 ms':>10}")
+    for command, row in rows.items():
+        print(f"{command:<10}{row['count']:>8}{row['errors']:>8}{row['ops_per_s']:>10.1f}{row['mib_per_s']:>9.1f}"
+              f"{row['p50_ms']:>10.2f}{row['p99_ms']:>10.2f}{row['p999_ms']:>10.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Simulated clients against a local file server")
+    parser.add_argument("--clients", type=int, default=16, help="simulated clients (default 16)")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds of mixed load (default 20)")
+    parser.add_argument("--mix", default="upload=3,download=5,list=1,delete=1",
+                        help="command weights, from " + ",".join(COMMANDS))
+    parser.add_argument("--sizes", default="4k=50,64k=30,1m=15,16m=5", help="upload size weights, size=weight")
+    parser.add_argument("--streams", type=int, default=1, help="data connections per client session")
+    parser.add_argument("--list-limit", type=int, default=100, help="entries per list command")
+    parser.add_argument("--connects", type=int, default=20, help="connect/close rounds per client before the load")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--dedup", action="store_true", help="start the server with --dedup")
+    parser.add_argument("--server-arg", action="append", default=[], help="extra engine.py argument, repeatable")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args(argv)
+    args.host = "127.0.0.1"
+
+    try:
+        sizes = parse_weights(args.sizes, parse_size)
+    except ValueError as e:
+        parser.error(f"bad --sizes: {e}")
+
+    workdir = tempfile.mkdtemp(prefix="loadgen_")
+    storage = os.path.join(workdir, "storage")
+    os.makedirs(storage)
+    payloads = []
+    for size, weight in sizes:
+        path = os.path.join(workdir, f"payload_{size}.bin")
+        make_file(path, size)
+        payloads.append((size, path, weight))
+
+    args.port = free_port()
+    engine = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "engine.py")
+    command = [sys.executable, engine, "--port", str(args.port), "--storage", storage,
+               "--max-streams", str(max(1, args.streams))]
+    if args.dedup:
+        command.append("--dedup")
+    server = subprocess.Popen(command + args.server_arg, stdout=subprocess.DEVNULL)
+    try:
+        time.sleep(1)
+        try:
+            workload = Workload(args, payloads, workdir)
+        except ValueError as e:
+            parser.error(f"bad --mix: {e}")
+        sampler = ProcessSampler(server.pid)
+        results = {"clients": args.clients, "duration": args.duration, "mix": args.mix, "sizes": args.sizes}
+
+        elapsed, _ = run_threads(workload.churn, args.clients, args.connects)
+        setup = workload.stats.summary(elapsed).get("connect")
+        workload.stats = Stats()
+        if setup:
+            results["connect"] = setup
+            print(f"connection setup: {setup['ops_per_s']:.0f}/s, p50 {setup['p50_ms']:.2f} ms, "
+                  f"p99 {setup['p99_ms']:.2f} ms, {setup['errors']} errors")
+
+        if sampler.available():
+            sampler.start()
+        workload.deadline = time.perf_counter() + args.duration
+        elapsed, errors = run_threads(workload.client, args.clients)
+        results["commands"] = workload.stats.summary(elapsed)
+        print_table(f"{args.clients} clients, {elapsed:.1f} s", results["commands"])
+        if errors:
+            print(f"{len(errors)} clients stopped early, first error: {errors[0]!r}")
+        if sampler.start_time is not None:
+            results["server"] = sampler.stop()
+            print(f"server: {results['server']['cpu_percent']:.0f}% cpu, "
+                  f"peak rss {results['server']['peak_rss_mib']:.1f} MiB")
+        else:
+            print("server: cpu/rss not available (no /proc)")
+
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(results, f, indent=2)
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,156 @@
+import argparse
+import asyncio
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from client_core import Session  # noqa: E402
+
+# download throughput vs. number of parallel streams on an artificial long fat link.
+# a local proxy delays every chunk by --delay-ms and allows only --window-kb in flight per
+# connection and direction, so one stream tops out near window / delay like a window limited TCP flow.
+#
+#   python benchmarks/segmented_bench.py --size-mb 512 --delay-ms 50 --streams 1,2,4,8
+#
+# to measure on a real shaped link instead (tc qdisc add dev lo root netem delay 25ms),
+# pass --no-proxy and the proxy is skipped.
+
+OWNER = "bench"
+FILENAME = "segmented.bin"
+
+
+class DelayProxy:
+    def __init__(self, target_port, delay, window):
+        self.target_port = target_port
+        self.delay = delay
+        self.window = window
+        self.port = None
+        self.loop = None
+
+    def start(self):
+        ready = threading.Event()
+        threading.Thread(target=self.run, args=(ready,), daemon=True).start()
+        ready.wait()
+
+    def run(self, ready):
+        self.loop = asyncio.new_event_loop()
+        server = self.loop.run_until_complete(asyncio.start_server(self.handle, "127.0.0.1", 0))
+        self.port = server.sockets[0].getsockname()[1]
+        ready.set()
+        self.loop.run_forever()
+
+    async def handle(self, client_reader, client_writer):
+        server_reader, server_writer = await asyncio.open_connection("127.0.0.1", self.target_port)
+        await asyncio.gather(self.pipe(client_reader, server_writer), self.pipe(server_reader, client_writer),
+                             return_exceptions=True)
+
+    async def pipe(self, reader, writer):
+        queue = asyncio.Queue()
+        in_flight = [0]
+        room = asyncio.Condition()
+
+        async def deliver():
+            while True:
+                due, data = await queue.get()
+                if data is None:
+                    break
+                await asyncio.sleep(max(0, due - time.monotonic()))
+                writer.write(data)
+                await writer.drain()
+                async with room:
+                    in_flight[0] -= len(data)
+                    room.notify_all()
+            writer.close()
+
+        sender = asyncio.ensure_future(deliver())
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                async with room:
+                    await room.wait_for(lambda: in_flight[0] + len(data) <= self.window or in_flight[0] == 0)
+                    in_flight[0] += len(data)
+                queue.put_nowait((time.monotonic() + self.delay, data))
+        finally:
+            queue.put_nowait((0, None))
+            await sender
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def make_file(path, size):
+    block = os.urandom(4 * 1024 * 1024)
+    with open(path, "wb") as f:
+        written = 0
+        while written < size:
+            written += f.write(block[:min(len(block), size - written)])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Segmented download throughput vs. stream count")
+    parser.add_argument("--size-mb", type=int, default=256, help="test file size in MiB (default 256)")
+    parser.add_argument("--delay-ms", type=float, default=50.0, help="one way delay added by the proxy")
+    parser.add_argument("--window-kb", type=int, default=1024, help="bytes in flight per connection and direction")
+    parser.add_argument("--streams", default="1,2,4,8", help="comma separated stream counts to try")
+    parser.add_argument("--no-proxy", action="store_true", help="connect straight to the server (use with tc netem)")
+    parser.add_argument("--host", default="127.0.0.1", help="server address when --no-proxy is used")
+    parser.add_argument("--verify", action="store_true", help="also hash the result against the server")
+    args = parser.parse_args(argv)
+
+    stream_counts = [int(count) for count in args.streams.split(",") if count.strip()]
+    workdir = tempfile.mkdtemp(prefix="segmented_bench_")
+    storage = os.path.join(workdir, "storage")
+    downloads = os.path.join(workdir, "downloads")
+    os.makedirs(storage)
+    os.makedirs(downloads)
+    size = args.size_mb * 1024 * 1024
+    make_file(os.path.join(storage, f"{OWNER}_{FILENAME}"), size)
+
+    port = free_port()
+    engine = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "engine.py")
+    server = subprocess.Popen([sys.executable, engine, "--port", str(port), "--storage", storage,
+                               "--max-streams", str(max(stream_counts))], stdout=subprocess.DEVNULL)
+    try:
+        time.sleep(1)
+        connect_port = port
+        if not args.no_proxy:
+            proxy = DelayProxy(port, args.delay_ms / 1000, args.window_kb * 1024)
+            proxy.start()
+            connect_port = proxy.port
+            print(f"proxy: {args.delay_ms:g} ms one way, {args.window_kb} KiB window "
+                  f"(~{args.window_kb / 1024 / (args.delay_ms / 1000):.1f} MiB/s per stream)")
+
+        session = Session(args.host, connect_port, "bench-client", streams=max(stream_counts))
+        session.connect()
+        print(f"{'streams':>8}{'MiB/s':>10}{'seconds':>10}")
+        for streams in stream_counts:
+            target = os.path.join(downloads, FILENAME)
+            start = time.perf_counter()
+            session.download_segmented(FILENAME, OWNER, downloads, streams=streams, verify=args.verify)
+            elapsed = time.perf_counter() - start
+            if os.path.getsize(target) != size:
+                print(f"{streams:>8} wrong size {os.path.getsize(target)}")
+            os.remove(target)
+            print(f"{streams:>8}{size / elapsed / 1024 ** 2:>10.1f}{elapsed:>10.2f}", flush=True)
+        session.close()
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,131 @@
+import argparse
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+# compares the download send paths over loopback:
+#   legacy   - the old Server.send_file loop, f.read(1024) + conn.send per chunk
+#   window   - the engine fallback for non regular files, one 4 MiB readinto window + sendall
+#   sendfile - kernel zero copy with socket.sendfile (what the engine uses for regular files)
+#
+#   python benchmarks/sendfile_bench.py --size-gb 2 --runs 3
+
+MODES = ("legacy", "window", "sendfile")
+
+
+def make_file(path, size):
+    block = os.urandom(4 * 1024 * 1024)
+    with open(path, "wb") as f:
+        written = 0
+        while written < size:
+            written += f.write(block[:min(len(block), size - written)])
+
+
+def drain(conn, expected, result):
+    buffer = bytearray(4 * 1024 * 1024)
+    received = 0
+    while received < expected:
+        n = conn.recv_into(buffer)
+        if not n:
+            break
+        received += n
+    result.append(received)
+
+
+def send_legacy(conn, f, size):
+    while True:
+        chunk = f.read(1024)
+        if not chunk:
+            break
+        conn.send(chunk)  # same unchecked partial write as the old code
+
+
+def send_window(conn, f, size):
+    buffer = bytearray(4 * 1024 * 1024)
+    view = memoryview(buffer)
+    while True:
+        n = f.readinto(buffer)
+        if not n:
+            break
+        conn.sendall(view[:n])
+
+
+def send_zero_copy(conn, f, size):
+    conn.sendfile(f, 0, size)
+
+
+SENDERS = {"legacy": send_legacy, "window": send_window, "sendfile": send_zero_copy}
+
+
+def run_once(mode, path, size):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    receiver = socket.create_connection(listener.getsockname())
+    sender, _ = listener.accept()
+    listener.close()
+
+    result = []
+    reader = threading.Thread(target=drain, args=(receiver, size, result))
+    reader.start()
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    with open(path, "rb") as f:
+        SENDERS[mode](sender, f, size)
+    sender.shutdown(socket.SHUT_WR)
+    reader.join()
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+    sender.close()
+    receiver.close()
+    return elapsed, cpu, result[0]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Throughput of the old and new download paths on loopback")
+    parser.add_argument("--size-gb", type=float, default=2.0, help="test file size in GiB (default 2)")
+    parser.add_argument("--runs", type=int, default=3, help="runs per mode, best one is reported")
+    parser.add_argument("--modes", default=",".join(MODES), help="comma separated subset of " + ",".join(MODES))
+    parser.add_argument("--file", help="use an existing file instead of generating one")
+    parser.add_argument("--dir", help="where to create the test file (default: system temp dir)")
+    args = parser.parse_args(argv)
+
+    modes = [mode.strip() for mode in args.modes.split(",") if mode.strip()]
+    for mode in modes:
+        if mode not in SENDERS:
+            parser.error(f"unknown mode {mode}")
+
+    cleanup = None
+    if args.file:
+        path = args.file
+    else:
+        fd, path = tempfile.mkstemp(prefix="sendfile_bench_", dir=args.dir)
+        os.close(fd)
+        cleanup = path
+        print(f"Creating {args.size_gb:g} GiB test file at {path}...", flush=True)
+        make_file(path, int(args.size_gb * 1024 ** 3))
+    size = os.path.getsize(path)
+
+    try:
+        print(f"{'mode':<10}{'MiB/s':>12}{'seconds':>10}{'cpu s':>10}")
+        for mode in modes:
+            best = None
+            for _ in range(args.runs):
+                elapsed, cpu, received = run_once(mode, path, size)
+                if received != size:
+                    print(f"{mode:<10} short transfer: {received} of {size} bytes", flush=True)
+                if best is None or elapsed < best[0]:
+                    best = (elapsed, cpu)
+            elapsed, cpu = best
+            print(f"{mode:<10}{size / elapsed / 1024 ** 2:>12.1f}{elapsed:>10.2f}{cpu:>10.2f}", flush=True)
+    finally:
+        if cleanup:
+            os.remove(cleanup)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
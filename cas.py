@@ -0,0 +1,230 @@
+import hashlib
+import json
+import os
+import threading
+from collections import Counter
+
+from layout import is_temp, temp_path
+from transfer import hash_pieces
+
+# content addressed storage for --dedup: file data is cut into fixed size chunks that are kept
+# once under .chunks/ab/cd/<sha256>, a stored file is only a manifest listing its chunks (under
+# .manifests, flat or sharded like the plain files, see layout.py).
+# fixed size chunks keep hashing cheap on both sides, identical files and shared prefixes dedup fully.
+# reference counts live in the catalog, a chunk is deleted with the last manifest using it
+
+CHUNK_SIZE = 4 * 1024 * 1024
+CHUNK_DIR = ".chunks"
+MANIFEST_DIR = ".manifests"
+
+
+class MissingChunks(Exception):
+    # a manifest refers to chunks the store doesn't hold (never sent or collected meanwhile)
+    def __init__(self, digests):
+        super().__init__(f"{len(digests)} chunks are missing on the server.")
+        self.digests = digests
+
+
+def is_digest(value):
+    return isinstance(value, str) and len(value) == 64 and all(c in "0123456789abcdef" for c in value)
+
+
+def chunk_list(path, chunk_size=CHUNK_SIZE, whole=None):
+    # [[sha256, length], ...] for every chunk of path, what the client announces before a dedup upload.
+    # whole is an optional hash object that gets the entire file in the same pass
+    chunks = []
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            if whole is not None:
+                whole.update(data)
+            chunks.append([hashlib.sha256(data).hexdigest(), len(data)])
+    return chunks
+
+
+class ChunkStore:
+    def __init__(self, storage_dir, refs, chunk_size=CHUNK_SIZE):
+        self.chunk_dir = os.path.join(storage_dir, CHUNK_DIR)
+        self.manifest_dir = os.path.join(storage_dir, MANIFEST_DIR)
+        self.chunk_size = chunk_size
+        self.refs = refs  # chunk reference counts, kept in the catalog (add_refs / drop_refs)
+        self.lock = threading.Lock()  # manifest writes and chunk collection, called from executor threads
+        self.pins = Counter()  # chunks of manifests being downloaded right now
+        self.doomed = set()  # unreferenced chunks that are still pinned, deleted by the last unpin
+        self.relative = lambda name: name  # manifest path in manifest_dir, the storage layout's
+
+    def load(self, relative=None):
+        os.makedirs(self.chunk_dir, exist_ok=True)
+        os.makedirs(self.manifest_dir, exist_ok=True)
+        if relative is not None:
+            self.relative = relative
+
+    def manifests(self):
+        # (name, manifest) of every stored manifest, only read when a storage folder is imported
+        for directory, _, names in os.walk(self.manifest_dir):
+            for name in names:
+                if is_temp(name) or os.path.join(directory, name) != self.manifest_path(name):
+                    continue  # a temp file, or a leftover of the other layout
+                manifest = self.read_manifest(name)
+                if manifest is not None:
+                    yield name, manifest
+
+    def chunk_path(self, digest):
+        return os.path.join(self.chunk_dir, digest[:2], digest[2:4], digest)
+
+    def has_chunk(self, digest):
+        return os.path.exists(self.chunk_path(digest))
+
+    def missing(self, digests):
+        return [digest for digest in dict.fromkeys(digests) if not self.has_chunk(digest)]
+
+    def write_chunk(self, digest, data):
+        path = self.chunk_path(digest)
+        if os.path.exists(path):
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp, "wb") as f:
+            f.write(data)
+        os.replace(temp, path)  # readers never see half a chunk, two writers of one chunk are harmless
+        return True
+
+    def put_chunk(self, data, wanted=None):
+        # stores data under its own hash, returns None without writing when the hash isn't wanted
+        digest = hashlib.sha256(data).hexdigest()
+        if wanted is not None and digest not in wanted:
+            return None
+        self.write_chunk(digest, data)
+        return digest
+
+    def manifest_path(self, name):
+        return os.path.join(self.manifest_dir, self.relative(name))
+
+    def read_manifest(self, name):
+        try:
+            with open(self.manifest_path(name)) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return manifest if isinstance(manifest, dict) and "chunks" in manifest else None
+
+    def checkout(self, name):
+        # (manifest, version) for one download, the chunks stay on disk until unpin() even if the
+        # file is deleted or replaced meanwhile. None when there is no such manifest
+        with self.lock:
+            try:
+                with open(self.manifest_path(name)) as f:
+                    version = os.fstat(f.fileno()).st_mtime_ns  # same inode the manifest is read from
+                    manifest = json.load(f)
+            except (OSError, ValueError):
+                return None
+            self.pins.update(digest for digest, _ in manifest["chunks"])
+        return manifest, version
+
+    def unpin(self, manifest):
+        with self.lock:
+            self.pins.subtract(digest for digest, _ in manifest["chunks"])
+            for digest, _ in manifest["chunks"]:
+                if self.pins[digest] <= 0:
+                    del self.pins[digest]
+                    if digest in self.doomed:
+                        self.doomed.discard(digest)
+                        self.delete_chunk(digest)
+
+    def hash_chunks(self, chunks):
+        # sha256 of the file the chunks make up, read in manifest order. they stay pinned meanwhile
+        # so a concurrent delete can't collect them, MissingChunks when one isn't stored
+        with self.lock:
+            absent = self.missing(digest for digest, _ in chunks)
+            if absent:
+                raise MissingChunks(absent)
+            self.pins.update(digest for digest, _ in chunks)
+        try:
+            return hash_pieces((self.chunk_path(digest), 0, length) for digest, length in chunks)
+        finally:
+            self.unpin({"chunks": chunks})
+
+    def commit(self, name, chunks, sha256=None):
+        # writes the manifest once every chunk is stored, an older version of the file is released
+        manifest = {"size": sum(length for _, length in chunks), "chunks": [list(chunk) for chunk in chunks]}
+        if sha256:
+            manifest["sha256"] = sha256
+        path = self.manifest_path(name)
+        with self.lock:
+            absent = self.missing(digest for digest, _ in chunks)
+            if absent:
+                raise MissingChunks(absent)
+            old = self.read_manifest(name)
+            # references go up before the manifest exists and down after it is gone,
+            # a crash in between can only leak a chunk, never lose one
+            self.refs.add_refs(digest for digest, _ in chunks)
+            self.doomed.difference_update(digest for digest, _ in chunks)  # referenced again, keep them
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp = temp_path(path)
+            with open(temp, "w") as f:
+                json.dump(manifest, f, separators=(",", ":"))
+            os.replace(temp, path)
+            if old:
+                self.release(old)
+        return manifest
+
+    def remove(self, name):
+        # False when there is no manifest of that name
+        with self.lock:
+            manifest = self.read_manifest(name)
+            if manifest is None:
+                return False
+            os.remove(self.manifest_path(name))
+            self.release(manifest)
+        return True
+
+    def release(self, manifest):
+        # caller holds the lock, chunks nobody refers to any more are deleted once no download reads them
+        for digest in self.refs.drop_refs(digest for digest, _ in manifest["chunks"]):
+            if self.pins[digest] > 0:
+                self.doomed.add(digest)
+            else:
+                self.delete_chunk(digest)
+
+    def delete_chunk(self, digest):
+        try:
+            os.remove(self.chunk_path(digest))
+        except FileNotFoundError:
+            pass
+
+    def ingest(self, name, path):
+        # moves a finished upload into the store, chunks we already hold are not written again
+        for attempt in range(2):
+            chunks = []
+            whole = hashlib.sha256()
+            with open(path, "rb") as f:
+                while True:
+                    data = f.read(self.chunk_size)
+                    if not data:
+                        break
+                    whole.update(data)
+                    digest = hashlib.sha256(data).hexdigest()
+                    self.write_chunk(digest, data)
+                    chunks.append([digest, len(data)])
+            try:
+                manifest = self.commit(name, chunks, whole.hexdigest())
+                break
+            except MissingChunks:
+                if attempt:
+                    raise  # a delete collected a shared chunk between our write and the commit, once is enough
+        os.remove(path)
+        return manifest
+
+    def pieces(self, manifest, offset, length):
+        # (chunk path, offset in chunk, count) covering offset..offset+length of the file
+        end = offset + length
+        position = 0
+        for digest, size in manifest["chunks"]:
+            if position >= end:
+                break
+            if position + size > offset:
+                start = max(offset, position) - position
+                yield self.chunk_path(digest), start, min(end, position + size) - position - start
+            position += size
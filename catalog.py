@@ -0,0 +1,169 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+# persistent file catalog, one sqlite database in WAL mode inside the storage folder so readers
+# never wait for the writer. the owner is stored explicitly, the old "{owner}_{name}" guess is
+# only used once, when a folder without a catalog is imported
+
+CATALOG_NAME = ".catalog.sqlite3"
+LIST_BATCH = 1000  # entries per catalog query when listing, and per ENTRIES frame
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    owner TEXT NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    sha256 TEXT,
+    uploaded_at REAL NOT NULL,
+    PRIMARY KEY (owner, name)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS files_by_name ON files (name, owner);
+CREATE INDEX IF NOT EXISTS files_by_size ON files (size, owner, name);
+CREATE INDEX IF NOT EXISTS files_by_upload ON files (uploaded_at, owner, name);
+CREATE TABLE IF NOT EXISTS chunk_refs (
+    digest TEXT PRIMARY KEY,
+    refs INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+FILE_COLUMNS = "owner, name, size, mtime, sha256, uploaded_at"
+SORT_COLUMNS = {"name": "name", "owner": "owner", "size": "size", "uploaded": "uploaded_at"}
+
+
+def sort_key(sort):
+    # every sort ends in (owner, name), the primary key, so a page boundary is never ambiguous
+    column = SORT_COLUMNS[sort]
+    return [column] + [c for c in ("owner", "name") if c != column]
+
+
+def prefix_bound(prefix):
+    # smallest string greater than everything starting with prefix
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class Catalog:
+    # files (primary key owner + name doubles as the by-owner index) and dedup chunk reference counts.
+    # one sqlite connection per thread, the event loop and executor threads both use it
+    def __init__(self, storage_dir):
+        self.path = os.path.join(storage_dir, CATALOG_NAME)
+        self.local = threading.local()
+
+    def db(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None)  # autocommit, transaction() groups writes
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")  # WAL keeps the database consistent, fsync at checkpoints
+            conn.execute("PRAGMA busy_timeout=5000")
+            self.local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        conn = self.db()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def open(self):
+        # creates the tables, returns False while the storage folder was never imported
+        self.db().executescript(SCHEMA)
+        return self.setting("imported") is not None
+
+    def close(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            self.local.conn = None
+            conn.close()
+
+    def setting(self, key):
+        row = self.db().execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+        return row["value"] if row else None
+
+    def set_setting(self, key, value):
+        self.db().execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def add(self, owner, name, size, mtime, sha256=None, uploaded_at=None):
+        self.db().execute(f"INSERT OR REPLACE INTO files ({FILE_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)",
+                          (owner, name, size, mtime, sha256, uploaded_at or time.time()))
+
+    def add_many(self, rows):
+        # (owner, name, size, mtime, sha256, uploaded_at) tuples in one transaction, used by the import
+        with self.transaction() as conn:
+            conn.executemany(f"INSERT OR REPLACE INTO files ({FILE_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+    def get(self, owner, name):
+        row = self.db().execute(f"SELECT {FILE_COLUMNS} FROM files WHERE owner = ? AND name = ?",
+                                (owner, name)).fetchone()
+        return dict(row) if row else None
+
+    def remove(self, owner, name):
+        cursor = self.db().execute("DELETE FROM files WHERE owner = ? AND name = ?", (owner, name))
+        return cursor.rowcount > 0
+
+    def set_hash(self, owner, name, mtime, sha256):
+        # only sticks when the file wasn't replaced while it was being hashed
+        self.db().execute("UPDATE files SET sha256 = ? WHERE owner = ? AND name = ? AND mtime = ?",
+                          (sha256, owner, name, mtime))
+
+    def page(self, owner=None, prefix=None, pattern=None, sort="name", reverse=False, after=None, limit=1000):
+        # one page of entries in sort order, after is the sort key of the last entry of the previous page.
+        # every sort column is indexed, a page costs O(limit) no matter how many files come before it.
+        # returns (entries, key of the last entry or None when nothing is left)
+        columns = sort_key(sort)
+        where = []
+        args = []
+        if owner is not None:
+            where.append("owner = ?")
+            args.append(owner)
+        if prefix:
+            where.append("name >= ? AND name < ?")
+            args += [prefix, prefix_bound(prefix)]
+        if pattern:
+            where.append("name GLOB ?")
+            args.append(pattern)
+        if after is not None:
+            where.append(f"({', '.join(columns)}) {'<' if reverse else '>'} ({', '.join('?' * len(columns))})")
+            args += list(after)
+        order = ", ".join(f"{column} {'DESC' if reverse else 'ASC'}" for column in columns)
+        where = f"WHERE {' AND '.join(where)}" if where else ""
+        sql = f"SELECT {FILE_COLUMNS} FROM files {where} ORDER BY {order} LIMIT ?"
+        rows = [dict(row) for row in self.db().execute(sql, args + [limit + 1])]
+        more = len(rows) > limit
+        rows = rows[:limit]
+        last = [rows[-1][column] for column in columns] if more else None
+        return rows, last
+
+    def count(self):
+        return self.db().execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def add_refs(self, digests):
+        counts = Counter(digests)
+        with self.transaction() as conn:
+            conn.executemany("INSERT INTO chunk_refs (digest, refs) VALUES (?, ?) "
+                             "ON CONFLICT (digest) DO UPDATE SET refs = refs + excluded.refs", counts.items())
+
+    def drop_refs(self, digests):
+        # returns the chunks nobody refers to any more
+        counts = Counter(digests)
+        with self.transaction() as conn:
+            conn.executemany("UPDATE chunk_refs SET refs = refs - ? WHERE digest = ?",
+                             [(count, digest) for digest, count in counts.items()])
+            unused = [row["digest"] for digest in counts for row in conn.execute(
+                "SELECT digest FROM chunk_refs WHERE digest = ? AND refs <= 0", (digest,))]
+            conn.executemany("DELETE FROM chunk_refs WHERE digest = ?", [(digest,) for digest in unused])
+        return unused
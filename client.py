@@ -1,18 +1,25 @@
-import socket
 import tkinter as tk
 from tkinter import filedialog, messagebox, simpledialog
 import os
 import threading
-import time
 from tkinter import ttk
 
+from client_core import DEFAULT_COMPRESSION, DEFAULT_STREAMS, Session
+from clientcache import LocalCache
+from logsink import LogSink
+from protocol import RequestError
+from transfer import RECV_BUFFER_SIZE
+
 class Client:
     def __init__(self, root):
         self.root = root
         self.root.title("Client GUI")
-        self.client_socket = None
+        self.session = None  # client_core.Session, all the socket work happens in there
         self.username = None
-        self.socket_lock = threading.RLock()  # using RLock for reentrancy
+        self.streams = DEFAULT_STREAMS  # parallel data connections for uploads/downloads
+        self.recv_buffer_size = RECV_BUFFER_SIZE  # download receive window, reused for every read
+        self.compression = DEFAULT_COMPRESSION  # codec asked for per transfer, compressed data is sent as is
+        self.cache = None  # index of downloaded files, unchanged ones are copied locally instead of downloaded
         self.receive_thread_running = False  # flag to control receive thread
 
         # gui components
@@ -55,6 +62,8 @@ class Client:
         scrollbar = ttk.Scrollbar(log_frame, orient="vertical", command=self.log_listbox.yview)
         scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
         self.log_listbox.config(yscrollcommand=scrollbar.set)
+        self.log_sink = LogSink(self.root, self.log_listbox)  # batched inserts, bounded history
+        self.log_sink.start()
 
         # file operations of client buttons
         file_operations_frame = ttk.Frame(self.root)
@@ -72,6 +81,9 @@ class Client:
         self.list_files_button = ttk.Button(file_operations_frame, text="List Files", command=self.list_files, state=tk.DISABLED)
         self.list_files_button.grid(row=1, column=1, padx=5, pady=5)
 
+        self.download_files_button = ttk.Button(file_operations_frame, text="Download Files", command=self.download_files, state=tk.DISABLED)
+        self.download_files_button.grid(row=2, column=0, columnspan=2, padx=5, pady=5)
+
         # connection statusa
         status_frame = ttk.Frame(self.root)
         status_frame.pack(pady=10)
@@ -89,11 +101,7 @@ class Client:
 
     def log_message(self, message):
         # thread safe logging
-        self.root.after(0, self._log_message_safe, message)
-
-    def _log_message_safe(self, message):
-        self.log_listbox.insert(tk.END, message)
-        self.log_listbox.yview(tk.END)
+        self.log_sink(message)
         
     def connect_to_server(self):
         server_ip = self.server_ip_entry.get()
@@ -104,43 +112,42 @@ class Client:
             self.log_message("Error: Enter valid server IP, port, and username!")
             return
 
-        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.client_socket.settimeout(5)  # set a timeout of 5 seconds
+        if self.cache is None:
+            try:
+                self.cache = LocalCache()
+            except Exception as e:
+                self.log_message(f"Local download cache unavailable, every download is fetched. {e}")
 
+        # control connection for commands, transfers get their own connections from the session pool
+        session = Session(server_ip, int(port), username, streams=self.streams,
+                          buffer_size=self.recv_buffer_size, on_notification=self.log_message,
+                          on_disconnect=self._server_disconnected, compression=self.compression, cache=self.cache)
         try:
-            self.client_socket.connect((server_ip, int(port)))
-            self.client_socket.settimeout(None)  # reset timeout to blocking mode
-            response = self.client_socket.recv(1024).decode()
+            greeting, response = session.connect()
+            if not session.framed:
+                self.log_message(greeting)
             self.log_message(response)
-
-            self.client_socket.send(username.encode())
-            response = self.client_socket.recv(1024).decode()
-
-            if "Error" in response:
-                self.log_message(response)
-                self.client_socket.close()
-                return
-            else:
-                self.log_message(response)
-
-            self.username = username
-            self.log_message("Connected to the server.")
-            self.enable_controls()
-            self.start_receive_thread()
-            self.update_status_label("Connected")
-            self.connect_button.config(state=tk.DISABLED)
-
+        except RequestError as e:
+            self.log_message(f"Error: {e}")
+            return
         except Exception as e:
             self.log_message(f"Error: Failed to connect to the server. {e}")
-        finally:
-            self.client_socket.settimeout(None)  #ensure timeout is reset
+            return
 
+        self.session = session
+        self.username = username
+        self.log_message("Connected to the server.")
+        self.enable_controls()
+        self.start_receive_thread()
+        self.update_status_label("Connected")
+        self.connect_button.config(state=tk.DISABLED)
 
     def enable_controls(self): #enable request options after connection
         self.upload_button.config(state=tk.NORMAL)
         self.delete_button.config(state=tk.NORMAL)
         self.download_button.config(state=tk.NORMAL)
         self.list_files_button.config(state=tk.NORMAL)
+        self.download_files_button.config(state=tk.NORMAL)
         self.disconnect_button.config(state=tk.NORMAL)
 
     def disable_controls(self): #disable requst options after disconnect
@@ -148,51 +155,56 @@ class Client:
         self.delete_button.config(state=tk.DISABLED)
         self.download_button.config(state=tk.DISABLED)
         self.list_files_button.config(state=tk.DISABLED)
+        self.download_files_button.config(state=tk.DISABLED)
         self.disconnect_button.config(state=tk.DISABLED)
 
     def upload_file(self):
-        filepath = filedialog.askopenfilename()
-        if not filepath:
+        filepaths = filedialog.askopenfilenames()
+        if not filepaths:
             self.log_message("No file selected.")
             return
 
-        #new thread for upload 
-        threading.Thread(target=self._upload_file_thread, args=(filepath,), daemon=True).start()
+        #new thread for upload, several of them can run at the same time
+        if len(filepaths) == 1:
+            threading.Thread(target=self._upload_file_thread, args=(filepaths[0],), daemon=True).start()
+        else:  # many files go together in one batch
+            threading.Thread(target=self._upload_files_thread, args=(list(filepaths),), daemon=True).start()
 
     def _upload_file_thread(self, filepath):
         try:
+            if self.session is None:
+                self.log_message("Not connected to the server.")
+                return
             filename = os.path.basename(filepath)
-            file_size = os.path.getsize(filepath)
-
-            with self.socket_lock: #locking for thread crashes
-                if self.client_socket is None:
-                    self.log_message("Not connected to the server.")
-                    return
-                command = f'upload "{filename}"'
-                self.client_socket.send(command.encode())
-                response = self.client_socket.recv(1024).decode()
-
-                if not response.startswith("Send file size"):
-                    self.log_message(f"Unexpected response from server: {response}")
-                    return
-
-                self.client_socket.send(str(file_size).encode())
-
-                with open(filepath, "rb") as f:
-                    while True:
-                        chunk = f.read(4096)
-                        if not chunk:
-                            break
-                        self.client_socket.sendall(chunk)
-
-                response = self.client_socket.recv(1024).decode()
-                self.log_message(response)
-
+            response = self.session.upload_file(filepath)
+            self.log_message(response)
             self.log_message(f"File {filename} uploaded successfully.")
-
+        except RequestError as e:
+            self.log_message(f"Error: {e}")
         except Exception as e:
             self.log_message(f"Error: Failed to upload file. {e}")
 
+    def _upload_files_thread(self, filepaths):
+        try:
+            if self.session is None:
+                self.log_message("Not connected to the server.")
+                return
+            self.log_results("uploaded", self.session.upload_files(filepaths))
+        except RequestError as e:
+            self.log_message(f"Error: {e}")
+        except Exception as e:
+            self.log_message(f"Error: Failed to upload files. {e}")
+
+    def log_results(self, action, results):
+        # one line per file of a batch
+        for result in results:
+            if result["ok"]:
+                self.log_message(f"File {result['name']} {action} successfully.")
+            else:
+                self.log_message(f"Error: {result['name']}: {result['message']}")
+        failed = sum(not result["ok"] for result in results)
+        self.log_message(f"{len(results) - failed} of {len(results)} files {action}.")
+
     def delete_file(self):
         filename = simpledialog.askstring("Delete File", "Enter the filename to delete:")
         if not filename:
@@ -200,15 +212,12 @@ class Client:
             return
 
         try:
-            with self.socket_lock: #locking for thread crashes
-                if self.client_socket is None:
-                    self.log_message("Not connected to the server.")
-                    return
-                command = f'delete "{filename}"'
-                self.client_socket.send(command.encode())
-                response = self.client_socket.recv(1024).decode()
-                self.log_message(response)
-
+            if self.session is None:
+                self.log_message("Not connected to the server.")
+                return
+            self.log_message(self.session.delete_file(filename))
+        except RequestError as e:
+            self.log_message(f"Error: {e}")
         except Exception as e:
             self.log_message(f"Error: Failed to delete file. {e}")
 
@@ -226,75 +235,66 @@ class Client:
 
     def _download_file_thread(self, filename, owner, save_dir):
         try:
-            with self.socket_lock: # locking for thread crashes
-                if self.client_socket is None:
-                    self.log_message("Not connected to the server.")
-                    return
-                command = f'download "{filename}" "{owner}"'
-                self.client_socket.send(command.encode())
-                response = self.client_socket.recv(1024).decode()
-
-                if not response.isdigit():
-                    self.log_message(response)
-                    return
-
-                file_size = int(response)
-                self.client_socket.send(b"Ready")
-
-                save_path = os.path.join(save_dir, filename)
-                with open(save_path, "wb") as f:
-                    received = 0
-                    while received < file_size:
-                        remaining = file_size - received
-                        data = self.client_socket.recv(min(4096, remaining)) # make them packet delivery again for deal with large file sizes
-                        if not data:
-                            break
-                        f.write(data)
-                        received += len(data)
-
-                
-                if self.client_socket is None:
-                    self.log_message("Not connected to the server.")
-                    return
-                
-                # read the confirmation message from the server
-                response = self.client_socket.recv(1024).decode()
-                self.log_message(response)
-
+            if self.session is None:
+                self.log_message("Not connected to the server.")
+                return
+            response = self.session.download_file(filename, owner, save_dir)
+            self.log_message(response)
             self.log_message(f"File {filename} downloaded successfully to {save_dir}.")
-
+        except RequestError as e:
+            self.log_message(f"Error: {e}")
         except Exception as e:
             self.log_message(f"Error: Failed to download file. {e}")
 
-    def list_files(self):
+    def download_files(self):
+        owner = simpledialog.askstring("Download Files", "Enter the owner whose files to download:")
+        prefix = simpledialog.askstring("Download Files", "Only names starting with (leave empty for all):")
+        save_dir = filedialog.askdirectory()
+
+        if not owner or not save_dir:
+            self.log_message("Error: Missing information for download.")
+            return
+
+        threading.Thread(target=self._download_files_thread, args=(owner, prefix or None, save_dir), daemon=True).start()
+
+    def _download_files_thread(self, owner, prefix, save_dir):
         try:
-            with self.socket_lock:
-                if self.client_socket is None:
-                    self.log_message("Not connected to the server.")
-                    return
-                self.client_socket.send(b"list")
-                data = b""
-                while True:
-                    chunk = self.client_socket.recv(1024)
-                    data += chunk
-                    if len(chunk) < 1024:
-                        break
-
-                response = data.decode()
-                self.log_message("Files on the server:")
-                for line in response.splitlines(): # split them from new lines to make them readable
-                    self.log_message(line)
+            if self.session is None:
+                self.log_message("Not connected to the server.")
+                return
+            results = self.session.download_files(None, save_dir, owner=owner, prefix=prefix)
+            if not results:
+                self.log_message("No files available.")
+                return
+            self.log_results(f"downloaded to {save_dir}", results)
+        except RequestError as e:
+            self.log_message(f"Error: {e}")
+        except Exception as e:
+            self.log_message(f"Error: Failed to download files. {e}")
 
+    def list_files(self):
+        try:
+            if self.session is None:
+                self.log_message("Not connected to the server.")
+                return
+            self.log_message("Files on the server:")
+            count = 0
+            for entry in self.session.iter_files(): # one line per file to make them readable, streamed
+                self.log_message(f"{entry['name']} (Owner: {entry['owner']})")
+                count += 1
+            if not count:
+                self.log_message("No files available.")
+        except RequestError as e:
+            self.log_message(f"Error: {e}")
         except Exception as e:
             self.log_message(f"Error: Failed to list files. {e}")
 
     def disconnect(self):
         try:
-            with self.socket_lock:
-                if self.client_socket:
-                    self.client_socket.close()
-                self.client_socket = None
-                self.receive_thread_running = False  # stop the receive thread
+            self.receive_thread_running = False  # stop the receive thread
+            session, self.session = self.session, None
+            if session:
+                session.close()
             self.disable_controls()
             self.log_message("Disconnected from the server.")
         except Exception as e:
@@ -302,57 +302,27 @@ class Client:
         self.update_status_label("Disconnected")
         self.connect_button.config(state=tk.NORMAL)
 
+    def _server_disconnected(self, reason):
+        self.receive_thread_running = False
+        self.log_message(reason)
+        self.root.after(0, self.disconnect)
+
     def start_receive_thread(self): #listening thread starter for receive message function using this in connect server function
-        
+        if self.session.framed:
+            return  # the session's reader thread pushes notifications and disconnects as they arrive
         self.receive_thread_running = True
-        receive_thread = threading.Thread(target=self.receive_message, daemon=True)
+        receive_thread = threading.Thread(target=self.receive_message, args=(self.session,), daemon=True)
         receive_thread.start()
 
-    def receive_message(self): # listening messages from server
-        try:
-            while self.receive_thread_running:
-                acquired = self.socket_lock.acquire(timeout=0.1) # this is for crash 
-                if acquired:
-                    try:
-                        if self.client_socket is None:
-                            break  # socket is closed exit the loop
-                        self.client_socket.settimeout(0.1)
-                        try:
-                            message = self.client_socket.recv(1024).decode()
-                            if message: # message content checking for motion of client
-                                if message.startswith("NOTIFICATION:"):
-                                    self.log_message(f"{message}")
-                                elif message.startswith("DISCONNECT"):
-                                    self.log_message("Disconnected by server because server is closed.")
-                                    self.disconnect()
-                                    break
-                                else:
-                                    # handle other messages
-                                    self.log_message(f"{message}")
-                            else:
-                                #cnnection closed by server
-                                self.log_message("Connection closed by server.")
-                                self.disconnect()
-                                break
-                        except socket.timeout:
-                            continue  #contiune to listening 
-                        except Exception as e:
-                            self.log_message(f"Error while receiving message: {e}")
-                            self.disconnect()
-                            break
-                        finally:
-                            if self.client_socket:
-                                self.client_socket.settimeout(None)
-                    finally:
-                        self.socket_lock.release()
-                else:
-                    
-                    #wait and try again
-                    time.sleep(0.1)
-        except Exception as e:
-            self.log_message(f"Connection error: {e}")
-            if self.client_socket:
-                self.client_socket.close()
+    def receive_message(self, session): # listening notifications from an old text protocol server
+        while self.receive_thread_running and session is self.session:
+            try:
+                session.poll(0.1)  # notifications and disconnects come back through the session callbacks
+            except Exception as e:
+                if self.receive_thread_running and session is self.session:
+                    self.log_message(f"Connection error: {e}")
+                    self.root.after(0, self.disconnect)
+                break
     
     def update_status_label(self, status): #user frienly fnction for gui informing about connection 
         if status == "Connected":
@@ -0,0 +1,1197 @@
+import fnmatch
+import hashlib
+import os
+import queue
+import selectors
+import socket
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+from cas import chunk_list
+from compression import BLOCK_SIZE, choose_codec, decode_block, encode_block, get_codec, looks_compressible
+from delta import MAX_LITERAL, SIGNATURE, compute_delta, parse_signatures
+from protocol import (COMMAND, DATA, DATA_FRAME_SIZE, DISCONNECT, END, ENTRIES, ERROR, HELLO, META, NOTIFICATION, OK,
+                      READY, VERSION, WELCOME, Frame, FrameSocket, ProtocolError, RequestError,
+                      advertises_framing)
+from transfer import (RECV_BUFFER_SIZE, HashingWriter, PositionalWriter, StreamHash, hash_file, preallocate,
+                      read_partial_info, recv_into_file, remove_partial, split_ranges, write_partial_info)
+
+# protocol side of the client, no tkinter in here so scripts and tools can reuse it
+
+DEFAULT_STREAMS = 4  # data connections opened next to the control connection
+CONNECT_TIMEOUT = 5
+PARTIAL_SUFFIX = ".part"  # unfinished downloads, resumed on the next try
+TRANSFER_RETRIES = 3  # reconnect and resume this many times when a transfer connection drops
+SEGMENT_THRESHOLD = 64 * 1024 * 1024  # downloads at least this big are split across the data connections
+MIN_SEGMENT_SIZE = 8 * 1024 * 1024
+CHUNK_QUERY_BATCH = 16384  # chunk hashes per "chunks" command, keeps the json frames small
+DEFAULT_COMPRESSION = "auto"  # what the gui asks for, the best codec both sides have
+DELTA_THRESHOLD = 1024 * 1024  # smaller files are re-uploaded whole, a delta wouldn't save much
+
+
+class TransferAborted(Exception):
+    # the transfer was given up half way, the connection is out of sync and gets dropped
+    pass
+
+
+class NotModified(Exception):
+    # a conditional download found the server holding what the client already has
+    def __init__(self, info):
+        super().__init__("File not modified.")
+        self.info = info
+
+
+def open_socket(host, port, timeout=CONNECT_TIMEOUT):
+    sock = socket.create_connection((host, int(port)), timeout=timeout)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+class GuardedSink:
+    # lets the reader thread write DATA payloads into a caller's file. a failing write (disk full)
+    # is kept for the waiting thread instead of killing the reader, the rest of the payload is dropped
+    def __init__(self, f):
+        self.f = f
+        self.error = None
+
+    def write(self, data):
+        if self.f is not None and self.error is None:
+            try:
+                self.f.write(data)
+            except Exception as e:
+                self.error = e
+        return len(data)
+
+
+class Waiter:
+    # one request waiting for its frames
+    def __init__(self):
+        self.replies = queue.SimpleQueue()  # (frame, bytes written to the sink) or an exception
+        self.sink = None  # without one DATA frames are handed over whole, like any other frame
+        self.sink_ready = threading.Event()  # DATA frames wait until the request says where they go
+
+    def set_sink(self, f):
+        self.sink = f
+        self.sink_ready.set()
+
+    def next_frame(self):
+        item = self.replies.get()
+        if isinstance(item, BaseException):
+            raise item
+        return item
+
+
+class FrameReader:
+    # the only thread reading a control connection. replies are handed to the thread that waits
+    # for their request id, notifications and disconnects go through a queue to a callback thread
+    # so a slow callback never holds up a reply. commands wait on their own queue, nothing polls
+    def __init__(self, channel):
+        self.channel = channel
+        self.frames = channel.frames
+        self.waiters = {}  # request id -> Waiter
+        self.lock = threading.Lock()
+        self.closed = False
+        self.stopping = False  # closed by us, not by the server
+        self.announced = False  # on_disconnect was already queued
+        self.events = queue.SimpleQueue()
+        self.wakeup, self.wakeup_writer = socket.socketpair()
+        self.thread = threading.Thread(target=self.run, name="frame-reader", daemon=True)
+        self.dispatcher = threading.Thread(target=self.dispatch, name="frame-callbacks", daemon=True)
+
+    def start(self):
+        self.thread.start()
+        self.dispatcher.start()
+
+    def stop(self):
+        self.stopping = True
+        try:
+            self.wakeup_writer.send(b"x")
+        except OSError:
+            pass
+
+    def register(self, request_id):
+        with self.lock:
+            if self.closed:
+                raise ConnectionError("Connection to the server was lost.")
+            self.waiters[request_id] = waiter = Waiter()
+        return waiter
+
+    def unregister(self, request_id):
+        with self.lock:
+            waiter = self.waiters.pop(request_id, None)
+        if waiter is not None:
+            waiter.sink_ready.set()  # frames still coming for it are dropped
+
+    def run(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self.channel.sock, selectors.EVENT_READ)
+        selector.register(self.wakeup, selectors.EVENT_READ)
+        try:
+            while not self.stopping:
+                if not self.frames.buffer:  # bytes read ahead with the previous frame need no wait
+                    ready = [key.fileobj for key, _ in selector.select()]
+                    if self.wakeup in ready:
+                        break
+                self.read_frame()
+        except (OSError, ValueError, ConnectionError, ProtocolError):
+            pass
+        finally:
+            selector.close()
+            self.shutdown()
+
+    def read_frame(self):
+        frame_type, request_id, length = self.frames.recv_header()
+        with self.lock:
+            waiter = self.waiters.get(request_id)
+        if frame_type == DATA and waiter is not None:
+            waiter.sink_ready.wait()
+            with self.lock:
+                waiter = self.waiters.get(request_id)  # may have given up meanwhile
+        if frame_type == DATA and (waiter is None or waiter.sink is not None):
+            sink = GuardedSink(waiter.sink if waiter is not None else None)
+            written = self.frames.recv_payload_into(length, sink)
+            if waiter is not None:
+                waiter.replies.put(sink.error or (Frame(DATA, request_id, b""), written))
+            return
+        frame = self.frames.recv_frame_body(frame_type, request_id, length)
+        if waiter is not None:
+            waiter.replies.put((frame, 0))
+        elif frame.type == NOTIFICATION:
+            self.events.put((self.channel.on_notification, frame.message()))
+        elif frame.type == DISCONNECT:
+            self.announce("Disconnected by server because server is closed.")
+            raise ConnectionError("Server closed the connection.")
+        elif request_id == 0:
+            self.events.put((self.channel.on_notification, f"Unexpected message from server: {frame}"))
+        # anything else answers a request that was given up on, nobody wants it
+
+    def announce(self, reason):
+        if not self.announced and not self.stopping:
+            self.announced = True
+            self.events.put((self.channel.on_disconnect, reason))
+
+    def shutdown(self):
+        with self.lock:
+            self.closed = True
+            waiters, self.waiters = list(self.waiters.values()), {}
+        for waiter in waiters:
+            waiter.replies.put(ConnectionError("Connection to the server was lost."))
+            waiter.sink_ready.set()
+        self.announce("Connection closed by server.")
+        self.events.put(None)
+        self.wakeup.close()
+        self.wakeup_writer.close()
+
+    def dispatch(self):
+        while True:
+            event = self.events.get()
+            if event is None:
+                return
+            callback, message = event
+            if callback:
+                try:
+                    callback(message)
+                except Exception:
+                    pass
+
+
+class Channel:
+    # one framed connection. data connections are used by a single thread at a time and read
+    # their replies themselves, the control connection gets a FrameReader and takes commands
+    # from any thread
+    def __init__(self, sock, buffer_size=RECV_BUFFER_SIZE, on_notification=None, on_disconnect=None):
+        self.sock = sock
+        self.frames = FrameSocket(sock, buffer_size)
+        self.on_notification = on_notification
+        self.on_disconnect = on_disconnect
+        self.welcome = {}
+        self.reader = None
+        self.send_lock = threading.RLock()  # one frame (or one whole upload) at a time on the wire
+        self.sinks = {}  # request id -> file DATA frames are written to, without a reader
+        self.waiting = {}  # request id -> the reader's Waiter, kept here so a reader shutdown can't lose it
+
+    def login(self, hello):
+        self.frames.send_frame(HELLO, 0, dict(hello, version=VERSION))
+        reply = self.frames.recv_frame()
+        if reply.type != WELCOME:
+            raise RequestError(reply.message() or "Login refused.")
+        self.welcome = reply.json()
+        self.sock.settimeout(None)
+        return reply.message()
+
+    def start_reader(self):
+        self.reader = FrameReader(self)
+        self.reader.start()
+
+    def close(self):
+        if self.reader:
+            self.reader.stop()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)  # wakes a reader blocked in the middle of a frame
+        except OSError:
+            pass
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+    def handle_unsolicited(self, frame):
+        if frame.type == NOTIFICATION:
+            if self.on_notification:
+                self.on_notification(frame.message())
+        elif frame.type == DISCONNECT:
+            if self.on_disconnect:
+                self.on_disconnect("Disconnected by server because server is closed.")
+            raise ConnectionError("Server closed the connection.")
+        elif self.on_notification:
+            self.on_notification(f"Unexpected message from server: {frame}")
+
+    def send_frame(self, frame_type, request_id, payload=None):
+        with self.send_lock:
+            self.frames.send_frame(frame_type, request_id, payload)
+
+    @contextmanager
+    def request(self, payload, exclusive=False):
+        # sends a command and yields its request id. the id is registered with the reader before
+        # the command goes out so the reply can't slip past. exclusive keeps other threads from
+        # sending until the block ends, uploads stream DATA frames the server reads in one go
+        request_id = self.frames.next_request_id()
+        if self.reader:
+            self.waiting[request_id] = self.reader.register(request_id)
+        try:
+            with self.send_lock if exclusive else nullcontext():
+                self.send_frame(COMMAND, request_id, payload)
+                yield request_id
+        finally:
+            self.sinks.pop(request_id, None)
+            self.waiting.pop(request_id, None)
+            if self.reader:
+                self.reader.unregister(request_id)
+
+    def set_sink(self, request_id, f):
+        # DATA frames of the request are written to f from now on, None hands them over as frames
+        if self.reader:
+            self.waiting[request_id].set_sink(f)
+        else:
+            self.sinks[request_id] = f
+
+    def next_frame(self, request_id):
+        # (frame, bytes written to the sink), DATA payloads go straight to the request's sink
+        if self.reader:
+            return self.waiting[request_id].next_frame()
+        sink = self.sinks.get(request_id)
+        while True:
+            frame_type, frame_id, length = self.frames.recv_header()
+            if frame_id == request_id and frame_type == DATA and sink is not None:
+                return Frame(DATA, frame_id, b""), self.frames.recv_payload_into(length, sink)
+            frame = self.frames.recv_frame_body(frame_type, frame_id, length)
+            if frame_id == request_id:
+                return frame, 0
+            self.handle_unsolicited(frame)
+
+    def wait_reply(self, request_id):
+        return self.next_frame(request_id)[0]
+
+    def command(self, payload):
+        with self.request(payload) as request_id:
+            reply = self.wait_reply(request_id)
+        if reply.type == ERROR:
+            raise RequestError(reply.message())
+        return reply
+
+    def poll(self, timeout):
+        # waits for one unsolicited frame, returns False when nothing arrived.
+        # with a reader running the frames are delivered by it, this only watches it stay alive
+        if self.reader:
+            self.reader.thread.join(timeout)
+            if self.reader.closed:
+                raise ConnectionError("Connection to the server was lost.")
+            return False
+        self.sock.settimeout(timeout)
+        try:
+            frame = self.frames.recv_frame()
+        except (socket.timeout, BlockingIOError):
+            return False
+        finally:
+            self.sock.settimeout(None)
+        self.handle_unsolicited(frame)
+        return True
+
+    def list_files(self, **query):
+        return list(self.iter_files(**query))
+
+    def iter_files(self, **query):
+        # streamed listing, entries are yielded as their batches arrive. query takes owner, prefix,
+        # glob, sort (name/owner/size/uploaded), reverse and limit
+        request = {key: value for key, value in query.items() if value is not None}
+        with self.request(dict(request, cmd="list", stream=True)) as request_id:
+            while True:
+                reply = self.wait_reply(request_id)
+                if reply.type == ENTRIES:
+                    yield from reply.json()["files"]
+                elif reply.type == END:
+                    return
+                elif reply.type == OK:  # server without streaming
+                    yield from reply.json()["files"]
+                    return
+                else:
+                    raise RequestError(reply.message())
+
+    def list_page(self, limit, cursor=None, **query):
+        # one page and the cursor of the next one (None on the last page)
+        request = {key: value for key, value in query.items() if value is not None}
+        reply = self.command(dict(request, cmd="list", limit=limit, cursor=cursor)).json()
+        return reply["files"], reply.get("cursor")
+
+    def delete_file(self, filename):
+        return self.command({"cmd": "delete", "name": filename}).message()
+
+    def stat_file(self, filename, owner, with_hash=False):
+        return self.command({"cmd": "stat", "name": filename, "owner": owner, "hash": with_hash}).json()
+
+    def upload_file(self, filepath, filename=None, resume=False, codec=None):
+        # size goes with the command and the bytes follow right away. a resumable upload
+        # waits for READY first, the server tells how many bytes it already holds.
+        # with a codec the file goes in compressed blocks, unless it looks compressed already.
+        # the sha256 hashed along the way goes with END, the server checks it and keeps it
+        filename = filename or os.path.basename(filepath)
+        stat = os.stat(filepath)
+        request = {"cmd": "upload", "name": filename, "size": stat.st_size}
+        if resume:
+            request.update(resume=True, mtime=stat.st_mtime_ns)
+        codec = get_codec(codec)
+        if codec and not looks_compressible([(filepath, 0, stat.st_size)], stat.st_size):
+            codec = None
+        if codec:
+            request["codec"] = codec.name
+        with self.request(request, exclusive=True) as request_id:
+            offset = 0
+            if resume:
+                reply = self.wait_reply(request_id)
+                if reply.type != READY:
+                    raise RequestError(reply.message())
+                offset = reply.json()["offset"]
+            hasher = StreamHash()
+            try:
+                if offset:
+                    hasher.update_file(filepath, 0, offset)
+                with open(filepath, "rb") as f:
+                    f.seek(offset)
+                    while True:
+                        chunk = f.read(BLOCK_SIZE if codec else DATA_FRAME_SIZE)
+                        if not chunk:
+                            break
+                        hasher.update(chunk)
+                        self.send_frame(DATA, request_id, encode_block(codec, chunk) if codec else chunk)
+                self.send_frame(END, request_id, {"sha256": hasher.hexdigest()})
+            finally:
+                hasher.close()
+            reply = self.wait_reply(request_id)
+        if reply.type == ERROR:
+            raise RequestError(reply.message())
+        return reply.message()
+
+    def missing_chunks(self, digests):
+        missing = []
+        for start in range(0, len(digests), CHUNK_QUERY_BATCH):
+            reply = self.command({"cmd": "chunks", "hashes": digests[start:start + CHUNK_QUERY_BATCH]})
+            missing += reply.json()["missing"]
+        return missing
+
+    def upload_deduplicated(self, filepath, chunk_size, filename=None):
+        # dedup servers: only chunks the server doesn't hold yet are sent, the rest is referenced by
+        # hash. a dropped connection needs no resume, chunks that made it are not missing next time
+        filename = filename or os.path.basename(filepath)
+        whole = hashlib.sha256()
+        chunks = chunk_list(filepath, chunk_size, whole)
+        for attempt in range(2):
+            missing = set(self.missing_chunks([digest for digest, _ in chunks]))
+            request = {"cmd": "upload_chunks", "name": filename, "size": sum(length for _, length in chunks),
+                       "chunks": chunks}
+            with self.request(request, exclusive=True) as request_id:
+                with open(filepath, "rb") as f:
+                    offset = 0
+                    for digest, length in chunks:
+                        if digest in missing:
+                            missing.discard(digest)  # repeated chunks of the file go once
+                            f.seek(offset)
+                            self.send_frame(DATA, request_id, f.read(length))
+                        offset += length
+                self.send_frame(END, request_id, {"sha256": whole.hexdigest()})
+                reply = self.wait_reply(request_id)
+            if reply.type != ERROR:
+                return reply.message()
+            if attempt or not reply.json().get("missing"):
+                raise RequestError(reply.message())
+
+    def upload_delta(self, filepath, filename=None, codec=None):
+        # re-upload of a file the server already holds, only what changed goes over (see delta.py).
+        # None when the server has no copy or when most of the file is new, a plain upload is better then
+        filename = filename or os.path.basename(filepath)
+        size = os.path.getsize(filepath)
+        request = {"cmd": "upload_delta", "name": filename, "size": size}
+        codec = get_codec(codec)
+        if codec and not looks_compressible([(filepath, 0, size)], size):
+            codec = None
+        if codec:
+            request["codec"] = codec.name
+        with self.request(request, exclusive=True) as request_id:
+            reply = self.wait_reply(request_id)
+            if reply.type != META:
+                if reply.type == ERROR and reply.json().get("no_base"):
+                    return None
+                raise RequestError(reply.message())
+            meta = reply.json()
+            self.set_sink(request_id, None)
+            records = bytearray()
+            while len(records) < meta["blocks"] * SIGNATURE.size:
+                frame, _ = self.next_frame(request_id)
+                if frame.type != DATA:
+                    raise RequestError(frame.message())
+                records += frame.payload
+            block = meta["block_size"]
+            whole = hashlib.sha256()
+            ops = compute_delta(filepath, block, meta["base_size"], parse_signatures(records),
+                                max_literal=int(size * MAX_LITERAL), whole=whole)
+            if ops is None:
+                self.send_frame(END, request_id, {"cancel": True})
+                self.wait_reply(request_id)
+                return None
+            with open(filepath, "rb") as f:
+                for op, start, count in ops:
+                    if op == "copy":
+                        self.send_frame(META, request_id, {"copy": [start, count]})
+                        continue
+                    f.seek(start)
+                    while count:
+                        chunk = f.read(min(count, BLOCK_SIZE if codec else DATA_FRAME_SIZE))
+                        if not chunk:
+                            raise TransferAborted(f"File {filename} shrank during upload.")
+                        self.send_frame(DATA, request_id, encode_block(codec, chunk) if codec else chunk)
+                        count -= len(chunk)
+            self.send_frame(END, request_id, {"sha256": whole.hexdigest()})
+            reply = self.wait_reply(request_id)
+        if reply.type == ERROR:
+            raise RequestError(reply.message())
+        return reply.message()
+
+    def upload_batch(self, paths, names=None, codec=None):
+        # many files in one request, each a META header with name and size followed by its DATA frames.
+        # returns one result per file, {"name", "ok", "message"}, a file failing doesn't stop the others.
+        # the server stores each file as it arrives and reports the sha256 it hashed, checked here
+        names = names or [os.path.basename(path) for path in paths]
+        codec = get_codec(codec)
+        request = {"cmd": "upload_batch"}
+        if codec:
+            request["codec"] = codec.name
+        sent = []  # (name, sha256 of what went out or the reason it didn't)
+        with self.request(request, exclusive=True) as request_id:
+            for path, name in zip(paths, names):
+                try:
+                    f = open(path, "rb")
+                except OSError as e:
+                    sent.append((name, e))
+                    continue
+                with f:
+                    size = os.fstat(f.fileno()).st_size
+                    self.send_frame(META, request_id, {"name": name, "size": size})
+                    hasher = hashlib.sha256()
+                    remaining = size
+                    while remaining:
+                        chunk = f.read(min(remaining, BLOCK_SIZE if codec else DATA_FRAME_SIZE))
+                        if not chunk:
+                            # can't take back the size in META, the rest of the stream would be garbage
+                            raise TransferAborted(f"File {name} shrank during upload.")
+                        hasher.update(chunk)
+                        self.send_frame(DATA, request_id, encode_block(codec, chunk) if codec else chunk)
+                        remaining -= len(chunk)
+                    sent.append((name, hasher.hexdigest()))
+            self.send_frame(END, request_id)
+            results = []
+            while True:
+                reply = self.wait_reply(request_id)
+                if reply.type == ENTRIES:
+                    results += reply.json()["files"]
+                elif reply.type == OK:
+                    break
+                else:
+                    raise RequestError(reply.message())
+
+        results = iter(results)  # in the order the entries were sent
+        report = []
+        for name, digest in sent:
+            result = next(results, None) if isinstance(digest, str) else None
+            if isinstance(digest, OSError):
+                report.append({"name": name, "ok": False, "message": f"Couldn't read the file. {digest}"})
+            elif result is None:
+                report.append({"name": name, "ok": False, "message": "No result from the server."})
+            elif result["ok"] and result.get("sha256") != digest:
+                report.append({"name": name, "ok": False, "message": "File failed verification on the server."})
+            elif result["ok"]:
+                report.append({"name": name, "ok": True, "message": "File received successfully."})
+            else:
+                report.append({"name": name, "ok": False, "message": result.get("message", "Upload failed.")})
+        return report
+
+    def download_range(self, filename, owner, f, offset=0, length=None, version=None, on_meta=None, codec=None,
+                       condition=None):
+        # writes the requested range at the current position of f, returns (META, END) payloads.
+        # codec asks for compressed blocks, the server may still send the data as it is.
+        # condition ({"if_version", "if_sha256"}) raises NotModified when the server holds that content
+        request = dict(condition or {}, cmd="download", name=filename, owner=owner, offset=offset)
+        if length is not None:
+            request["length"] = length
+        if version is not None:
+            request["version"] = version
+        if codec:
+            request["codec"] = codec
+        with self.request(request) as request_id:
+            reply = self.wait_reply(request_id)
+            if reply.type == OK and condition:
+                raise NotModified(reply.json())
+            if reply.type != META:
+                raise RequestError(reply.message())
+            meta = reply.json()
+            if on_meta:
+                on_meta(meta)  # may move f when the server restarted the range
+            elif meta["offset"] != offset:
+                raise TransferAborted("File changed on the server during download.")
+
+            codec = get_codec(meta.get("codec"))
+            self.set_sink(request_id, None if codec else f)  # only now, on_meta may still have moved f
+            received = 0
+            while True:
+                frame, written = self.next_frame(request_id)
+                if frame.type == DATA:
+                    if codec:
+                        data = decode_block(codec, frame.payload)
+                        f.write(data)
+                        written = len(data)
+                    received += written
+                    continue
+                if frame.type == END:
+                    break
+                raise RequestError(frame.message())
+
+        if received != meta["length"]:
+            raise RequestError(f"File size mismatch: expected {meta['length']}, received {received}")
+        return meta, frame.json()
+
+    def download_file(self, filename, owner, save_path, resume=False, codec=None, cache=None):
+        # data goes to save_path.part first, a broken download keeps it so the next try can resume.
+        # it's hashed as it arrives and checked against the sha256 the server sends with END.
+        # with a clientcache.LocalCache the download is conditional on what it already holds
+        cached = cache.lookup(owner, filename) if cache else None
+        condition = {"if_version": cached["version"], "if_sha256": cached["sha256"]} if cached else None
+        partial = save_path + PARTIAL_SUFFIX
+        offset = 0
+        version = None
+        info = read_partial_info(partial) if resume else None
+        if info and os.path.exists(partial) and os.path.getsize(partial) < info["size"]:
+            offset = os.path.getsize(partial)
+            version = info["version"]
+
+        def start(meta):
+            version_seen.append(meta["version"])
+            if meta["offset"] != offset:  # the file changed since the partial download, start over
+                f.seek(meta["offset"])
+                f.truncate()
+            write_partial_info(partial, meta["size"], meta["version"])
+            if meta["offset"] == 0:
+                preallocate(f, meta["size"])
+            else:
+                hasher.update_file(partial, 0, meta["offset"])  # resumed, what arrived last time
+
+        version_seen = []
+        hasher = StreamHash()
+        try:
+            with open(partial, "r+b" if offset else "wb") as f:
+                f.seek(offset)
+                try:
+                    _, end = self.download_range(filename, owner, HashingWriter(f, hasher), offset,
+                                                 version=version, on_meta=start, codec=codec, condition=condition)
+                finally:
+                    f.truncate(f.tell())
+            sha256 = hasher.hexdigest()
+        except NotModified:
+            if not offset:
+                remove_partial(partial)
+            return cache.materialize(cached, owner, filename, save_path)
+        except BaseException:
+            if os.path.exists(partial) and not os.path.getsize(partial):
+                remove_partial(partial)  # nothing worth resuming
+            raise
+        finally:
+            hasher.close()
+        if end.get("sha256") not in (None, sha256):
+            remove_partial(partial)
+            raise RequestError(f"Downloaded file {filename} failed verification.")
+        os.replace(partial, save_path)
+        remove_partial(partial, keep_data=True)
+        if cache:
+            cache.record(owner, filename, save_path, sha256, version_seen[-1])
+        return end.get("message", "")
+
+    def download_batch(self, files, save_dir, codec=None, cache=None, **query):
+        # files is a list of (name, owner), None downloads everything matching query (owner, prefix,
+        # glob). they come back to back in one stream, each saved through a .part file and checked
+        # against the sha256 the server knows. a name that repeats for several owners is saved as
+        # owner_name. returns one result per file, {"name", "owner", "ok", "message"}.
+        # with a clientcache.LocalCache the listed files the cache holds are only sent when they changed
+        request = {key: value for key, value in query.items() if value is not None}
+        request["cmd"] = "download_batch"
+        cached = {}
+        if files is not None:
+            request["files"] = []
+            for name, owner in files:
+                entry = cache.lookup(owner, name) if cache else None
+                if entry:
+                    cached[owner, name] = entry
+                    request["files"].append({"name": name, "owner": owner, "if_version": entry["version"],
+                                             "if_sha256": entry["sha256"]})
+                else:
+                    request["files"].append({"name": name, "owner": owner})
+        if codec:
+            request["codec"] = codec
+        results = []
+        taken = set()
+        with self.request(request) as request_id:
+            self.set_sink(request_id, None)  # the entries are split up here, DATA comes as frames
+            while True:
+                reply = self.wait_reply(request_id)
+                if reply.type == END:
+                    break
+                if reply.type != META:
+                    raise RequestError(reply.message())
+                meta = reply.json()
+                name, owner = meta["name"], meta["owner"]
+                if "error" in meta:
+                    results.append({"name": name, "owner": owner, "ok": False, "message": meta["error"]})
+                    continue
+                target = name if name not in taken else f"{owner}_{name}"
+                if not is_local_name(target):
+                    # the name comes from the server, it must not reach outside save_dir
+                    if not meta.get("not_modified"):
+                        self.read_batch_entry(request_id, meta, None)  # skipped, the stream stays in sync
+                    results.append({"name": name, "owner": owner, "ok": False,
+                                    "message": f"Server sent an invalid file name: {target!r}"})
+                    continue
+                taken.add(target)
+                save_path = os.path.join(save_dir, target)
+                if meta.get("not_modified"):
+                    if (owner, name) not in cached:
+                        raise ProtocolError(f"Server sent not modified for {name}, which wasn't asked about")
+                    message = cache.materialize(cached[owner, name], owner, name, save_path)
+                    results.append({"name": name, "owner": owner, "ok": True, "path": save_path, "message": message})
+                    continue
+                result = self.receive_batch_entry(request_id, meta, save_path)
+                if cache and result["ok"]:
+                    cache.record(owner, name, save_path, result["sha256"], meta["version"])
+                results.append(result)
+        return results
+
+    def receive_batch_entry(self, request_id, meta, save_path):
+        partial = save_path + PARTIAL_SUFFIX
+        hasher = hashlib.sha256()
+        try:
+            with open(partial, "wb") as f:
+                preallocate(f, meta["size"])
+                self.read_batch_entry(request_id, meta, f, hasher)
+        except (RequestError, ProtocolError):
+            remove_partial(partial)
+            raise
+        result = {"name": meta["name"], "owner": meta["owner"], "ok": False}
+        if meta.get("sha256") not in (None, hasher.hexdigest()):
+            remove_partial(partial)
+            return dict(result, message=f"Downloaded file {meta['name']} failed verification.")
+        os.replace(partial, save_path)
+        return dict(result, ok=True, path=save_path, sha256=hasher.hexdigest(), message="File sent successfully.")
+
+    def read_batch_entry(self, request_id, meta, f, hasher=None):
+        # the DATA frames of one entry into f, f None skips them
+        codec = get_codec(meta.get("codec"))
+        if meta.get("codec") and codec is None:
+            raise ProtocolError(f"Server sent unknown codec {meta['codec']}")
+        received = 0
+        while received < meta["size"]:
+            frame, _ = self.next_frame(request_id)
+            if frame.type != DATA:
+                raise RequestError(frame.message())  # the server broke off the batch
+            data = decode_block(codec, frame.payload) if codec else frame.payload
+            if f is not None:
+                f.write(data)
+            if hasher is not None:
+                hasher.update(data)
+            received += len(data)
+        if received != meta["size"]:
+            raise ProtocolError(f"Batch entry {meta['name']} overran its size")
+
+
+def is_local_name(name):
+    # a plain file name, joined to a local folder it stays inside it
+    return isinstance(name, str) and name not in ("", ".", "..") and os.path.basename(name) == name
+
+
+def matches(entry, owner=None, prefix=None, glob=None):
+    # the list filters applied here, for servers that can't filter
+    return ((owner is None or entry["owner"] == owner) and (prefix is None or entry["name"].startswith(prefix))
+            and (glob is None or fnmatch.fnmatchcase(entry["name"], glob)))
+
+
+class LegacyChannel:
+    # the original text protocol, for servers that don't offer framing
+    def __init__(self, sock, buffer_size=RECV_BUFFER_SIZE, on_notification=None, on_disconnect=None):
+        self.sock = sock
+        self.buffer_size = buffer_size
+        self.view = None
+        self.on_notification = on_notification
+        self.on_disconnect = on_disconnect
+
+    def login(self, username):
+        self.sock.send(username.encode())
+        response = self.sock.recv(1024).decode()
+        self.sock.settimeout(None)
+        if "Error" in response:
+            raise RequestError(response.replace("Error:", "", 1).strip())
+        return response
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+    def check(self, response):
+        if response.startswith("Error"):
+            raise RequestError(response.replace("Error:", "", 1).strip())
+        return response
+
+    def poll(self, timeout):
+        self.sock.settimeout(timeout)
+        try:
+            message = self.sock.recv(1024).decode()
+        except (socket.timeout, BlockingIOError):
+            return False
+        finally:
+            self.sock.settimeout(None)
+        if not message:
+            if self.on_disconnect:
+                self.on_disconnect("Connection closed by server.")
+            raise ConnectionError("Connection closed by server.")
+        if message.startswith("DISCONNECT"):
+            if self.on_disconnect:
+                self.on_disconnect("Disconnected by server because server is closed.")
+            raise ConnectionError("Server closed the connection.")
+        if self.on_notification:
+            self.on_notification(message)
+        return True
+
+    def list_files(self):
+        self.sock.send(b"list")
+        data = b""
+        while True:
+            chunk = self.sock.recv(1024)
+            data += chunk
+            if len(chunk) < 1024:
+                break
+        response = self.check(data.decode())
+        files = []
+        for line in response.splitlines():  # "name (Owner: user)" per line
+            name, sep, owner = line.rpartition(" (Owner: ")
+            if sep:
+                files.append({"name": name, "owner": owner.rstrip(")")})
+        return files
+
+    def delete_file(self, filename):
+        self.sock.send(f'delete "{filename}"'.encode())
+        return self.check(self.sock.recv(1024).decode())
+
+    def upload_file(self, filepath, filename=None, resume=False, codec=None):
+        # no resume or compression in the text protocol, always sends the whole file
+        filename = filename or os.path.basename(filepath)
+        file_size = os.path.getsize(filepath)
+        self.sock.send(f'upload "{filename}"'.encode())
+        response = self.sock.recv(1024).decode()
+        if not response.startswith("Send file size"):
+            raise RequestError(f"Unexpected response from server: {response}")
+
+        self.sock.send(str(file_size).encode())
+        with open(filepath, "rb") as f:
+            while True:
+                chunk = f.read(65536)
+                if not chunk:
+                    break
+                self.sock.sendall(chunk)
+        return self.check(self.sock.recv(1024).decode())
+
+    def download_file(self, filename, owner, save_path, resume=False, codec=None, cache=None):
+        self.sock.send(f'download "{filename}" "{owner}"'.encode())
+        response = self.sock.recv(1024).decode()
+        if not response.isdigit():
+            self.check(response)
+            raise RequestError(f"Unexpected response from server: {response}")
+
+        file_size = int(response)
+        self.sock.send(b"Ready")
+        if self.view is None:
+            self.view = memoryview(bytearray(self.buffer_size))
+        with open(save_path, "wb") as f:
+            preallocate(f, file_size)
+            recv_into_file(self.sock, f, file_size, self.view)
+        return self.check(self.sock.recv(1024).decode())
+
+
+class ChannelPool:
+    # idle data connections, new ones are opened on demand up to size
+    def __init__(self, factory, size):
+        self.factory = factory
+        self.size = size
+        self.idle = []
+        self.open_count = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while True:
+                if self.closed:
+                    raise ConnectionError("Not connected to the server.")
+                if self.idle:
+                    return self.idle.pop()
+                if self.open_count < self.size:
+                    self.open_count += 1
+                    break
+                self.cond.wait()
+        try:
+            return self.factory()
+        except BaseException:
+            with self.cond:
+                self.open_count -= 1
+                self.cond.notify()
+            raise
+
+    def release(self, channel, broken=False):
+        with self.cond:
+            if broken or self.closed:
+                channel.close()
+                self.open_count -= 1
+            else:
+                self.idle.append(channel)
+            self.cond.notify()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            idle, self.idle = self.idle, []
+            self.open_count -= len(idle)
+            self.cond.notify_all()
+        for channel in idle:
+            channel.close()
+
+
+class Session:
+    # one login: a control connection for commands and notifications plus a pool of
+    # data connections so several transfers and metadata commands can run in parallel
+    def __init__(self, host, port, username, streams=DEFAULT_STREAMS, buffer_size=RECV_BUFFER_SIZE,
+                 retries=TRANSFER_RETRIES, on_notification=None, on_disconnect=None, compression=None, cache=None):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.streams = streams
+        self.buffer_size = buffer_size
+        self.retries = retries
+        self.on_notification = on_notification
+        self.on_disconnect = on_disconnect
+        self.compression = compression  # None, "auto" or a codec name, see compression.py
+        self.cache = cache  # clientcache.LocalCache, downloads it holds are only fetched when they changed
+        self.control = None
+        self.control_lock = threading.RLock()  # the text protocol can only do one thing at a time
+        self.pool = None
+        self.framed = False
+        self.session_token = None
+        self.stored = set()  # own file names the server was seen holding, only those try a delta upload
+
+    def connect(self):
+        sock = open_socket(self.host, self.port)
+        try:
+            greeting = sock.recv(1024)
+            self.framed = advertises_framing(greeting)
+            if self.framed:
+                self.control = Channel(sock, self.buffer_size, self.on_notification, self.on_disconnect)
+                response = self.control.login({"username": self.username})
+                self.session_token = self.control.welcome.get("session")
+                self.control.start_reader()  # replies and notifications are pushed from here on
+                streams = min(self.streams, self.control.welcome.get("streams", self.streams))
+                if self.session_token and streams > 0:
+                    self.pool = ChannelPool(self.open_data_channel, streams)
+            else:
+                self.control = LegacyChannel(sock, self.buffer_size, self.on_notification, self.on_disconnect)
+                response = self.control.login(self.username)
+        except BaseException:
+            sock.close()
+            self.control = None
+            raise
+        return greeting.decode(errors="replace"), response
+
+    def open_data_channel(self):
+        sock = open_socket(self.host, self.port)
+        try:
+            sock.recv(1024)  # greeting
+            channel = Channel(sock, self.buffer_size)
+            channel.login({"username": self.username, "session": self.session_token})
+            return channel
+        except BaseException:
+            sock.close()
+            raise
+
+    @property
+    def connected(self):
+        return self.control is not None
+
+    def require_control(self):
+        if self.control is None:
+            raise ConnectionError("Not connected to the server.")
+        return self.control
+
+    @contextmanager
+    def control_channel(self):
+        # framed commands are told apart by request id and may overlap, text ones take turns
+        if self.framed:
+            yield self.require_control()
+            return
+        with self.control_lock:
+            yield self.require_control()
+
+    @contextmanager
+    def data_channel(self):
+        # transfers get their own connection, legacy servers share the control one
+        pool = self.pool
+        if pool is None:
+            with self.control_channel() as channel:
+                yield channel
+            return
+        channel = pool.acquire()
+        broken = False
+        try:
+            yield channel
+        except RequestError:
+            raise  # server said no, the connection is still in sync
+        except BaseException:
+            broken = True
+            raise
+        finally:
+            pool.release(channel, broken)
+
+    def list_files(self, **query):
+        return list(self.iter_files(**query))
+
+    def iter_files(self, **query):
+        # entries stream in batches over a data connection, memory stays bounded for any catalog size
+        if not self.framed:
+            if any(value is not None for value in query.values()):
+                raise RequestError("Filtered listings need the framed protocol.")
+            with self.control_lock:
+                yield from self.require_control().list_files()
+            return
+        with self.data_channel() as channel:
+            for entry in channel.iter_files(**query):
+                self.note_stored(entry)
+                yield entry
+
+    def list_page(self, limit, cursor=None, **query):
+        if not self.framed:
+            raise RequestError("Paginated listings need the framed protocol.")
+        with self.data_channel() as channel:
+            files, cursor = channel.list_page(limit, cursor, **query)
+        for entry in files:
+            self.note_stored(entry)
+        return files, cursor
+
+    def note_stored(self, entry):
+        if entry.get("owner") == self.username:
+            self.stored.add(entry["name"])
+
+    def delete_file(self, filename):
+        with self.control_channel() as channel:
+            response = channel.delete_file(filename)
+        self.stored.discard(filename)
+        return response
+
+    def known_stored(self, filename):
+        # seen in a listing or uploaded by this session, or a copy the local cache got from the server
+        return filename in self.stored or bool(self.cache and self.cache.lookup(self.username, filename))
+
+    def transfer_codec(self):
+        # codec both sides know, asked for per transfer. old servers offer none
+        if not self.framed or self.control is None:
+            return None
+        return choose_codec(self.control.welcome.get("codecs", []), self.compression)
+
+    def upload_file(self, filepath, filename=None):
+        response = self.send_file(filepath, filename)
+        self.stored.add(filename or os.path.basename(filepath))
+        return response
+
+    def send_file(self, filepath, filename=None):
+        welcome = self.control.welcome if self.framed and self.control else {}
+        name = filename or os.path.basename(filepath)
+        if welcome.get("delta") and os.path.getsize(filepath) >= DELTA_THRESHOLD and self.known_stored(name):
+            # a file the server already holds in some version only sends what changed
+            codec = self.transfer_codec()
+            response = self.with_retries(lambda channel: channel.upload_delta(filepath, filename, codec))
+            if response is not None:
+                return response
+        chunk_size = welcome.get("chunk_size")
+        if chunk_size and os.path.getsize(filepath) >= chunk_size:
+            return self.with_retries(lambda channel: channel.upload_deduplicated(filepath, chunk_size, filename))
+        codec = self.transfer_codec()
+        return self.with_retries(lambda channel: channel.upload_file(filepath, filename, resume=self.framed,
+                                                                     codec=codec))
+
+    def download_file(self, filename, owner, save_dir, streams=None):
+        # big files are fetched as parallel ranges when we have several data connections
+        save_path = os.path.join(save_dir, filename)
+        cache = self.cache if self.framed else None
+        if self.pool is not None and self.pool.size > 1 and streams != 1:
+            info = self.stat_file(filename, owner)
+            if info["size"] >= SEGMENT_THRESHOLD or streams:
+                cached = cache.lookup(owner, filename) if cache else None
+                if cached and cached["version"] == info["version"]:
+                    return cache.materialize(cached, owner, filename, save_path)
+                return self.download_segmented(filename, owner, save_dir, streams, info=info)
+        codec = self.transfer_codec()
+        return self.with_retries(lambda channel: channel.download_file(filename, owner, save_path,
+                                                                       resume=self.framed, codec=codec, cache=cache))
+
+    def upload_files(self, paths):
+        # one pipelined batch when the server knows batches, one upload after the other otherwise.
+        # returns one result per file, see Channel.upload_batch
+        if self.framed and self.control and self.control.welcome.get("batch"):
+            codec = self.transfer_codec()
+            results = self.with_retries(lambda channel: channel.upload_batch(paths, codec=codec))
+            self.stored.update(result["name"] for result in results if result["ok"])
+            return results
+        return [self.transfer_result(os.path.basename(path), None, self.upload_file, path) for path in paths]
+
+    def download_files(self, files, save_dir, **query):
+        # files is a list of (name, owner), None takes every file matching query (owner, prefix, glob)
+        if self.framed and self.control and self.control.welcome.get("batch"):
+            codec = self.transfer_codec()
+            return self.with_retries(lambda channel: channel.download_batch(files, save_dir, codec, self.cache,
+                                                                            **query))
+        if files is None:
+            files = [(entry["name"], entry["owner"]) for entry in self.iter_files() if matches(entry, **query)]
+        return [self.transfer_result(name, owner, self.download_file, name, owner, save_dir) for name, owner in files]
+
+    def transfer_result(self, name, owner, transfer, *args):
+        try:
+            return {"name": name, "owner": owner, "ok": True, "message": transfer(*args)}
+        except (RequestError, TransferAborted, OSError) as e:
+            if self.control is None:
+                raise
+            return {"name": name, "owner": owner, "ok": False, "message": str(e)}
+
+    def stat_file(self, filename, owner, with_hash=False):
+        # hashing can take a while on the server, keep it off the control connection
+        with self.data_channel() as channel:
+            return channel.stat_file(filename, owner, with_hash)
+
+    def download_segmented(self, filename, owner, save_dir, streams=None, verify=True, info=None):
+        # disjoint byte ranges over several connections at once, written in place with pwrite
+        if self.pool is None:
+            raise RequestError("Segmented downloads need the framed protocol.")
+        if info is None:
+            info = self.stat_file(filename, owner)  # with the sha256 when the server knows it, never hashed first
+        streams = min(streams or self.pool.size, self.pool.size)
+        save_path = os.path.join(save_dir, filename)
+        partial = save_path + PARTIAL_SUFFIX
+        errors = []
+
+        with open(partial, "wb") as f:
+            preallocate(f, info["size"])
+            f.truncate(info["size"])
+            fd = f.fileno()
+            lock = threading.Lock()
+
+            def fetch(offset, length):
+                try:
+                    self.download_segment(filename, owner, fd, lock, offset, length, info["version"])
+                except BaseException as e:
+                    errors.append(e)
+
+            workers = [threading.Thread(target=fetch, args=piece, daemon=True)
+                       for piece in split_ranges(info["size"], streams, MIN_SEGMENT_SIZE)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+
+        if errors:
+            os.remove(partial)
+            raise errors[0]
+        if verify and not info.get("sha256"):
+            # not hashed on the server yet, asked for now that the segments are in (it is remembered)
+            latest = self.stat_file(filename, owner, with_hash=True)
+            if latest["version"] != info["version"]:
+                os.remove(partial)
+                raise TransferAborted("File changed on the server during download.")
+            info = dict(info, sha256=latest.get("sha256"))
+        if verify and info.get("sha256") and hash_file(partial) != info["sha256"]:
+            os.remove(partial)
+            raise RequestError(f"Downloaded file {filename} failed verification.")
+        os.replace(partial, save_path)
+        if self.cache and info.get("sha256"):
+            self.cache.record(owner, filename, save_path, info["sha256"], info["version"])
+        return "File sent successfully."
+
+    def download_segment(self, filename, owner, fd, lock, offset, length, version):
+        writer = PositionalWriter(fd, offset, lock)
+
+        def check(meta):
+            if meta["offset"] != writer.position:
+                raise TransferAborted("File changed on the server during download.")
+
+        for attempt in range(self.retries + 1):
+            done = writer.position - offset
+            try:
+                with self.data_channel() as channel:
+                    channel.download_range(filename, owner, writer, offset + done, length - done,
+                                           version=version, on_meta=check, codec=self.transfer_codec())
+                return
+            except (ConnectionError, TimeoutError):
+                if attempt == self.retries or self.control is None:
+                    raise
+                time.sleep(min(0.25 * 2 ** attempt, 2))
+
+    def with_retries(self, transfer):
+        # a dropped data connection is replaced and the transfer resumes where it stopped
+        attempts = self.retries + 1 if self.pool else 1
+        for attempt in range(attempts):
+            try:
+                with self.data_channel() as channel:
+                    return transfer(channel)
+            except (ConnectionError, TimeoutError):
+                if attempt == attempts - 1 or self.control is None:
+                    raise
+                time.sleep(min(0.25 * 2 ** attempt, 2))
+
+    def poll(self, timeout=0.1):
+        # only the text protocol needs polling, framed sessions push notifications from their reader.
+        # gives up when a command holds the control connection
+        if self.framed:
+            return self.require_control().poll(timeout)
+        if not self.control_lock.acquire(timeout=timeout):
+            return False
+        try:
+            return self.require_control().poll(timeout)
+        finally:
+            self.control_lock.release()
+
+    def close(self):
+        if self.pool:
+            self.pool.close()
+            self.pool = None
+        control, self.control = self.control, None
+        if control:
+            control.close()
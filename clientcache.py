@@ -0,0 +1,133 @@
+import os
+import secrets
+import shutil
+import sqlite3
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # windows, links or copies only
+
+# what the client already downloaded: per owner/filename the local path, its size and mtime when it
+# was written, the sha256 and the server's version. downloads send the version and hash along and a
+# server that still holds the same content answers "not modified", the file is then put in place from
+# the local copy (reflink, hardlink or copy). a local copy that was changed or removed since is
+# noticed by its size/mtime and not used
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "file-transfer")
+INDEX_NAME = "index.sqlite3"
+FICLONE = 0x40049409  # linux ioctl, copy on write clone on btrfs/xfs
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    owner TEXT NOT NULL,
+    name TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    version INTEGER,
+    PRIMARY KEY (owner, name)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS files_by_hash ON files (sha256);
+"""
+
+
+class LocalCache:
+    # one sqlite connection per thread, downloads run on several
+    def __init__(self, directory=DEFAULT_CACHE_DIR):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, INDEX_NAME)
+        self.local = threading.local()
+        self.db().executescript(SCHEMA)
+
+    def db(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA busy_timeout=5000")  # several clients on one machine share the index
+            self.local.conn = conn
+        return conn
+
+    def lookup(self, owner, name):
+        # the entry of owner/name with a local copy that still holds that content, None otherwise
+        row = self.db().execute("SELECT * FROM files WHERE owner = ? AND name = ?", (owner, name)).fetchone()
+        if row is None:
+            return None
+        entry = dict(row)
+        if not unchanged(entry):
+            copy = self.find_copy(entry["sha256"])  # the same content saved for another name
+            if copy is None:
+                return None
+            entry["path"] = copy
+        return entry
+
+    def find_copy(self, sha256):
+        for row in self.db().execute("SELECT * FROM files WHERE sha256 = ?", (sha256,)).fetchall():
+            if unchanged(dict(row)):
+                return row["path"]
+        return None
+
+    def record(self, owner, name, path, sha256, version):
+        info = os.stat(path)
+        self.db().execute("INSERT OR REPLACE INTO files (owner, name, path, size, mtime, sha256, version) "
+                          "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                          (owner, name, os.path.abspath(path), info.st_size, info.st_mtime_ns, sha256, version))
+
+    def materialize(self, entry, owner, name, save_path):
+        # the cached content at save_path, returns how it got there
+        source = entry["path"]
+        if os.path.exists(save_path) and os.path.samefile(source, save_path):
+            how = "already in place"
+        else:
+            how = place(source, save_path)
+        self.record(owner, name, save_path, entry["sha256"], entry["version"])
+        return f"File not modified, {how} from the local cache."
+
+    def close(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            self.local.conn = None
+            conn.close()
+
+
+def unchanged(entry):
+    try:
+        info = os.stat(entry["path"])
+    except OSError:
+        return False
+    return info.st_size == entry["size"] and info.st_mtime_ns == entry["mtime"]
+
+
+def place(source, target):
+    # a reflink shares the blocks until one side is written, a hardlink is the same file (changing it
+    # changes both, the index notices by the mtime), a copy is the last resort. the target appears
+    # with one rename, a half made copy is never seen. the temp name is our own, two downloads
+    # placing the same target at once don't share it
+    temp = f"{target}.{secrets.token_hex(8)}.cache-tmp"
+    for how, make in (("cloned", clone), ("linked", os.link), ("copied", shutil.copy2)):
+        if os.path.exists(temp):
+            os.remove(temp)  # what a failed clone left behind
+        try:
+            make(source, temp)
+            break
+        except OSError:
+            if make is shutil.copy2:
+                if os.path.exists(temp):
+                    os.remove(temp)
+                raise
+    os.replace(temp, target)
+    if os.path.lexists(temp):
+        os.remove(temp)  # a rename between two links of one file does nothing, the target was in place already
+    return how
+
+
+def clone(source, target):
+    if fcntl is None:
+        raise OSError("No reflinks on this platform.")
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    shutil.copystat(source, target)
@@ -0,0 +1,334 @@
+import asyncio
+import itertools
+import json
+import multiprocessing
+import signal
+import socket
+import threading
+import time
+
+from protocol import RequestError
+
+# pre-fork mode (engine.py --workers N). every worker process runs its own ServerEngine and event loop
+# on the same port, with SO_REUSEPORT the kernel spreads new connections over them (without it they
+# accept from one inherited listening socket). the file catalog is the shared sqlite database already.
+# what used to live in one engine's dicts, logged in usernames, session tokens and uploads in progress,
+# is owned by the broker in the parent process. workers ask it over a socketpair, one json object per
+# line, and it routes download notifications to the worker holding the owner's control connection.
+# the parent also writes the log, workers send their lines up the same link
+
+WORKER_STOP_TIMEOUT = 30  # seconds a stopped worker gets to close its clients and storage
+
+
+class ClusterLink:
+    # worker side of the link to the broker, used from the worker's event loop
+    def __init__(self, sock, index):
+        self.sock = sock
+        self.index = index
+        self.engine = None
+        self.loop = None
+        self.loop_thread = None
+        self.writer = None
+        self.reader_task = None
+        self.call_ids = itertools.count(1)
+        self.pending = {}  # call id -> future waiting for the broker's reply
+        self.streams = {}  # session token -> data connections of that session in this worker
+
+    async def start(self, engine):
+        self.engine = engine
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        reader, self.writer = await asyncio.open_connection(sock=self.sock)
+        self.reader_task = asyncio.create_task(self.read_messages(reader))
+
+    async def close(self):
+        if self.writer is None:
+            return
+        try:
+            await self.writer.drain()  # the last log lines
+        except ConnectionError:
+            pass
+        self.writer.close()
+        self.writer = None
+        if self.reader_task:
+            self.reader_task.cancel()
+
+    def send(self, message):
+        if self.writer is not None and not self.writer.is_closing():
+            self.writer.write(json.dumps(message, separators=(",", ":")).encode() + b"\n")
+
+    async def call(self, op, **fields):
+        call_id = next(self.call_ids)
+        future = self.loop.create_future()
+        self.pending[call_id] = future
+        try:
+            self.send(dict(fields, op=op, id=call_id))
+            return await future
+        finally:
+            self.pending.pop(call_id, None)
+
+    async def read_messages(self, reader):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                if "reply" in message:
+                    future = self.pending.get(message["reply"])
+                    if future is not None and not future.done():
+                        future.set_result(message)
+                elif message.get("op") == "notify":
+                    asyncio.ensure_future(self.deliver(message["user"], message["message"]))
+                elif message.get("op") == "session_ended":
+                    for conn in self.streams.pop(message["token"], ()):
+                        conn.close()  # transfers die with their control connection, wherever it was
+        except (ConnectionError, ValueError) as e:
+            self.log(f"Broker link failed: {e}")
+        finally:
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Lost the connection to the broker."))
+            if self.engine.server_running:
+                self.log("Lost the connection to the broker, shutting down.")
+                self.engine.request_shutdown()
+
+    async def deliver(self, username, message):
+        if await self.engine.notify_client(username, message):
+            self.log(f"Notification sent to {username} from another worker.")
+
+    def log(self, message):
+        # any thread, the parent prints it and writes the log file
+        message = f"[worker {self.index}] {message}"
+        if self.loop is None or self.writer is None:
+            print(message, flush=True)
+        elif threading.get_ident() == self.loop_thread:
+            self.send({"op": "log", "message": message})
+        else:
+            self.loop.call_soon_threadsafe(self.send, {"op": "log", "message": message})
+
+    # the engine's shared tables
+
+    async def login(self, username, token):
+        reply = await self.call("login", user=username, token=token)
+        return reply["ok"]
+
+    def logout(self, username, token):
+        self.send({"op": "logout", "user": username, "token": token})
+
+    async def open_stream(self, token, username, max_streams):
+        # data connection of a session that may be logged in to another worker, returns the local set
+        # the connection goes into
+        reply = await self.call("stream", token=token, user=username, max=max_streams)
+        if not reply["ok"]:
+            raise RequestError(reply["message"])
+        return self.streams.setdefault(token, set())
+
+    def close_stream(self, token, conn):
+        streams = self.streams.get(token)
+        if streams is not None:
+            streams.discard(conn)
+            if not streams:
+                del self.streams[token]
+        self.send({"op": "stream_closed", "token": token})
+
+    async def claim_upload(self, owner, name):
+        reply = await self.call("claim", owner=owner, name=name)
+        return reply["ok"]
+
+    def release_upload(self, owner, name):
+        self.send({"op": "release", "owner": owner, "name": name})
+
+    def notify(self, username, message):
+        self.send({"op": "notify", "user": username, "message": message})
+
+
+class Broker:
+    # parent side: the tables every worker shares. only the broker's event loop touches them
+    def __init__(self, log=print):
+        self.log = log
+        self.links = {}  # worker index -> stream writer
+        self.users = {}  # logged in username -> worker index
+        self.sessions = {}  # session token -> [username, worker index, open data connections]
+        self.uploads = {}  # (owner, name) -> worker index
+        self.processes = []
+        self.stopping = False
+
+    def reply(self, index, message, **fields):
+        self.send(index, dict(fields, reply=message["id"]))
+
+    def send(self, index, message):
+        writer = self.links.get(index)
+        if writer is not None and not writer.is_closing():
+            writer.write(json.dumps(message, separators=(",", ":")).encode() + b"\n")
+
+    def handle(self, index, message):
+        op = message.get("op")
+        if op == "log":
+            self.log(message["message"])
+        elif op == "login":
+            ok = message["user"] not in self.users
+            if ok:
+                self.users[message["user"]] = index
+                if message.get("token"):
+                    self.sessions[message["token"]] = [message["user"], index, 0]
+            self.reply(index, message, ok=ok)
+        elif op == "logout":
+            if self.users.get(message["user"]) == index:
+                del self.users[message["user"]]
+            if message.get("token"):
+                self.end_session(message["token"])
+        elif op == "stream":
+            session = self.sessions.get(message["token"])
+            if session is None or session[0] != message["user"]:
+                self.reply(index, message, ok=False, message="Invalid session.")
+            elif session[2] >= message["max"]:
+                self.reply(index, message, ok=False, message="Too many data connections.")
+            else:
+                session[2] += 1
+                self.reply(index, message, ok=True)
+        elif op == "stream_closed":
+            session = self.sessions.get(message["token"])
+            if session is not None:
+                session[2] -= 1
+        elif op == "claim":
+            key = (message["owner"], message["name"])
+            ok = key not in self.uploads
+            if ok:
+                self.uploads[key] = index
+            self.reply(index, message, ok=ok)
+        elif op == "release":
+            self.uploads.pop((message["owner"], message["name"]), None)
+        elif op == "notify":
+            target = self.users.get(message["user"])
+            if target is not None:
+                self.send(target, message)
+
+    def end_session(self, token):
+        if self.sessions.pop(token, None) is not None:
+            for index in self.links:
+                self.send(index, {"op": "session_ended", "token": token})
+
+    def drop_worker(self, index):
+        # a worker that exited takes its clients and uploads with it
+        self.links.pop(index, None)
+        for username in [name for name, owner in self.users.items() if owner == index]:
+            del self.users[username]
+        for token in [token for token, session in self.sessions.items() if session[1] == index]:
+            self.end_session(token)
+        for key in [key for key, owner in self.uploads.items() if owner == index]:
+            del self.uploads[key]
+
+    async def serve_worker(self, index, sock):
+        reader, writer = await asyncio.open_connection(sock=sock)
+        self.links[index] = writer
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    self.handle(index, json.loads(line))
+                except (ValueError, KeyError, TypeError) as e:
+                    self.log(f"Bad message from worker {index}: {e}")
+        except ConnectionError:
+            pass
+        finally:
+            self.drop_worker(index)
+            writer.close()
+
+    def stop(self):
+        # each worker says goodbye to its own clients on sigterm. only sent once, a worker
+        # that is already shutting down would be killed by a second one once its loop is gone
+        if self.stopping:
+            return
+        self.stopping = True
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+
+    async def run(self, processes, socks):
+        self.processes = processes
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.stop)
+            except (NotImplementedError, RuntimeError):
+                pass
+        await asyncio.gather(*(self.serve_worker(index, sock) for index, sock in enumerate(socks)))
+
+
+def bind_listener(host, port, backlog):
+    # SO_REUSEPORT: the parent only holds the port, each worker binds and listens on its own socket.
+    # otherwise the parent listens and the workers share that socket. returns (socket, port, shared)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        shared = not hasattr(socket, "SO_REUSEPORT")
+        if not shared:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((host, int(port)))
+        if shared:
+            sock.listen(backlog)
+            sock.setblocking(False)
+    except Exception:
+        sock.close()
+        raise
+    return sock, sock.getsockname()[1], shared
+
+
+def run_worker(index, sock, make_engine, listener, inherited):
+    for other in inherited:
+        other.close()  # the parent's ends of the other links, they'd keep those open after a crash
+    link = ClusterLink(sock, index)
+    engine = make_engine(index, link, listener)
+    try:
+        engine.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        engine.metrics.close()
+
+
+def run_cluster(workers, host, port, backlog, make_engine, log=print):
+    # blocking, forks the workers and runs the broker until all of them exited.
+    # make_engine(index, link, listener) builds a worker's engine inside the worker process,
+    # listener is the port number to bind with SO_REUSEPORT or the shared listening socket
+    if "fork" not in multiprocessing.get_all_start_methods():
+        raise RuntimeError("Worker processes need fork(), run without --workers on this platform.")
+    context = multiprocessing.get_context("fork")
+    sock, port, shared = bind_listener(host, port, backlog)
+    processes = []
+    socks = []
+    broker = Broker(log)
+    finished = False
+    try:
+        for index in range(workers):
+            parent_end, worker_end = socket.socketpair()
+            inherited = socks + [parent_end] + ([] if shared else [sock])
+            process = context.Process(target=run_worker, name=f"worker-{index}",
+                                      args=(index, worker_end, make_engine, sock if shared else port, inherited))
+            process.start()
+            worker_end.close()
+            processes.append(process)
+            socks.append(parent_end)
+        log(f"Started {workers} worker processes on port {port}"
+            f"{' sharing one listening socket' if shared else ' with SO_REUSEPORT'}.")
+        asyncio.run(broker.run(processes, socks))
+        finished = True
+    finally:
+        broker.processes = processes
+        if not finished:
+            broker.stop()  # the broker failed, the workers are still serving
+        # a worker closes its link before it is done closing its storage, give it time to exit
+        deadline = time.monotonic() + WORKER_STOP_TIMEOUT
+        for process in processes:
+            process.join(max(0, deadline - time.monotonic()))
+        for process in processes:
+            if process.is_alive():
+                log(f"Worker {process.name} did not exit in {WORKER_STOP_TIMEOUT} seconds, terminating it.")
+                process.terminate()
+                process.join()
+            if process.exitcode:
+                log(f"Worker {process.name} exited with code {process.exitcode}.")
+        sock.close()
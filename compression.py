@@ -0,0 +1,150 @@
+import math
+import struct
+import zlib
+from collections import Counter
+
+from transfer import open_source, read_into_at, read_range
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.block as lz4_block
+except ImportError:
+    lz4_block = None
+
+# optional compression of framed transfers. a client names a codec in its upload or download
+# command, the sender cuts the data into blocks and sends each one as a DATA frame that starts with
+# a small header: raw or compressed, and the raw length. blocks that don't shrink go raw, files that
+# look compressed already (high byte entropy in a few samples) aren't compressed at all.
+# sizes and offsets in commands, META and resume always count raw bytes
+
+BLOCK_SIZE = 1024 * 1024  # raw bytes per compressed DATA frame
+MAX_BLOCK_SIZE = 16 * 1024 * 1024  # biggest raw block a receiver accepts, stops decompression bombs
+BLOCK_HEADER = struct.Struct("!BI")  # flag, raw length
+MAX_BLOCK_PAYLOAD = BLOCK_HEADER.size + MAX_BLOCK_SIZE  # a compressed block is never bigger than its raw form
+RAW = 0
+COMPRESSED = 1
+CODEC_PREFERENCE = ("zstd", "lz4", "zlib")  # fastest for a given ratio first
+ENTROPY_LIMIT = 7.2  # bits per byte, zip/jpeg/video sit near 8, text and logs around 4-5
+SAMPLE_SIZE = 4096
+SAMPLE_COUNT = 8
+MIN_SAVING = 0.05  # a block must shrink by this much to be sent compressed
+
+
+class CodecError(Exception):
+    pass
+
+
+class Codec:
+    def __init__(self, name, compress, decompress):
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress  # (data, raw length) -> bytes, never more than raw length
+
+
+def _zlib_decompress(data, size):
+    inflater = zlib.decompressobj()
+    return inflater.decompress(data, size)
+
+
+def _build_codecs():
+    codecs = {"zlib": Codec("zlib", lambda data: zlib.compress(data, 1), _zlib_decompress)}
+    if zstandard is not None:
+        codecs["zstd"] = Codec("zstd", zstandard.ZstdCompressor(level=3).compress,
+                               lambda data, size: zstandard.ZstdDecompressor().decompress(data, max_output_size=size))
+    if lz4_block is not None:
+        codecs["lz4"] = Codec("lz4", lambda data: lz4_block.compress(data, store_size=False),
+                              lambda data, size: lz4_block.decompress(data, uncompressed_size=size))
+    return codecs
+
+
+CODECS = _build_codecs()
+
+
+def available_codecs():
+    return [name for name in CODEC_PREFERENCE if name in CODECS]
+
+
+def get_codec(name):
+    return CODECS.get(name) if isinstance(name, str) else None
+
+
+def choose_codec(offered, wanted="auto"):
+    # the codec to ask the other side for, None when there is nothing both sides know
+    if not wanted or wanted == "off":
+        return None
+    if wanted == "auto":
+        return next((name for name in available_codecs() if name in offered), None)
+    return wanted if wanted in offered and wanted in CODECS else None
+
+
+def entropy(data):
+    # shannon entropy in bits per byte
+    if not data:
+        return 0.0
+    total = len(data)
+    return -sum(count / total * math.log2(count / total) for count in Counter(data).values())
+
+
+def read_samples(pieces, length, count=SAMPLE_COUNT, size=SAMPLE_SIZE):
+    # a few slices spread over (source, offset, count) pieces that add up to length
+    if length <= count * size:
+        positions = [0]
+        size = length
+    else:
+        step = (length - size) // (count - 1)
+        positions = [index * step for index in range(count)]
+    samples = bytearray()
+    start = 0
+    for source, offset, piece_length in pieces:
+        wanted = [p for p in positions if start <= p < start + piece_length]
+        if wanted:
+            with open_source(source) as f:
+                for position in wanted:
+                    sample = bytearray(min(size, start + piece_length - position))
+                    samples += sample[:read_into_at(f, memoryview(sample), offset + position - start)]
+        start += piece_length
+    return bytes(samples)
+
+
+def looks_compressible(pieces, length):
+    # blocking, a few small reads
+    if length <= 0:
+        return False
+    return entropy(read_samples(pieces, length)) < ENTROPY_LIMIT
+
+
+def encode_block(codec, data):
+    # the DATA payload for one block, compressed only when that saves something
+    packed = codec.compress(bytes(data))
+    if len(packed) <= len(data) * (1 - MIN_SAVING):
+        return BLOCK_HEADER.pack(COMPRESSED, len(data)) + packed
+    return BLOCK_HEADER.pack(RAW, len(data)) + bytes(data)
+
+
+def decode_block(codec, payload):
+    if len(payload) < BLOCK_HEADER.size:
+        raise CodecError("Compressed block is too short.")
+    flag, size = BLOCK_HEADER.unpack_from(payload)
+    body = memoryview(payload)[BLOCK_HEADER.size:]
+    if size > MAX_BLOCK_SIZE:
+        raise CodecError(f"Compressed block of {size} bytes is too large.")
+    if flag == RAW:
+        data = body
+    elif flag == COMPRESSED:
+        try:
+            data = codec.decompress(bytes(body), size)
+        except Exception as e:
+            raise CodecError(f"Corrupt {codec.name} block: {e}")
+    else:
+        raise CodecError(f"Unknown block flag {flag}.")
+    if len(data) != size:
+        raise CodecError(f"Block decoded to {len(data)} bytes instead of {size}.")
+    return data
+
+
+def read_block(source, offset, size, codec):
+    # blocking: one block of a stored file, ready to go out as a DATA payload
+    return encode_block(codec, read_range(source, offset, size))
@@ -0,0 +1,143 @@
+import hashlib
+import math
+import mmap
+import os
+import struct
+import zlib
+
+from transfer import HASH_READ_SIZE, open_source, read_into_at
+
+# rsync style delta uploads. the server cuts its stored copy into blocks and sends a signature per
+# block, a weak checksum (adler32, it can be rolled one byte at a time) and a strong hash. the client
+# slides a window over the new file and looks for blocks the server already has at any offset, then
+# sends copy instructions for those and the bytes in between. the server writes the new version next
+# to the old one and commits it like any upload, only a few KB go over the wire for a small edit
+
+MIN_BLOCK = 2 * 1024
+MAX_BLOCK = 128 * 1024
+SIGNATURE = struct.Struct("!I16s")  # adler32, 16 byte blake2b
+ADLER_MOD = 65521
+MAX_LITERAL = 0.5  # part of the new file that may be new data, beyond that a plain upload is cheaper
+
+
+def block_size(size):
+    # about sqrt(size) like rsync, a signature list of a few MB for the biggest files
+    return max(MIN_BLOCK, min(MAX_BLOCK, math.isqrt(size) // 1024 * 1024))
+
+
+def strong_hash(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def signatures(pieces, size, block):
+    # blocking: packed SIGNATURE records for every block of the (source, offset, count) pieces,
+    # the last block may be short
+    records = bytearray()
+    buffer = bytearray(max(block, HASH_READ_SIZE // block * block))
+    view = memoryview(buffer)
+    filled = 0
+    for source, offset, count in pieces:
+        with open_source(source) as f:
+            position, remaining = offset, count
+            while remaining:
+                n = read_into_at(f, view[filled:filled + min(len(buffer) - filled, remaining)], position)
+                if not n:
+                    raise OSError("File ended early.")
+                filled += n
+                position += n
+                remaining -= n
+                if filled == len(buffer):
+                    add_signatures(records, view, filled, block)
+                    filled = 0
+    add_signatures(records, view, filled, block)
+    if len(records) != math.ceil(size / block) * SIGNATURE.size:
+        raise OSError("File changed while its signatures were computed.")
+    return bytes(records)
+
+
+def add_signatures(records, view, length, block):
+    for start in range(0, length, block):
+        data = view[start:min(start + block, length)]
+        records += SIGNATURE.pack(zlib.adler32(data), strong_hash(data))
+
+
+def parse_signatures(data):
+    # weak checksum -> {strong hash: block index}, the first block wins when blocks repeat
+    table = {}
+    for index, (weak, strong) in enumerate(SIGNATURE.iter_unpack(data)):
+        table.setdefault(weak, {}).setdefault(strong, index)
+    return table
+
+
+def compute_delta(path, block, base_size, table, max_literal=None, whole=None):
+    # blocking: the instructions turning the server's copy into path, [("copy", first block, count)
+    # or ("data", offset, length)] in file order, data ranges refer to path. None when more than
+    # max_literal bytes would have to be sent, rolling over new data is slow in python.
+    # whole is an optional hash object that gets the entire file
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            if whole is not None:
+                whole.update(m)
+            return scan(m, size, block, base_size, table, max_literal)
+
+
+def scan(m, size, block, base_size, table, max_literal):
+    ops = []
+    literal = 0  # bytes of data ops so far
+    start = 0  # where the pending data range begins
+    i = 0
+    weak = None
+    while i + block <= size:
+        if weak is None:  # aligned probe, adler32 runs in C
+            weak = zlib.adler32(m[i:i + block])
+            a, b = weak & 0xffff, weak >> 16
+        candidates = table.get(weak)
+        if candidates is not None:
+            index = candidates.get(strong_hash(m[i:i + block]))
+            if index is not None and (index + 1) * block <= base_size:
+                literal += add_data(ops, start, i)
+                add_copy(ops, index)
+                i += block
+                start = i
+                weak = None
+                continue
+        if i + block == size:
+            break
+        if max_literal is not None and literal + i + 1 - start > max_literal:
+            return None
+        # roll the window one byte: drop m[i], take m[i + block]
+        out, new = m[i], m[i + block]
+        a = (a - out + new) % ADLER_MOD
+        b = (b - block * out + a - 1) % ADLER_MOD
+        weak = (b << 16) | a
+        i += 1
+    # the server's last block is shorter than the others, it can only match at the very end
+    tail = base_size % block
+    if tail and size - start >= tail:
+        index = base_size // block
+        data = m[size - tail:size]
+        if table.get(zlib.adler32(data), {}).get(strong_hash(data)) == index:
+            literal += add_data(ops, start, size - tail)
+            add_copy(ops, index)
+            start = size
+    literal += add_data(ops, start, size)
+    if max_literal is not None and literal > max_literal:
+        return None
+    return ops
+
+
+def add_data(ops, start, end):
+    if end > start:
+        ops.append(("data", start, end - start))
+    return end - start
+
+
+def add_copy(ops, index):
+    if ops and ops[-1][0] == "copy" and ops[-1][1] + ops[-1][2] == index:
+        ops[-1] = ("copy", ops[-1][1], ops[-1][2] + 1)  # runs of blocks in order go as one instruction
+    else:
+        ops.append(("copy", index, 1))
+
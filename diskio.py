@@ -0,0 +1,193 @@
+import asyncio
+import functools
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# blocking file system calls (open, write, stat, remove, rename, reads for hashing) run on a small
+# pool of disk threads of their own, so a slow volume never stalls the event loop and can't take
+# the threads compression and hashing run on either. uploads write through a WriteBehind buffer:
+# the loop hands the received bytes over and goes back to the socket, the disk threads write them
+# (and hash them, in order, when the upload wants its sha256).
+# when a transfer has WRITE_BEHIND bytes waiting (or all of them together DISK_BUFFER) it stops
+# reading its socket until the disk caught up, tcp flow control then slows the client down
+
+DISK_THREADS = 4
+DISK_BUFFER = 256 * 1024 * 1024  # received bytes all transfers together may have waiting for the disk
+WRITE_BEHIND = 8 * 1024 * 1024  # the same for one transfer
+WRITE_BATCH = 64  # buffers written with one pwritev
+FLUSH_SIZE = 1024 * 1024  # smaller writes are collected first, a small upload is written by close() in one go
+
+
+class DiskPool:
+    # only used from the event loop thread, the work itself runs on the pool's threads
+    def __init__(self, threads=DISK_THREADS, max_buffered=DISK_BUFFER):
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix="disk")
+        self.threads = threads
+        self.max_buffered = max_buffered
+        self.queued = 0  # calls submitted and not finished, running ones included
+        self.buffered = 0  # bytes in write-behind buffers
+        self.calls = 0
+        self.stalled = 0.0  # seconds transfers stopped reading because the disk fell behind
+
+    async def run(self, function, *args, **kwargs):
+        if kwargs:
+            function = functools.partial(function, **kwargs)
+        self.queued += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+        finally:
+            self.queued -= 1
+            self.calls += 1
+
+    async def open(self, path, mode="rb"):
+        return await self.run(open, path, mode)
+
+    def writer(self, f, limit=WRITE_BEHIND, hasher=None):
+        return WriteBehind(self, f, min(limit, self.max_buffered), hasher)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+class WriteBehind:
+    # file-like write() for an upload, like asyncio's StreamWriter: write() only queues a copy of the
+    # data, await drain() after it waits while too much is queued. writes go to their position with
+    # pwrite, the file offset isn't used. close() writes the rest, truncates at the end and closes f.
+    # hasher (a hashlib object) gets every byte written, on the disk threads: only one write runs
+    # at a time and buffers go out in order, so it is only read after close()
+    def __init__(self, pool, f, limit, hasher=None):
+        self.pool = pool
+        self.f = f
+        self.limit = limit
+        self.hasher = hasher
+        self.position = f.tell()
+        self.pending = deque()  # (position, bytes)
+        self.size = 0
+        self.flusher = None
+        self.progress = asyncio.Event()
+        self.error = None
+
+    def write(self, data):
+        if self.error is not None:
+            raise self.error
+        data = bytes(data)  # the caller reuses its buffer
+        self.pending.append((self.position, data))
+        self.position += len(data)
+        self.size += len(data)
+        self.pool.buffered += len(data)
+        if self.size >= FLUSH_SIZE:
+            self.start_flusher()
+        return len(data)
+
+    def start_flusher(self):
+        if self.flusher is None and self.pending:
+            self.flusher = asyncio.ensure_future(self.flush_pending())
+
+    async def drain(self):
+        loop = asyncio.get_running_loop()
+        start = None
+        while self.size and (self.size > self.limit or self.pool.buffered > self.pool.max_buffered):
+            if self.error is not None:
+                break
+            start = start or loop.time()
+            self.start_flusher()
+            self.progress.clear()
+            await self.progress.wait()
+        if start is not None:
+            self.pool.stalled += loop.time() - start
+        if self.error is not None:
+            raise self.error
+
+    async def flush_pending(self):
+        try:
+            while self.pending:
+                position, data = self.pending.popleft()
+                buffers = [data]
+                end = position + len(data)
+                while self.pending and self.pending[0][0] == end and len(buffers) < WRITE_BATCH:
+                    buffers.append(self.pending.popleft()[1])
+                    end += len(buffers[-1])
+                try:
+                    await self.pool.run(write_at, self.f.fileno(), buffers, position, self.hasher)
+                finally:
+                    written = end - position
+                    self.size -= written
+                    self.pool.buffered -= written
+                    self.progress.set()
+        except OSError as e:
+            self.error = e
+            self.position = position  # the file is only good up to the failed write
+            self.pool.buffered -= self.size  # nothing more gets written
+            self.size = 0
+            self.pending.clear()
+        finally:
+            self.flusher = None
+            self.progress.set()
+
+    async def flush(self):
+        self.start_flusher()
+        await self.wait_flusher()
+        if self.error is not None:
+            raise self.error
+
+    async def wait_flusher(self):
+        while self.flusher is not None:
+            await asyncio.shield(self.flusher)
+
+    def tell(self):
+        return self.position
+
+    def seek(self, position):
+        # only before the first write, resumed uploads start behind what's there
+        self.position = position
+
+    def fileno(self):
+        return self.f.fileno()
+
+    async def close(self):
+        # also after a failed transfer, what did arrive stays for a resume. what is still pending
+        # is written with the truncate and close, one trip to the disk threads
+        try:
+            await self.wait_flusher()
+        finally:
+            position = self.pending[0][0] if self.pending else self.position
+            buffers = [data for _, data in self.pending]
+            self.pending.clear()
+            try:
+                await self.pool.run(close_at, self.f, buffers, position, self.position, self.hasher)
+            finally:
+                self.pool.buffered -= self.size
+                self.size = 0
+
+
+def close_at(f, buffers, position, size, hasher=None):
+    # blocking: writes the last buffers at position, cuts f at size (leftovers of a preallocation or
+    # an older partial) and closes it
+    try:
+        write_at(f.fileno(), buffers, position, hasher)
+        f.truncate(size)
+    finally:
+        f.close()
+
+
+def write_at(fd, buffers, position, hasher=None):
+    # blocking: every byte of buffers at position
+    if hasher is not None:
+        for data in buffers:
+            hasher.update(data)
+    if not hasattr(os, "pwritev"):
+        os.lseek(fd, position, os.SEEK_SET)  # one flusher per file, nobody else moves the offset
+        for data in buffers:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+        return
+    while buffers:
+        n = os.pwritev(fd, buffers, position)
+        position += n
+        while buffers and n >= len(buffers[0]):
+            n -= len(buffers[0])
+            buffers = buffers[1:]
+        if buffers and n:
+            buffers = [memoryview(buffers[0])[n:]] + buffers[1:]
@@ -0,0 +1,1148 @@
+import argparse
+import asyncio
+import hashlib
+import os
+import secrets
+import shlex
+import signal
+import socket
+import stat
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import quote, unquote
+
+from cas import ChunkStore
+from compression import BLOCK_SIZE, available_codecs, encode_block, read_block
+from catalog import LIST_BATCH, Catalog
+from cluster import run_cluster
+from diskio import DISK_BUFFER, DISK_THREADS, DiskPool
+from filecache import CACHE_MAX_FILE, CACHE_SIZE, FileCache, read_pieces
+from layout import FLAT, LAYOUT_SETTING, SHARDED, has_flat_files, make_layout, temp_path
+from logsink import FileLog
+from metrics import Counter, Metrics
+from protocol import (DATA, DISCONNECT, ERROR, FRAMED_MARKER, GREETING, HEADER_SIZE, HELLO, NOTIFICATION,
+                      VERSION, WELCOME, Frame, ProtocolError, RequestError, encode_frame, looks_like_hello,
+                      pack_header, unpack_header)
+from session import FramedSession
+from throttle import QUANTUM, Throttle
+from transfer import (RECV_BUFFER_SIZE, BufferPool, check_buffer_size, hash_pieces,
+                      open_source, open_upload, parse_size, read_range, remove_if_exists, remove_partial, resume_offset)
+
+
+SENDFILE_WINDOW = 64 * 1024 * 1024  # bytes per DATA frame when serving a download
+FALLBACK_WINDOW = 4 * 1024 * 1024  # read size when the file can't be sent with sendfile
+PREFETCH_MIN = 1024 * 1024  # smaller sendfile ranges are read by the loop itself
+MAX_STREAMS = 8  # data connections a client may open next to its control connection
+
+
+def storage_key(filename, owner):
+    # "{owner}_{filename}" on disk. "%", "/" and "_" in the owner are escaped so the first "_"
+    # always separates owner and file name and a username can't leave the storage folder
+    return f"{quote(owner, safe='').replace('_', '%5F')}_{filename}"
+
+
+def parse_storage_key(key):
+    owner, sep, filename = key.partition("_")
+    if not sep or not owner or not filename:
+        return None
+    return unquote(owner), filename
+
+
+def is_regular_file(f):
+    try:
+        return stat.S_ISREG(os.fstat(f.fileno()).st_mode)
+    except (AttributeError, OSError, ValueError):
+        return False
+
+
+class Connection:
+    # thin wrapper around a non blocking socket, every call goes through the event loop selector
+    def __init__(self, loop, sock, addr, metrics=None):
+        self.loop = loop
+        self.sock = sock
+        self.addr = addr
+        self.metrics = metrics or Metrics()
+        self.bytes_received = 0  # socket traffic of this connection, per command deltas go to the trace log
+        self.bytes_sent = 0
+        self.replied_error = False  # last text protocol reply started with "Error"
+        self.write_lock = asyncio.Lock()  # notifications can be sent from other client tasks
+        self.buffer = bytearray()  # bytes read ahead of the current message
+        self.framed = False
+        self.session_token = None  # framed control connections, lets the client attach data connections
+        self.data_conns = set()
+        self.throttle = None  # throttle.Lane once logged in, None while no bandwidth limit applies
+        self.disk = None  # the engine's diskio.DiskPool
+        self.closed = False
+
+    async def recv(self, size=1024):
+        if self.buffer:
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+            return data
+        data = await self.loop.sock_recv(self.sock, size)
+        self.count_received(len(data))
+        return data
+
+    def count_received(self, count):
+        self.bytes_received += count
+        self.metrics.bytes_received.inc(amount=count)
+
+    def count_sent(self, count):
+        self.bytes_sent += count
+        self.metrics.bytes_sent.inc(amount=count)
+
+    def unread(self, data):
+        self.buffer[:0] = data
+
+    async def recv_exact(self, size):
+        while len(self.buffer) < size:
+            chunk = await self.loop.sock_recv(self.sock, max(65536, size - len(self.buffer)))
+            if not chunk:
+                raise ConnectionError("Connection closed by client.")
+            self.count_received(len(chunk))
+            self.buffer += chunk
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    async def recv_into_file(self, f, count, view):
+        # refills the same buffer with recv_into, no bytes object per read. a write-behind f
+        # (diskio.py) makes us stop reading while the disk is behind
+        drain = getattr(f, "drain", None)
+        remaining = count
+        if self.buffer:
+            take = min(len(self.buffer), remaining)
+            f.write(self.buffer[:take])
+            del self.buffer[:take]
+            remaining -= take
+        size = len(view) if self.throttle is None else min(len(view), QUANTUM)
+        while remaining:
+            if drain is not None:
+                await drain()
+            n = await self.loop.sock_recv_into(self.sock, view[:min(size, remaining)])
+            if not n:
+                raise ConnectionError("Connection interrupted during file upload.")
+            self.count_received(n)
+            f.write(view[:n])
+            remaining -= n
+            await self.pace(n)
+        return count
+
+    async def pace(self, count):
+        # waits for the bandwidth limits, file data only
+        if self.throttle is not None:
+            await self.throttle.take(count)
+
+    async def read_header(self):
+        return unpack_header(await self.recv_exact(HEADER_SIZE))
+
+    async def read_frame(self):
+        frame_type, request_id, length = await self.read_header()
+        return Frame(frame_type, request_id, await self.recv_exact(length))
+
+    async def send(self, data):
+        async with self.write_lock:
+            await self.loop.sock_sendall(self.sock, data)
+        self.count_sent(len(data))
+        self.replied_error = data.startswith(b"Error")  # how the text protocol marks a failed command
+
+    async def send_frame(self, frame_type, request_id, payload=None):
+        await self.send(encode_frame(frame_type, request_id, payload))
+
+    async def send_file_range(self, f, offset, count):
+        # regular files go through kernel zero copy (os.sendfile), sock_sendall retries partial writes
+        if self.throttle is None:
+            await self.prefetch(f, offset, min(count, SENDFILE_WINDOW))
+            async with self.write_lock:
+                await self._send_file_range(f, offset, count)
+            return
+        end = offset + count
+        while offset < end:
+            size = min(QUANTUM, end - offset)
+            await self.pace(size)
+            async with self.write_lock:
+                await self._send_file_range(f, offset, size)
+            offset += size
+
+    async def send_data_file(self, request_id, f, offset, count, window=SENDFILE_WINDOW):
+        # one DATA frame per window so notifications can still get in between two frames,
+        # throttled transfers send smaller frames and wait for tokens before each one
+        if self.throttle is not None:
+            window = min(window, QUANTUM)
+        end = offset + count
+        while offset < end:
+            size = min(window, end - offset)
+            await self.pace(size)
+            await self.prefetch(f, offset, size)
+            async with self.write_lock:
+                await self.loop.sock_sendall(self.sock, pack_header(DATA, request_id, size))
+                self.count_sent(HEADER_SIZE)
+                await self._send_file_range(f, offset, size)
+            offset += size
+
+    async def prefetch(self, f, offset, count):
+        # sendfile runs on the event loop and reads the disk when the data isn't cached, a disk
+        # thread starts reading it in first so the loop finds it in memory. small reads aren't worth the trip
+        if count < PREFETCH_MIN or self.disk is None or not hasattr(os, "posix_fadvise") or not is_regular_file(f):
+            return
+        try:
+            await self.disk.run(os.posix_fadvise, f.fileno(), offset, count, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass
+
+    async def _send_file_range(self, f, offset, count):
+        if count <= 0:
+            return
+        if isinstance(f, memoryview):  # cached in memory, see filecache.py
+            await self.loop.sock_sendall(self.sock, f[offset:offset + count])
+            self.count_sent(count)
+            return
+        if is_regular_file(f):
+            sent = await self.loop.sock_sendfile(self.sock, f, offset, count, fallback=False)
+            self.count_sent(sent)
+            if sent != count:
+                raise ConnectionError(f"File changed during transfer ({sent} of {count} bytes sent).")
+            return
+        # pipes, devices, etc. can't be sendfile'd, copy through one large reusable window
+        f.seek(offset)
+        buffer = bytearray(min(FALLBACK_WINDOW, count))
+        view = memoryview(buffer)
+        remaining = count
+        while remaining:
+            if self.disk is not None:
+                read = await self.disk.run(f.readinto, view[:min(len(buffer), remaining)])
+            else:
+                read = f.readinto(view[:min(len(buffer), remaining)])
+            if not read:
+                raise ConnectionError(f"File ended early ({count - remaining} of {count} bytes sent).")
+            await self.loop.sock_sendall(self.sock, view[:read])
+            self.count_sent(read)
+            remaining -= read
+
+    async def send_pieces(self, pieces, request_id=None, window=SENDFILE_WINDOW):
+        # file ranges one after the other, DATA frames for framed downloads and raw bytes for legacy ones
+        for source, offset, count in pieces:
+            with open_source(source) as f:
+                if request_id is None:
+                    await self.send_file_range(f, offset, count)
+                else:
+                    await self.send_data_file(request_id, f, offset, count, window)
+
+    async def send_blocks(self, request_id, pieces, codec, block_size=BLOCK_SIZE):
+        # compressed download, one DATA frame per block. the next block is read and encoded on an
+        # executor thread while the current one is being sent
+        blocks = [(source, start, min(block_size, offset + count - start))
+                  for source, offset, count in pieces for start in range(offset, offset + count, block_size)]
+        pending = None
+        try:
+            for index, block in enumerate(blocks):
+                if pending is None:
+                    pending = asyncio.ensure_future(self.load_block(*block, codec))
+                payload = await pending
+                pending = None
+                if index + 1 < len(blocks):
+                    pending = asyncio.ensure_future(self.load_block(*blocks[index + 1], codec))
+                await self.pace(len(payload))
+                await self.send_frame(DATA, request_id, payload)
+        finally:
+            if pending is not None:
+                pending.cancel()
+
+    async def load_block(self, source, offset, size, codec):
+        # read on a disk thread, compressed on the default executor
+        if self.disk is None:
+            return await self.loop.run_in_executor(None, read_block, source, offset, size, codec)
+        data = await self.disk.run(read_range, source, offset, size)
+        return await self.loop.run_in_executor(None, encode_block, codec, data)
+
+    async def notify(self, message):
+        if self.framed:
+            await self.send_frame(NOTIFICATION, 0, {"message": message})
+        else:
+            await self.send(message.encode())
+
+    async def disconnect(self):
+        if self.framed:
+            await self.send_frame(DISCONNECT, 0)
+        else:
+            await self.send(b"DISCONNECT")
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+
+
+class StoredFile:
+    # a consistent snapshot of a stored file for one transfer: an open plain file (an upload replacing
+    # it swaps the directory entry, not this inode) or a dedup manifest whose chunks are pinned.
+    # use it as a context manager, close() lets go of both
+    def __init__(self, size, version, sha256=None, f=None, manifest=None, chunks=None, data=None, cache_key=None,
+                 disk=None):
+        self.size = size
+        self.version = version
+        self.known_sha256 = sha256 or (manifest or {}).get("sha256")
+        self.f = f
+        self.manifest = manifest
+        self.chunks = chunks
+        self.data = data  # memoryview of the whole file when it came from the file cache
+        self.cache_key = cache_key  # set when the cache wants this file, see ServerEngine.cache_file
+        self.disk = disk  # diskio.DiskPool close() runs on
+
+    def pieces(self, offset, length):
+        if self.data is not None:
+            return [(self.data, offset, length)] if length else []
+        if self.manifest is None:
+            return [(self.f, offset, length)] if length else []
+        return list(self.chunks.pieces(self.manifest, offset, length))
+
+    def release(self):
+        # blocking, the file is closed and the chunks unpinned (which may delete some)
+        self.data = None
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+        if self.manifest is not None and self.chunks is not None:
+            self.chunks.unpin(self.manifest)
+            self.chunks = None
+
+    async def close(self):
+        if self.f is None and self.chunks is None:
+            self.data = None  # served from the memory cache, nothing to let go of
+        elif self.disk is None:
+            self.release()
+        else:
+            await self.disk.run(self.release)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def sha256(self):
+        # blocking, run it in an executor
+        return self.known_sha256 or hash_pieces(self.pieces(0, self.size))
+
+
+class ServerEngine:
+    def __init__(self, storage_dir, port, host="0.0.0.0", log=None, backlog=1024,
+                 recv_buffer_size=RECV_BUFFER_SIZE, max_streams=MAX_STREAMS, dedup=False, metrics=None,
+                 metrics_port=None, metrics_host="127.0.0.1", cluster=None, reuse_port=False,
+                 cache_size=CACHE_SIZE, cache_max_file=CACHE_MAX_FILE, rate_limit=None, user_rate_limit=None,
+                 conn_rate_limit=None, disk_threads=DISK_THREADS, disk_buffer=DISK_BUFFER, data_dirs=None):
+        self.storage_dir = storage_dir
+        self.data_dirs = data_dirs or [storage_dir]  # where plain files are stored, one per disk
+        self.layout = None  # layout.Layout of the storage folder, known once the catalog is open
+        self.port = port
+        self.host = host
+        self.backlog = backlog
+        self.buffers = BufferPool(check_buffer_size(recv_buffer_size))  # shared by uploads in progress
+        self.log = log or print
+        self.max_streams = max_streams
+        self.clients = {}
+        # clients, sessions and uploads are only touched by the event loop thread, which makes the loop
+        # their single writer. executor threads go through the catalog and the chunk store, both locked
+        self.sessions = {}  # session token -> control connection
+        self.uploads = set()  # (owner, name) of framed uploads in progress
+        self.catalog = Catalog(storage_dir)  # owner, size, version and hash of every stored file
+        self.dedup = dedup
+        self.chunks = ChunkStore(storage_dir, self.catalog)  # content addressed storage, see cas.py
+        self.cache = FileCache(cache_size, cache_max_file) if cache_size > 0 else None  # hot small files
+        self.throttle = Throttle(rate_limit, user_rate_limit, conn_rate_limit)  # bytes per second, None is unlimited
+        self.disk = DiskPool(disk_threads, disk_buffer)  # blocking file system calls, see diskio.py
+        self.metrics = metrics or Metrics()  # always counted, only served when metrics_port is set
+        self.metrics.watch("ft_clients", "Logged in clients.", lambda: len(self.clients))
+        self.metrics.watch("ft_uploads_active", "Framed uploads in progress.", lambda: len(self.uploads))
+        self.metrics.watch("ft_disk_queue_depth", "Disk calls waiting for or running on a disk thread.",
+                           lambda: self.disk.queued)
+        self.metrics.watch("ft_disk_buffered_bytes", "Received bytes waiting to be written to disk.",
+                           lambda: self.disk.buffered)
+        self.metrics.watch("ft_disk_calls_total", "Calls run on the disk threads.", lambda: self.disk.calls,
+                           kind=Counter)
+        self.metrics.watch("ft_disk_stall_seconds_total", "Time uploads stopped reading because the disk fell behind.",
+                           lambda: self.disk.stalled, kind=Counter)
+        if self.throttle.enabled():
+            self.metrics.watch("ft_throttle_wait_seconds_total", "Time transfers waited for the bandwidth limits.",
+                               lambda: self.throttle.waited, kind=Counter)
+        if self.cache is not None:
+            self.metrics.watch("ft_cache_bytes", "File data held in the memory cache.", lambda: self.cache.size)
+            self.metrics.watch("ft_cache_entries", "Files held in the memory cache.", lambda: len(self.cache.entries))
+            self.metrics.watch("ft_cache_hits_total", "Downloads served from the memory cache.",
+                               lambda: self.cache.hits, kind=Counter)
+            self.metrics.watch("ft_cache_misses_total", "Cacheable downloads that went to disk.",
+                               lambda: self.cache.misses, kind=Counter)
+            self.metrics.watch("ft_cache_evictions_total", "Files pushed out of the memory cache.",
+                               lambda: self.cache.evictions, kind=Counter)
+        self.metrics_port = metrics_port
+        self.metrics_host = metrics_host
+        self.metrics_socket = None
+        self.metrics_server = None
+        self.cluster = cluster  # cluster.ClusterLink of a worker process, shares the tables above with the others
+        self.reuse_port = reuse_port
+        self.loop = None
+        self.server_socket = None
+        self.server_running = False
+        self.accept_task = None
+        self.shutdown_task = None
+        self.client_tasks = set()
+
+    def log_message(self, message):
+        try:
+            self.log(message)
+        except Exception:
+            pass  # a broken log sink must never take the server down
+
+    def bind(self):
+        # binding in the caller so gui and cli can report port errors right away
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.reuse_port:
+                self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)  # worker processes
+            self.server_socket.bind((self.host, int(self.port)))
+            self.server_socket.listen(self.backlog)
+            self.server_socket.setblocking(False)
+            if self.metrics_port is not None:
+                self.metrics_socket = socket.create_server((self.metrics_host, int(self.metrics_port)))
+        except Exception:
+            self.server_socket.close()
+            self.server_socket = None
+            raise
+
+    def run(self):
+        # blocking entry point, used by the cli and by the gui background thread
+        try:
+            asyncio.run(self.serve())
+        finally:
+            self.disk.close()
+
+    async def serve(self):
+        if self.server_socket is None:
+            self.bind()
+        self.loop = asyncio.get_running_loop()
+        if self.cluster is not None:
+            await self.cluster.start(self)
+        self.prepare_storage()
+        self.server_running = True
+        self.log_message(f"Server started on port {self.port}")
+        if self.metrics_socket is not None:
+            self.metrics_server = await asyncio.start_server(self.metrics.handle_http, sock=self.metrics_socket)
+            host, port = self.metrics_socket.getsockname()[:2]
+            self.log_message(f"Metrics on http://{host}:{port}/metrics")
+        self.accept_task = asyncio.create_task(self.accept_clients())
+        if threading.current_thread() is threading.main_thread():
+            # running headless, ctrl-c / sigterm should still say goodbye to clients
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                try:
+                    self.loop.add_signal_handler(sig, self.request_shutdown)
+                except (NotImplementedError, RuntimeError):
+                    pass
+        try:
+            await self.accept_task
+        except asyncio.CancelledError:
+            pass
+        finally:
+            if self.shutdown_task:
+                await self.shutdown_task
+            else:
+                await self.close_clients()
+            if self.cluster is not None:
+                await self.cluster.close()
+
+    def stop(self):
+        # thread safe, called from the gui thread. not waiting here on purpose,
+        # the shutdown logs go back through the gui thread
+        if self.loop is not None and self.server_running:
+            self.loop.call_soon_threadsafe(self.request_shutdown)
+
+    def request_shutdown(self):
+        if self.shutdown_task is None:
+            self.shutdown_task = asyncio.ensure_future(self.shutdown())
+
+    async def shutdown(self):
+        self.log_message("Shutting down server...")
+        self.server_running = False
+        if self.accept_task:
+            self.accept_task.cancel()
+        if self.server_socket:
+            self.server_socket.close()
+            self.server_socket = None
+            self.log_message("Server socket closed.")
+        if self.metrics_server:
+            self.metrics_server.close()
+            self.metrics_server = None
+        await self.close_clients()
+        if self.cache is not None:
+            stats = self.cache.stats()
+            self.log_message(f"File cache: {stats['hits']} hits, {stats['misses']} misses, "
+                             f"{stats['evictions']} evictions.")
+        self.log_message("Server closed successfully.")
+
+    async def close_clients(self):
+        # close all client connections and inform them about disconnection
+        clients = list(self.clients.items())
+        self.clients.clear()
+        for client_name, conn in clients:
+            try:
+                await asyncio.wait_for(conn.disconnect(), 1)
+                self.log_message(f"Disconnected client {client_name}")
+            except Exception as e:
+                self.log_message(f"Error disconnecting client {client_name}: {e}")
+            conn.close()
+        for task in list(self.client_tasks):
+            task.cancel()
+
+    async def accept_clients(self):
+        while self.server_running:
+            try:
+                sock, addr = await self.loop.sock_accept(self.server_socket)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if self.server_running:
+                    self.metrics.error("accept")
+                    self.log_message(f"Error accepting clients: {e}")
+                    await asyncio.sleep(0.1)  # fd exhaustion etc, dont spin
+                    continue
+                break
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = Connection(self.loop, sock, addr, self.metrics)
+            conn.disk = self.disk
+            task = asyncio.create_task(self.handle_client(conn, addr))  # one coroutine per client instead of one thread
+            self.client_tasks.add(task)
+            task.add_done_callback(self.client_tasks.discard)
+
+    async def handle_client(self, conn, addr):  # getting request from clients
+        username = None
+        self.metrics.connections.inc()
+        self.metrics.connections_total.inc()
+        try:
+            await conn.send(GREETING + FRAMED_MARKER)
+            first = await conn.recv(1024)
+            if looks_like_hello(first):
+                # client negotiated the framed protocol, anything else is a legacy username
+                conn.unread(first)
+                conn.framed = True
+                frame = await conn.read_frame()
+                hello = frame.json() if frame.type == HELLO else {}
+                username = str(hello.get("username", "")).strip()
+                if username and hello.get("session"):
+                    await self.serve_data_connection(conn, username, hello["session"])
+                    return
+            else:
+                username = first.decode().strip()
+            if not username:
+                username = None
+                return
+            token = secrets.token_hex(16) if conn.framed else None
+            if username in self.clients or (self.cluster is not None and not await self.cluster.login(username, token)):
+                if conn.framed:
+                    await conn.send_frame(ERROR, 0, {"message": "Username already taken!"})
+                else:
+                    await conn.send(b"Error: Username already taken!\n")  # info about username already taken
+                username = None
+                return
+
+            self.clients[username] = conn
+            conn.throttle = self.throttle.lane(username)
+            self.log_message(f"Client {username} connected from {addr}")
+            if conn.framed:
+                conn.session_token = token
+                self.sessions[conn.session_token] = conn
+                welcome = {"message": "Welcome to the server!", "version": VERSION,
+                           "session": conn.session_token, "streams": self.max_streams}
+                if self.dedup:
+                    welcome["chunk_size"] = self.chunks.chunk_size  # clients may send only missing chunks
+                welcome["codecs"] = available_codecs()  # transfers may ask for one of these, see compression.py
+                welcome["batch"] = True  # upload_batch and download_batch, many files per request
+                welcome["delta"] = True  # upload_delta, rsync style re-uploads, see delta.py
+                await conn.send_frame(WELCOME, 0, welcome)
+                await FramedSession(self, conn, username).run()
+                return
+            await conn.send(b"Welcome to the server!\n")
+
+            while True:
+                data = (await conn.recv(1024)).decode().strip()
+                if not data:
+                    break
+                await self.dispatch(conn, data, username)
+        except asyncio.CancelledError:
+            pass
+        except (ConnectionError, ProtocolError) as e:
+            self.metrics.error("protocol" if isinstance(e, ProtocolError) else "connection")
+            self.log_message(f"Connection with {username or addr} ended: {e}")
+        except Exception as e:
+            self.metrics.error("internal")
+            self.log_message(f"Error handling client {addr}: {e}")
+        finally:
+            self.metrics.connections.dec()
+            conn.close()
+            if conn.session_token:
+                self.sessions.pop(conn.session_token, None)
+                for data_conn in list(conn.data_conns):  # transfers die with their control connection
+                    data_conn.close()
+            if username is not None and self.clients.get(username) is conn:
+                del self.clients[username]
+                if self.cluster is not None:
+                    self.cluster.logout(username, conn.session_token)
+                self.log_message(f"Client {username} disconnected.")
+
+    async def serve_data_connection(self, conn, username, token):
+        # extra connection of an already logged in client, only used for commands and transfers.
+        # with worker processes the control connection may be in another worker, the broker knows it
+        try:
+            if self.cluster is not None:
+                streams = await self.cluster.open_stream(token, username, self.max_streams)
+            else:
+                streams = self.session_streams(token, username)
+        except RequestError as e:
+            await conn.send_frame(ERROR, 0, {"message": str(e)})
+            return
+        streams.add(conn)
+        conn.throttle = self.throttle.lane(username)
+        try:
+            await conn.send_frame(WELCOME, 0, {"message": "Data connection ready.", "version": VERSION})
+            await FramedSession(self, conn, username).run()
+        finally:
+            if self.cluster is not None:
+                self.cluster.close_stream(token, conn)
+            else:
+                streams.discard(conn)
+
+    def session_streams(self, token, username):
+        control = self.sessions.get(token)
+        if control is None or self.clients.get(username) is not control:
+            raise RequestError("Invalid session.")
+        if len(control.data_conns) >= self.max_streams:
+            raise RequestError("Too many data connections.")
+        return control.data_conns
+
+    async def dispatch(self, conn, data, username):
+        # handling legacy text requests and calling their functions
+        if data.startswith("list"):
+            with self.timed_command(conn, "list", username):
+                await self.send_file_list(conn)
+            return
+        for command, arg_count, handler in (
+            ("upload", 2, self.receive_file),
+            ("delete", 2, self.delete_file),
+            ("download", 3, self.send_file),
+        ):
+            if data.startswith(command):
+                try:
+                    tokens = shlex.split(data)
+                except ValueError:
+                    tokens = []
+                if len(tokens) != arg_count:
+                    await conn.send(f"Error: Invalid {command} command format.\n".encode())
+                    return
+                with self.timed_command(conn, command, username):
+                    await handler(conn, *tokens[1:], username)
+                return
+        self.metrics.error("unknown_command")
+        await conn.send(b"Error: Invalid command!\n")
+
+    @contextmanager
+    def timed_command(self, conn, cmd, username, request_id=None, failed=None):
+        # duration, outcome and socket traffic of one command for the metrics and the trace log.
+        # failed() tells whether an error was replied, the text protocol checks its last reply
+        start = time.perf_counter()
+        received, sent = conn.bytes_received, conn.bytes_sent
+        conn.replied_error = False
+        status = "aborted"  # connection lost half way
+        try:
+            yield
+            status = "error" if (failed() if failed else conn.replied_error) else "ok"
+            if status == "error":
+                self.metrics.error("request")
+        finally:
+            trace = {"user": username, "peer": f"{conn.addr[0]}:{conn.addr[1]}"}
+            if request_id is not None:
+                trace["request_id"] = request_id
+            self.metrics.command(cmd, status, time.perf_counter() - start, conn.bytes_received - received,
+                                 conn.bytes_sent - sent, **trace)
+
+    # shared by the legacy handlers below and by session.FramedSession
+
+    async def iter_entries(self, batch=LIST_BATCH, limit=None, **query):
+        # catalog entries one page at a time, read on the disk threads, see Catalog.page for the filters
+        after = None
+        count = 0
+        while limit is None or count < limit:
+            size = batch if limit is None else min(batch, limit - count)
+            entries, after = await self.disk.run(self.catalog.page, after=after, limit=size, **query)
+            count += len(entries)
+            for entry in entries:
+                yield entry
+            if after is None:
+                return
+
+    async def prepare_upload(self, filename, username):
+        if not filename or os.path.basename(filename) != filename:
+            raise RequestError(f"Invalid file name: {filename}")
+        if await self.disk.run(self.catalog.get, username, filename):  # if the file already exist allow overwriting
+            self.log_message(f"Warning: Overwriting existing file {filename} uploaded by {username}.")
+
+    async def claim_upload(self, filename, username):
+        # one upload per file at a time, two would write the same partial file
+        if (username, filename) in self.uploads or (
+                self.cluster is not None and not await self.cluster.claim_upload(username, filename)):
+            raise RequestError(f"File {filename} is already being uploaded.")
+        self.uploads.add((username, filename))
+
+    def release_upload(self, filename, username):
+        self.uploads.discard((username, filename))
+        if self.cluster is not None:
+            self.cluster.release_upload(username, filename)
+
+    def upload_temp_path(self, filename, username):
+        # private file for an upload that can't be resumed, renamed into place once complete
+        return temp_path(self.partial_path(filename, username))
+
+    async def commit_upload(self, filename, username, source, sha256=None):
+        # source holds the finished data, the partial or temp file of an upload. the final
+        # path only ever changes with one atomic rename, readers see the old file or the new one.
+        # sha256 was computed while the data arrived, the catalog keeps it for download checks
+        key = storage_key(filename, username)
+        if self.dedup:
+            await self.disk.run(self.store_chunks, filename, username, source)
+        else:
+            await self.disk.run(self.store_file, filename, username, source, sha256)
+        if self.cache is not None:
+            self.cache.invalidate(key)
+        if source == self.partial_path(filename, username):
+            await self.discard_partial(filename, username, keep_data=True)
+        self.log_message(f"File {filename} uploaded successfully by {username}.")
+
+    def store_file(self, filename, username, source, sha256):
+        # blocking, the rename that publishes a plain upload and its catalog row
+        key = storage_key(filename, username)
+        info = self.layout.publish(key, source)
+        self.chunks.remove(key)  # deduplicated copy from a run with --dedup
+        self.catalog.add(username, filename, info.st_size, info.st_mtime_ns, sha256)
+
+    def store_chunks(self, filename, username, source):
+        # blocking, cuts an upload into chunks and publishes its manifest and catalog row
+        key = storage_key(filename, username)
+        manifest = self.chunks.ingest(key, source)
+        self.remove_plain(key)
+        info = os.stat(self.chunks.manifest_path(key))
+        self.catalog.add(username, filename, manifest["size"], info.st_mtime_ns, manifest.get("sha256"))
+
+    def remove_plain(self, key):
+        # blocking, plain copy stored before dedup was turned on
+        self.layout.discard(key)
+
+    async def commit_manifest(self, filename, username, chunks, sha256=None):
+        # dedup upload whose chunks are all stored, raises cas.MissingChunks otherwise. every chunk was
+        # checked against its own hash, sha256 of the whole file was hashed from the stored chunks
+        key = storage_key(filename, username)
+        await self.disk.run(self.store_manifest, filename, username, chunks, sha256)
+        if self.cache is not None:
+            self.cache.invalidate(key)
+        self.log_message(f"File {filename} uploaded successfully by {username} (deduplicated).")
+
+    def store_manifest(self, filename, username, chunks, sha256):
+        # blocking, commit_manifest's disk and catalog work
+        key = storage_key(filename, username)
+        manifest = self.chunks.commit(key, chunks, sha256)
+        self.remove_plain(key)
+        info = os.stat(self.chunks.manifest_path(key))
+        self.catalog.add(username, filename, manifest["size"], info.st_mtime_ns, sha256)
+
+    def partial_path(self, filename, owner):
+        return self.layout.partial_path(storage_key(filename, owner))
+
+    async def partial_offset(self, filename, owner, size, version):
+        # bytes we already hold for this exact file (same size and client mtime), 0 starts over
+        return await self.disk.run(resume_offset, self.partial_path(filename, owner), size, version)
+
+    async def discard_partial(self, filename, owner, keep_data=False):
+        await self.disk.run(remove_partial, self.partial_path(filename, owner), keep_data)
+
+    async def remove_temp(self, path):
+        # a temp upload file that wasn't committed
+        await self.disk.run(remove_if_exists, path)
+
+    async def locate_file(self, filename, owner, cache=False, log_missing=True):
+        # cache: a download, which may be served from (and counts towards) the memory cache.
+        # log_missing=False for lookups where a missing file is expected, like the base of a delta
+        entry = await self.disk.run(self.catalog.get, owner, filename)
+        if entry is None:
+            if log_missing:
+                self.log_message(f"Client requested missing file: {filename} from {owner}.")
+            raise RequestError("File not found.")
+        key = storage_key(filename, owner)
+        cache_key = None
+        if cache and self.cache is not None and entry["size"] <= self.cache.max_file:
+            cached = self.cache.get(key, entry["mtime"])
+            if cached is not None:  # no file access at all
+                return StoredFile(len(cached.data), entry["mtime"], cached.sha256 or entry["sha256"], data=cached.data)
+            if self.cache.wants(key, entry["size"]):
+                cache_key = key
+        # size and version come from what was opened, the catalog row may lag behind a commit
+        try:
+            checkout, f, info = await self.disk.run(self.open_stored, key)
+        except FileNotFoundError:
+            raise RequestError("File not found on disk.")
+        if checkout is not None:
+            manifest, version = checkout
+            sha256 = entry["sha256"] if entry["mtime"] == version else None
+            return StoredFile(manifest["size"], version, sha256, manifest=manifest, chunks=self.chunks,
+                              cache_key=cache_key, disk=self.disk)
+        sha256 = entry["sha256"] if entry["mtime"] == info.st_mtime_ns else None
+        return StoredFile(info.st_size, info.st_mtime_ns, sha256, f=f, cache_key=cache_key, disk=self.disk)
+
+    def open_stored(self, key):
+        # blocking: (chunk checkout, None, None) of a deduplicated file, (None, open file, stat) of a plain one
+        checkout = self.chunks.checkout(key)  # one failed open for plain files
+        if checkout is not None:
+            return checkout, None, None
+        return (None,) + self.layout.open(key)
+
+    async def cache_file(self, stored):
+        # a hot small file is read into the cache once, this download and the next ones are sent from memory
+        if stored.cache_key is None or stored.size > self.cache.max_file:
+            return
+        try:
+            data = await self.disk.run(read_pieces, stored.pieces(0, stored.size), stored.size)
+        except OSError as e:
+            self.log_message(f"Error caching {stored.cache_key}: {e}")
+            return
+        self.cache.put(stored.cache_key, stored.version, data, stored.known_sha256)
+        stored.data = memoryview(data).toreadonly()
+
+    async def file_hash(self, stored, filename, owner):
+        # hashed once on the disk threads, the catalog remembers it until the file is replaced
+        if stored.known_sha256:
+            return stored.known_sha256
+        sha256 = await self.disk.run(stored.sha256)
+        await self.disk.run(self.catalog.set_hash, owner, filename, stored.version, sha256)
+        return sha256
+
+    async def remove_file(self, filename, username):
+        if await self.disk.run(self.catalog.get, username, filename) is None:  # only the owner's own file
+            self.log_message(f"Failed delete attempt by {username} for file {filename}.")
+            raise RequestError("File not found or insufficient permissions.")
+        try:
+            if not await self.disk.run(self.chunks.remove, storage_key(filename, username)):
+                await self.disk.run(self.layout.remove, storage_key(filename, username))
+        except FileNotFoundError:
+            self.log_message(f"Error deleting file {filename}: File not found on disk.")
+            raise RequestError("File not found on disk.")
+        except Exception as e:
+            self.log_message(f"Error deleting file {filename} for {username}: {e}")
+            raise RequestError("Unable to delete the file.")
+        await self.disk.run(self.catalog.remove, username, filename)
+        if self.cache is not None:
+            self.cache.invalidate(storage_key(filename, username))
+        self.log_message(f"File {filename} deleted by {username}.")
+
+    # legacy text protocol handlers
+
+    async def send_file_list(self, conn):
+        try:
+            # the text protocol has no end marker, the listing has to go out in one piece
+            file_list = "\n".join([f"{entry['name']} (Owner: {entry['owner']})" async for entry in self.iter_entries()])
+            if not file_list:
+                await conn.send(b"No files available.\n")
+            else:
+                await conn.send(file_list.encode())
+        except Exception as e:
+            self.log_message(f"Error sending file list: {e}")
+            await conn.send(b"Error: Failed to retrieve file list.\n")
+
+    async def receive_file(self, conn, filename, username):  # upload file function
+        try:
+            # request file size from client
+            await conn.send(b"Send file size: ")
+            file_size_data = (await conn.recv(1024)).decode().strip()
+
+            # validate received file size
+            if not file_size_data.isdigit():
+                raise ValueError(f"Invalid file size received: {file_size_data}")
+
+            file_size = int(file_size_data)
+            await self.prepare_upload(filename, username)
+            temp = self.upload_temp_path(filename, username)
+
+            view = self.buffers.acquire()
+            digest = hashlib.sha256()  # fed by the disk threads as they write, see diskio.py
+            try:
+                writer = self.disk.writer(await self.disk.run(open_upload, temp, file_size), hasher=digest)
+                try:
+                    await conn.recv_into_file(writer, file_size, view)
+                finally:
+                    await writer.close()
+                await self.commit_upload(filename, username, temp, digest.hexdigest())
+            finally:
+                self.buffers.release(view)
+                await self.remove_temp(temp)  # upload broke off, nothing to resume in the text protocol
+
+            await conn.send(b"File received successfully.\n")
+
+        except (ValueError, RequestError) as ve:
+            await conn.send(f"Error: {ve}\n".encode())
+            self.log_message(f"Error receiving file {filename} from {username}: {ve}")
+
+        except ConnectionError as ce:
+            self.log_message(f"Connection error for file {filename} from {username}: {ce}")
+            raise
+
+        except Exception as e:
+            await conn.send(b"Error: File upload failed.\n")
+            self.log_message(f"Unexpected error receiving file {filename} from {username}: {e}")
+
+    async def delete_file(self, conn, filename, username):
+        try:
+            await self.remove_file(filename, username)
+            await conn.send(b"File deleted successfully.\n")
+        except RequestError as e:
+            await conn.send(f"Error: {e}\n".encode())
+
+    async def send_file(self, conn, filename, owner, requesting_user):  # download file function
+        try:
+            async with await self.locate_file(filename, owner, cache=True) as stored:
+                await self.cache_file(stored)
+                # notify client about the file size
+                await conn.send(str(stored.size).encode())
+                confirmation = (await conn.recv(1024)).decode()
+                if confirmation != "Ready":
+                    self.log_message(f"Client not ready to receive file: {filename} from {owner}.")
+                    return
+
+                await conn.send_pieces(stored.pieces(0, stored.size))
+
+            await conn.send(b"File sent successfully.\n")
+            self.log_message(f"File {filename} sent to {requesting_user} from {owner}.")
+            await self.notify_owner(owner, filename, requesting_user)
+
+        except RequestError as e:
+            await conn.send(f"Error: {e}\n".encode())
+        except Exception as e:
+            await conn.send(b"Error: File transfer failed.\n")
+            self.log_message(f"Error sending file {filename} from {owner}: {e}")
+
+    async def notify_owner(self, owner, filename, requesting_user):
+        # checking if requesting user is the owner of the file
+        if owner == requesting_user:
+            return
+        notification = f"NOTIFICATION: Your file '{filename}' was downloaded by {requesting_user}."
+        if owner not in self.clients:
+            if self.cluster is not None:
+                self.cluster.notify(owner, notification)  # the owner may be logged in to another worker
+            return
+        if await self.notify_client(owner, notification):
+            self.log_message(f"Notification sent to {owner} about download by {requesting_user}.")
+
+    async def notify_client(self, username, message):
+        uploader_conn = self.clients.get(username)
+        if uploader_conn is None:
+            return False
+        try:
+            await uploader_conn.notify(message)
+            return True
+        except Exception as e:
+            self.log_message(f"Error sending notification to {username}: {e}")
+            return False
+
+    def prepare_storage(self):
+        self.open_catalog()
+        self.layout.prepare()
+
+    def open_catalog(self):
+        # the catalog is the file list, the storage folder is only scanned the first time
+        imported = self.catalog.open()
+        self.open_layout(imported)
+        self.chunks.load(self.layout.relative)
+        if not imported:
+            self.import_storage()
+
+    def open_layout(self, imported):
+        # new storage folders are sharded, older ones stay flat until python migrate.py converts them
+        name = self.catalog.setting(LAYOUT_SETTING)
+        if name is None:
+            flat = imported or has_flat_files(self.storage_dir, self.chunks.manifest_dir)
+            name = FLAT if flat else SHARDED
+            self.catalog.set_setting(LAYOUT_SETTING, name)
+        if name == FLAT and self.data_dirs != [self.storage_dir]:
+            raise ValueError(f"--data-dir needs the sharded layout, convert the storage folder first: "
+                             f"python migrate.py --storage {self.storage_dir}")
+        self.layout = make_layout(name, self.data_dirs)
+        if name == FLAT:
+            self.log_message(f"Storage folder uses the flat layout, convert it with: "
+                             f"python migrate.py --storage {self.storage_dir}")
+
+    def import_storage(self):
+        # files and manifests stored before there was a catalog. owners come from the
+        # "{owner}_{name}" file names, which was ambiguous for usernames with "_" in old folders
+        rows = []
+        count = 0
+        for key, path in self.layout.all_keys():
+            parsed = parse_storage_key(key)
+            if parsed:
+                info = os.stat(path)
+                rows.append((*parsed, info.st_size, info.st_mtime_ns, None, info.st_mtime))
+            if len(rows) >= 10000:
+                self.catalog.add_many(rows)
+                count += len(rows)
+                rows = []
+        for key, manifest in self.chunks.manifests():
+            parsed = parse_storage_key(key)
+            if parsed:
+                info = os.stat(self.chunks.manifest_path(key))
+                rows.append((*parsed, manifest["size"], info.st_mtime_ns, manifest.get("sha256"), info.st_mtime))
+                self.catalog.add_refs(digest for digest, _ in manifest["chunks"])
+        self.catalog.add_many(rows)
+        count += len(rows)
+        self.catalog.set_setting("imported", time.time())
+        self.log_message(f"Imported {count} stored files into the catalog.")
+
+
+def raise_file_limit():
+    # every idle client is one fd, lift the soft limit so 10k+ connections fit
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or hard > soft:
+        target = 1048576 if hard == resource.RLIM_INFINITY else hard
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+        except (ValueError, OSError):
+            pass
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Headless file transfer server")
+    parser.add_argument("--port", type=int, required=True, help="port to listen on")
+    parser.add_argument("--storage", required=True, help="storage folder for uploaded files")
+    parser.add_argument("--host", default="0.0.0.0", help="address to bind (default 0.0.0.0)")
+    parser.add_argument("--backlog", type=int, default=1024, help="listen backlog")
+    parser.add_argument("--recv-buffer", type=parse_size, default=RECV_BUFFER_SIZE,
+                        help="upload receive buffer size, e.g. 256K or 4M (default 1M)")
+    parser.add_argument("--max-streams", type=int, default=MAX_STREAMS,
+                        help=f"data connections allowed per client (default {MAX_STREAMS})")
+    parser.add_argument("--data-dir", action="append", dest="data_dirs", metavar="DIR",
+                        help="store files in this directory instead of the storage folder, repeat it to spread "
+                             "them over several disks (the catalog and --dedup chunks stay in the storage folder). "
+                             "after removing one, move its files with python migrate.py")
+    parser.add_argument("--dedup", action="store_true",
+                        help="store uploads as deduplicated chunks shared between files")
+    parser.add_argument("--cache-size", type=parse_size, default=CACHE_SIZE,
+                        help="memory for hot small files served without disk access, 0 turns it off (default 64M)")
+    parser.add_argument("--cache-max-file", type=parse_size, default=CACHE_MAX_FILE,
+                        help="largest file kept in the memory cache (default 1M)")
+    parser.add_argument("--rate-limit", type=parse_size,
+                        help="bandwidth of all file transfers together in bytes per second, e.g. 100M")
+    parser.add_argument("--user-rate-limit", type=parse_size, help="bandwidth per user in bytes per second")
+    parser.add_argument("--conn-rate-limit", type=parse_size, help="bandwidth per connection in bytes per second")
+    parser.add_argument("--disk-threads", type=int, default=DISK_THREADS,
+                        help=f"threads doing the blocking file system work (default {DISK_THREADS})")
+    parser.add_argument("--disk-buffer", type=parse_size, default=DISK_BUFFER,
+                        help="received data allowed to wait for the disk before uploads are slowed down (default 256M)")
+    parser.add_argument("--log-file", help="also write the log to this file, rotated at 10 MiB")
+    parser.add_argument("--log-json", action="store_true", help="write the log file as one json object per line")
+    parser.add_argument("--metrics-port", type=int, help="serve prometheus metrics over http on this port")
+    parser.add_argument("--metrics-host", default="127.0.0.1", help="address of the metrics endpoint (default 127.0.0.1)")
+    parser.add_argument("--trace-log", help="write one json line per handled command to this file")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="serve from this many processes sharing the port (default 1). each worker serves "
+                             "its metrics on --metrics-port plus its index and writes --trace-log.<index>, "
+                             "rate limits apply per worker")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not os.path.isdir(args.storage):
+        print(f"Error: Storage folder {args.storage} does not exist!", file=sys.stderr)
+        return 1
+    for directory in args.data_dirs or ():
+        if not os.path.isdir(directory):
+            print(f"Error: Data folder {directory} does not exist!", file=sys.stderr)
+            return 1
+    raise_file_limit()
+    file_log = FileLog(args.log_file, as_json=args.log_json) if args.log_file else None
+
+    def log(message):
+        print(message, flush=True)
+        if file_log:
+            file_log.write(message)
+
+    if args.workers > 1:
+        return run_workers(args, log, file_log)
+
+    metrics = Metrics(args.trace_log)
+    try:
+        engine = ServerEngine(args.storage, args.port, host=args.host, backlog=args.backlog,
+                              recv_buffer_size=args.recv_buffer, max_streams=args.max_streams, dedup=args.dedup,
+                              log=log, metrics=metrics, metrics_port=args.metrics_port,
+                              metrics_host=args.metrics_host, cache_size=args.cache_size,
+                              cache_max_file=args.cache_max_file, rate_limit=args.rate_limit,
+                              user_rate_limit=args.user_rate_limit, conn_rate_limit=args.conn_rate_limit,
+                              disk_threads=args.disk_threads, disk_buffer=args.disk_buffer,
+                              data_dirs=args.data_dirs)
+        engine.bind()
+    except Exception as e:
+        print(f"Error starting server: {e}", file=sys.stderr)
+        return 1
+    try:
+        engine.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        metrics.close()
+        if file_log:
+            file_log.close()
+    return 0
+
+
+def run_workers(args, log, file_log):
+    if args.dedup:
+        # chunks pinned by a download only exist in that worker's memory, another worker could delete them
+        print("Error: --dedup can't be combined with --workers yet.", file=sys.stderr)
+        return 1
+
+    def make_engine(index, link, listener):
+        # runs in the forked worker, anything with threads (trace log) is created here
+        metrics_port = args.metrics_port + index if args.metrics_port else args.metrics_port
+        engine = ServerEngine(args.storage, args.port, host=args.host, backlog=args.backlog,
+                              recv_buffer_size=args.recv_buffer, max_streams=args.max_streams, log=link.log,
+                              metrics=Metrics(f"{args.trace_log}.{index}" if args.trace_log else None),
+                              metrics_port=metrics_port, metrics_host=args.metrics_host, cluster=link,
+                              reuse_port=True, cache_size=args.cache_size, cache_max_file=args.cache_max_file,
+                              rate_limit=args.rate_limit, user_rate_limit=args.user_rate_limit,
+                              conn_rate_limit=args.conn_rate_limit, disk_threads=args.disk_threads,
+                              disk_buffer=args.disk_buffer, data_dirs=args.data_dirs)
+        if isinstance(listener, int):
+            engine.port = listener
+        else:
+            engine.server_socket = listener  # no SO_REUSEPORT, every worker accepts from the parent's socket
+        return engine
+
+    try:
+        # the catalog is created (and an old storage folder imported) once, before the workers start
+        setup = ServerEngine(args.storage, args.port, log=log, data_dirs=args.data_dirs)
+        setup.prepare_storage()
+        setup.catalog.close()
+        run_cluster(args.workers, args.host, args.port, args.backlog, make_engine, log)
+    except Exception as e:
+        print(f"Error starting server: {e}", file=sys.stderr)
+        return 1
+    finally:
+        if file_log:
+            file_log.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,99 @@
+import threading
+from collections import OrderedDict
+
+from transfer import open_source, read_into_at
+
+# small stored files that are downloaded again and again are kept in memory, so serving them costs
+# no open, stat or read. entries are keyed by storage key and checked against the catalog version on
+# every lookup, so a file replaced by another worker process is never served stale. uploads and
+# deletes also drop the entry right away. a file is only cached the second time it is asked for,
+# one-off downloads don't push the hot files out
+
+CACHE_SIZE = 64 * 1024 * 1024  # bytes of file data kept in memory
+CACHE_MAX_FILE = 1024 * 1024  # bigger files always come from disk (sendfile)
+SEEN_KEYS = 16384  # recently requested files remembered for the admission check
+
+
+class CachedFile:
+    def __init__(self, version, data, sha256=None):
+        self.version = version
+        self.data = data  # read-only memoryview
+        self.sha256 = sha256
+
+
+class FileCache:
+    # lru, the event loop looks files up and executor threads fill it, hence the lock
+    def __init__(self, max_bytes=CACHE_SIZE, max_file=CACHE_MAX_FILE):
+        self.max_bytes = max_bytes
+        self.max_file = min(max_file, max_bytes)
+        self.entries = OrderedDict()  # storage key -> CachedFile, least recently used first
+        self.seen = OrderedDict()  # storage keys asked for but not cached
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, version):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.version == version:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            if entry is not None:
+                self.drop(key)  # replaced since it was cached
+            self.misses += 1
+            return None
+
+    def wants(self, key, size):
+        # true the second time a small file is asked for, the caller then reads it and put()s it
+        if size > self.max_file:
+            return False
+        with self.lock:
+            if key in self.seen:
+                del self.seen[key]
+                return True
+            self.seen[key] = True
+            if len(self.seen) > SEEN_KEYS:
+                self.seen.popitem(last=False)
+            return False
+
+    def put(self, key, version, data, sha256=None):
+        if len(data) > self.max_file:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.drop(key)
+            self.entries[key] = CachedFile(version, memoryview(data).toreadonly(), sha256)
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                self.drop(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.drop(key)
+            self.seen.pop(key, None)
+
+    def drop(self, key):
+        self.size -= len(self.entries.pop(key).data)
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "bytes": self.size, "hits": self.hits, "misses": self.misses,
+                    "evictions": self.evictions}
+
+
+def read_pieces(pieces, size):
+    # blocking: the whole content of (source, offset, count) pieces, run it in an executor
+    data = bytearray(size)
+    view = memoryview(data)
+    position = 0
+    for source, offset, count in pieces:
+        with open_source(source) as f:
+            if read_into_at(f, view[position:position + count], offset) != count:
+                raise OSError("File ended early.")
+        position += count
+    return data
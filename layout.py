@@ -0,0 +1,191 @@
+import hashlib
+import os
+import re
+import secrets
+import shutil
+
+from transfer import open_stat, remove_if_exists
+
+# where stored files live on disk. the flat layout of older storage folders keeps every file as
+# {owner}_{name} in one directory, which gets slow to list and to look up in once it holds a few
+# hundred thousand entries. the sharded layout puts a file under ab/cd/ (from a hash of its storage
+# key), 65536 directories of a few entries each. files can be spread over several data directories,
+# one per disk for more bandwidth: every file has a home directory picked by rendezvous hashing, so
+# adding a directory only moves that directory's share of the files (python migrate.py moves them,
+# until then they are still found where they are). partial and temp uploads are written next to
+# their home, the final rename never crosses a file system. all methods are blocking, the engine
+# runs them on its disk threads
+
+FLAT = "flat"
+SHARDED = "sharded"
+LAYOUT_SETTING = "layout"  # catalog setting, storage folders from before it existed are flat
+PARTIAL_DIR = ".partial"  # unfinished framed uploads, kept so they can be resumed
+TEMP_NAME = re.compile(r"\.[0-9a-f]{16}\.tmp$")  # what temp_path appends, user files may end in .tmp too
+
+
+class Layout:
+    # the interface, a layout only decides the path of a key inside a data directory
+    name = None
+
+    def __init__(self, roots):
+        self.roots = [os.path.realpath(root) for root in roots]
+
+    def relative(self, key):
+        raise NotImplementedError
+
+    def keys(self, root):
+        # (storage key, path) of every file stored in root
+        raise NotImplementedError
+
+    def root(self, key):
+        if len(self.roots) == 1:
+            return self.roots[0]
+        name = os.fsencode(key)
+        return max(self.roots, key=lambda root: hashlib.blake2b(os.fsencode(root) + b"\0" + name,
+                                                                digest_size=8).digest())
+
+    def path(self, key):
+        return os.path.join(self.root(key), self.relative(key))
+
+    def partial_path(self, key):
+        return os.path.join(self.root(key), PARTIAL_DIR, key)
+
+    def prepare(self):
+        for root in self.roots:
+            os.makedirs(os.path.join(root, PARTIAL_DIR), exist_ok=True)
+
+    def candidates(self, key):
+        # the home first, then where a file stored before the last change of data directories may be
+        home = self.path(key)
+        yield home
+        for root in self.roots:
+            path = os.path.join(root, self.relative(key))
+            if path != home:
+                yield path
+
+    def open(self, key):
+        # (open file, stat) of the stored copy, FileNotFoundError when there is none
+        for path in self.candidates(key):
+            try:
+                return open_stat(path)
+            except FileNotFoundError:
+                pass
+        raise FileNotFoundError(f"{key} is not stored.")
+
+    def publish(self, key, source):
+        # source (a partial or temp file of this key) becomes the stored file with one rename
+        path = self.path(key)
+        try:
+            os.replace(source, path)
+        except FileNotFoundError:
+            if not os.path.exists(source):
+                raise
+            os.makedirs(os.path.dirname(path), exist_ok=True)  # first file of its shard
+            os.replace(source, path)
+        for stale in self.candidates(key):
+            if stale != path:
+                remove_if_exists(stale)  # older version in a directory that isn't its home any more
+        return os.stat(path)
+
+    def remove(self, key):
+        # FileNotFoundError when there was no copy
+        found = False
+        for path in self.candidates(key):
+            try:
+                os.remove(path)
+                found = True
+            except FileNotFoundError:
+                pass
+        if not found:
+            raise FileNotFoundError(f"{key} is not stored.")
+
+    def discard(self, key):
+        try:
+            self.remove(key)
+        except FileNotFoundError:
+            pass
+
+    def all_keys(self):
+        for root in self.roots:
+            yield from self.keys(root)
+
+
+class FlatLayout(Layout):
+    name = FLAT
+
+    def relative(self, key):
+        return key
+
+    def keys(self, root):
+        for entry in os.scandir(root):
+            if not entry.name.startswith(".") and not is_temp(entry.name) and entry.is_file():
+                yield entry.name, entry.path
+
+
+class ShardedLayout(Layout):
+    name = SHARDED
+
+    def relative(self, key):
+        digest = hashlib.sha1(os.fsencode(key)).hexdigest()
+        return os.path.join(digest[:2], digest[2:4], key)
+
+    def keys(self, root):
+        for first in scan_dirs(root):
+            for second in scan_dirs(first.path):
+                for entry in os.scandir(second.path):
+                    if not is_temp(entry.name) and entry.is_file():
+                        yield entry.name, entry.path
+
+
+LAYOUTS = {FLAT: FlatLayout, SHARDED: ShardedLayout}
+
+
+def make_layout(name, roots):
+    if name not in LAYOUTS:
+        raise ValueError(f"Unknown storage layout {name}.")
+    return LAYOUTS[name](roots)
+
+
+def scan_dirs(path):
+    # the two hex digit shard directories in path
+    try:
+        entries = list(os.scandir(path))
+    except FileNotFoundError:
+        return []
+    return [entry for entry in entries if len(entry.name) == 2 and entry.is_dir() and not entry.name.startswith(".")]
+
+
+def temp_path(path):
+    # private file next to path, renamed over it once complete
+    return f"{path}.{secrets.token_hex(8)}.tmp"
+
+
+def is_temp(name):
+    return TEMP_NAME.search(name) is not None
+
+
+def has_flat_files(storage_dir, manifest_dir):
+    # a storage folder written before the sharded layout, stored files or manifests at the top level
+    for directory in (storage_dir, manifest_dir):
+        try:
+            with os.scandir(directory) as entries:
+                if any(not entry.name.startswith(".") and entry.is_file() for entry in entries):
+                    return True
+        except FileNotFoundError:
+            pass
+    return False
+
+
+def move_file(source, target):
+    # one rename on the same file system, a copy that appears with one rename across them
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        os.replace(source, target)
+        return
+    except OSError:
+        if not os.path.exists(source):
+            raise
+    temp = temp_path(target)
+    shutil.copy2(source, temp)  # keeps the mtime, the catalog's version of the file
+    os.replace(temp, target)
+    os.remove(source)
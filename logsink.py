@@ -0,0 +1,92 @@
+import json
+import logging
+import logging.handlers
+import queue
+from collections import deque
+
+# log pipeline for the tk windows. any thread may log: messages go into a SimpleQueue (no lock
+# on the producer side) and the tk loop drains it on a timer, one listbox insert per batch.
+# the listbox keeps only the newest lines, the optional log file keeps everything
+
+LOG_INTERVAL_MS = 100  # how often the tk loop drains the queue
+LOG_RING_SIZE = 5000  # lines kept on screen
+LOG_DRAIN_LIMIT = 50000  # messages taken per tick, the rest waits for the next one
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUPS = 5
+SERVER_LOG_FILE = "server.log"
+
+
+class JsonFormatter(logging.Formatter):
+    # one json object per line, for log shippers
+    def format(self, record):
+        return json.dumps({"time": round(record.created, 3), "level": record.levelname,
+                           "message": record.getMessage()})
+
+
+class FileLog:
+    # rotating log file written by a background thread, write() only enqueues.
+    # bare writes the messages as they are, for callers that format their own lines
+    def __init__(self, path, as_json=False, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS, bare=False):
+        self.handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups,
+                                                            encoding="utf-8")
+        if bare:
+            formatter = logging.Formatter("%(message)s")
+        else:
+            formatter = JsonFormatter() if as_json else logging.Formatter("%(asctime)s %(message)s")
+        self.handler.setFormatter(formatter)
+        self.records = queue.SimpleQueue()
+        self.listener = logging.handlers.QueueListener(self.records, self.handler)
+        self.listener.start()
+
+    def write(self, message):
+        self.records.put(logging.makeLogRecord({"msg": message, "levelname": "INFO", "levelno": logging.INFO}))
+
+    def close(self):
+        self.listener.stop()  # flushes what is still queued
+        self.handler.close()
+
+
+class LogSink:
+    def __init__(self, root, listbox, ring_size=LOG_RING_SIZE, interval=LOG_INTERVAL_MS, file_log=None):
+        self.root = root
+        self.listbox = listbox
+        self.ring_size = ring_size
+        self.interval = interval
+        self.file_log = file_log
+        self.pending = queue.SimpleQueue()
+
+    def __call__(self, message):
+        # thread safe, never touches tk
+        self.pending.put(message)
+        if self.file_log:
+            self.file_log.write(message)
+
+    def start(self):
+        self.root.after(self.interval, self.drain)
+
+    def drain(self):
+        # only the newest ring_size messages of a burst can end up on screen, older ones are skipped
+        batch = deque(maxlen=max(1, self.ring_size - 1))  # room for the skipped note
+        taken = 0
+        try:
+            while taken < LOG_DRAIN_LIMIT:
+                batch.append(self.pending.get_nowait())
+                taken += 1
+        except queue.Empty:
+            pass
+        if batch:
+            lines = list(batch)
+            if taken > len(lines):
+                note = " (see the log file)" if self.file_log else ""
+                lines.insert(0, f"... {taken - len(lines)} log lines skipped{note}")
+            self.listbox.insert("end", *lines)
+            extra = self.listbox.size() - self.ring_size
+            if extra > 0:
+                self.listbox.delete(0, extra - 1)
+            self.listbox.yview("end")
+        self.root.after(self.interval, self.drain)
+
+    def close(self):
+        if self.file_log:
+            self.file_log.close()
+            self.file_log = None
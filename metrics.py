@@ -0,0 +1,186 @@
+import asyncio
+import json
+import time
+from bisect import bisect_left
+
+from logsink import FileLog
+
+# server metrics in the prometheus text format. everything is updated from the event loop thread
+# (the engine's single writer), so plain dicts and no locks. the engine serves them over http on
+# a local port when --metrics-port is given, --trace-log adds one json line per request
+
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+THROUGHPUT_BUCKETS = tuple(2 ** n * 1024 * 1024 for n in range(-4, 12))  # 64 KiB/s .. 2 GiB/s
+TRANSFER_COMMANDS = {"upload": "upload", "upload_chunks": "upload", "upload_batch": "upload", "upload_delta": "upload",
+                     "download": "download", "download_batch": "download"}
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+HTTP_TIMEOUT = 5
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in zip(names, values)) + "}"
+
+
+def format_value(value):
+    if isinstance(value, float):
+        if value != value:
+            return "NaN"
+        if value in (float("inf"), float("-inf")):
+            return "+Inf" if value > 0 else "-Inf"
+        return repr(value)
+    return str(value)
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help_text, labels=(), read=None):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.values = {}  # label values -> number
+        self.read = read  # metrics without labels can be read from the engine at scrape time
+
+    def samples(self):
+        # (name, label names, label values, value) lines of this metric
+        if self.read is not None:
+            yield self.name, (), (), self.read()
+            return
+        for key, value in sorted(self.values.items()):
+            yield self.name, self.labels, key, value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for name, labels, values, value in self.samples():
+            lines.append(f"{name}{format_labels(labels, values)} {format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        state = self.values.get(labels)
+        if state is None:
+            state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]  # per bucket, sum, count
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def samples(self):
+        for key, (counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket
+                yield f"{self.name}_bucket", self.labels + ("le",), key + (format_value(bound),), cumulative
+            yield f"{self.name}_sum", self.labels, key, total
+            yield f"{self.name}_count", self.labels, key, count
+
+
+class Metrics:
+    def __init__(self, trace_path=None):
+        self.metrics = []
+        self.connections = self.add(Gauge("ft_connections_active", "Open client connections."))
+        self.connections_total = self.add(Counter("ft_connections_total", "Accepted client connections."))
+        self.commands = self.add(Counter("ft_commands_total", "Commands handled, by command and outcome.",
+                                         ("cmd", "status")))
+        self.command_seconds = self.add(Histogram("ft_command_duration_seconds",
+                                                  "Time from reading a command to its last reply.", ("cmd",)))
+        self.bytes_received = self.add(Counter("ft_bytes_received_total", "Bytes read from client sockets."))
+        self.bytes_sent = self.add(Counter("ft_bytes_sent_total", "Bytes written to client sockets."))
+        self.transfer_bytes = self.add(Counter("ft_transfer_bytes_total", "Bytes moved by finished transfers.",
+                                               ("direction",)))
+        self.transfer_seconds = self.add(Histogram("ft_transfer_duration_seconds",
+                                                   "Duration of finished uploads and downloads.", ("direction",)))
+        self.transfer_rate = self.add(Histogram("ft_transfer_throughput_bytes_per_second",
+                                                "Throughput of single finished transfers.", ("direction",),
+                                                THROUGHPUT_BUCKETS))
+        self.errors = self.add(Counter("ft_errors_total", "Errors by kind.", ("kind",)))
+        self.trace_log = FileLog(trace_path, bare=True) if trace_path else None
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def watch(self, name, help_text, read, kind=Gauge):
+        # read from live state when scraped, e.g. the number of logged in clients or a counter
+        # some other object keeps
+        return self.add(kind(name, help_text, read=read))
+
+    def error(self, kind):
+        self.errors.inc(kind)
+
+    def command(self, cmd, status, seconds, received=0, sent=0, **trace):
+        # one finished command, uploads and downloads also count as a transfer when they succeed
+        self.commands.inc(cmd, status)
+        self.command_seconds.observe(seconds, cmd)
+        direction = TRANSFER_COMMANDS.get(cmd)
+        if direction and status == "ok":
+            moved = received if direction == "upload" else sent
+            self.transfer_bytes.inc(direction, amount=moved)
+            self.transfer_seconds.observe(seconds, direction)
+            if seconds > 0:
+                self.transfer_rate.observe(moved / seconds, direction)
+        if self.trace_log:
+            record = {"time": round(time.time(), 3), "cmd": cmd, "status": status,
+                      "ms": round(seconds * 1000, 3), "bytes_in": received, "bytes_out": sent}
+            record.update(trace)
+            self.trace_log.write(json.dumps(record, separators=(",", ":")))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+    async def handle_http(self, reader, writer):
+        # just enough http for a scraper: GET /metrics, one response, close
+        try:
+            request = await asyncio.wait_for(reader.readline(), HTTP_TIMEOUT)
+            while (await asyncio.wait_for(reader.readline(), HTTP_TIMEOUT)).strip():
+                pass  # headers
+            parts = request.decode(errors="replace").split()
+            if len(parts) >= 2 and parts[0] in ("GET", "HEAD") and parts[1].split("?")[0] in ("/", "/metrics"):
+                status, body = "200 OK", self.render().encode()
+            else:
+                status, body = "404 Not Found", b"Not found\n"
+            head = (f"HTTP/1.0 {status}\r\nContent-Type: {CONTENT_TYPE}\r\n"
+                    f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n").encode()
+            writer.write(head if parts and parts[0] == "HEAD" else head + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def close(self):
+        if self.trace_log:
+            self.trace_log.close()
+            self.trace_log = None
@@ -0,0 +1,92 @@
+import argparse
+import os
+import sys
+
+from cas import ChunkStore
+from catalog import Catalog
+from engine import parse_storage_key
+from layout import FLAT, LAYOUT_SETTING, SHARDED, has_flat_files, is_temp, make_layout, move_file
+
+# converts a storage folder to the sharded layout and moves every file to its home data directory,
+# for flat folders of older releases and after --data-dir changed. run it while the server is
+# stopped, it can be run again after an interruption and picks up where it stopped.
+#
+#   python migrate.py --storage /srv/files
+#   python migrate.py --storage /srv/files --data-dir /mnt/a --data-dir /mnt/b --old-data-dir /mnt/c
+#
+# unfinished uploads in .partial are left where they are, a resumed upload may start over
+
+
+def migrate(storage_dir, data_dirs=None, old_data_dirs=(), log=print):
+    catalog = Catalog(storage_dir)
+    chunks = ChunkStore(storage_dir, catalog)
+    try:
+        imported = catalog.open()
+        current = catalog.setting(LAYOUT_SETTING)
+        if current is None:
+            current = FLAT if imported or has_flat_files(storage_dir, chunks.manifest_dir) else SHARDED
+        target = make_layout(SHARDED, data_dirs or [storage_dir])
+        moved = 0
+        # every place a file may be: the storage folder and the data directories, old and new,
+        # in either layout (an earlier run may have stopped halfway)
+        sources = dict.fromkeys(os.path.realpath(path) for path in [storage_dir, *target.roots, *old_data_dirs])
+        for root in sources:
+            for layout in (make_layout(FLAT, [root]), make_layout(SHARDED, [root])):
+                for key, path in list(layout.keys(root)):
+                    if parse_storage_key(key) is None or path == target.path(key):
+                        continue
+                    move_file(path, target.path(key))
+                    moved += 1
+                    if moved % 10000 == 0:
+                        log(f"{moved} files moved.")
+        moved += migrate_manifests(chunks, target)
+        if current != SHARDED:
+            catalog.set_setting(LAYOUT_SETTING, SHARDED)
+        log(f"Storage folder {storage_dir} uses the sharded layout, {moved} files moved.")
+        return moved
+    finally:
+        catalog.close()
+
+
+def migrate_manifests(chunks, target):
+    # --dedup manifests follow the layout too, they always stay in the storage folder
+    moved = 0
+    if not os.path.isdir(chunks.manifest_dir):
+        return moved
+    chunks.relative = target.relative
+    for directory, _, names in list(os.walk(chunks.manifest_dir)):
+        for name in names:
+            path = os.path.join(directory, name)
+            if is_temp(name) or parse_storage_key(name) is None or path == chunks.manifest_path(name):
+                continue
+            move_file(path, chunks.manifest_path(name))
+            moved += 1
+    return moved
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Convert a storage folder to the sharded layout.")
+    parser.add_argument("--storage", required=True, help="storage folder of the server")
+    parser.add_argument("--data-dir", action="append", dest="data_dirs", metavar="DIR",
+                        help="the server's --data-dir directories, files are moved to their home among them")
+    parser.add_argument("--old-data-dir", action="append", dest="old_data_dirs", default=[], metavar="DIR",
+                        help="a data directory that is no longer used, its files are moved out")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    for directory in [args.storage, *(args.data_dirs or ()), *args.old_data_dirs]:
+        if not os.path.isdir(directory):
+            print(f"Error: Folder {directory} does not exist!", file=sys.stderr)
+            return 1
+    try:
+        migrate(args.storage, args.data_dirs, args.old_data_dirs)
+    except OSError as e:
+        print(f"Error migrating {args.storage}: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
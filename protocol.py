@@ -0,0 +1,166 @@
+import itertools
+import json
+import struct
+
+from transfer import RECV_BUFFER_SIZE, recv_into_file
+
+# every frame starts with a fixed 16 byte header:
+#   magic (2) | version (1) | frame type (1) | request id (4) | payload length (8)
+# the payload length tells the reader exactly where the message ends, no guessing with recv(1024)
+MAGIC = b"FT"
+VERSION = 1
+SUPPORTED_VERSIONS = (1,)
+HEADER = struct.Struct("!2sBBIQ")
+HEADER_SIZE = HEADER.size
+
+# the server advertises framing inside the legacy greeting, old clients just log it
+GREETING = b"Enter your username: "
+FRAMED_MARKER = b"[FT/%d]" % VERSION
+
+MAX_CONTROL_PAYLOAD = 64 * 1024 * 1024  # json frames are held in memory, data frames are streamed
+
+# frame types
+HELLO = 1         # client -> server, first frame, {"username", "versions"}
+WELCOME = 2       # server -> client, login accepted
+COMMAND = 3       # client -> server, {"cmd": ..., arguments}
+OK = 4            # server -> client, command finished
+ERROR = 5         # either way, {"message"}
+META = 6          # server -> client, transfer header (size etc.) before data frames
+DATA = 7          # raw file bytes for the request id
+END = 8           # end of a data stream for the request id
+NOTIFICATION = 9  # server -> client, request id 0
+DISCONNECT = 10   # server -> client, request id 0
+READY = 11        # server -> client, resumable upload may start, {"offset"}
+ENTRIES = 12      # server -> client, one batch of a streamed listing, {"files": [...]}
+
+FRAME_NAMES = {
+    HELLO: "HELLO", WELCOME: "WELCOME", COMMAND: "COMMAND", OK: "OK", ERROR: "ERROR",
+    META: "META", DATA: "DATA", END: "END", NOTIFICATION: "NOTIFICATION", DISCONNECT: "DISCONNECT",
+    READY: "READY", ENTRIES: "ENTRIES",
+}
+
+DATA_FRAME_SIZE = 1024 * 1024  # default payload size used when streaming files
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class RequestError(Exception):
+    # errors whose message is meant for the other side, sent back as an ERROR frame
+    pass
+
+
+def pack_header(frame_type, request_id, length, version=VERSION):
+    return HEADER.pack(MAGIC, version, frame_type, request_id, length)
+
+
+def unpack_header(header):
+    magic, version, frame_type, request_id, length = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ProtocolError(f"Bad frame magic {magic!r}")
+    if version not in SUPPORTED_VERSIONS:
+        raise ProtocolError(f"Unsupported protocol version {version}")
+    if frame_type not in FRAME_NAMES:
+        raise ProtocolError(f"Unknown frame type {frame_type}")
+    if frame_type != DATA and length > MAX_CONTROL_PAYLOAD:
+        raise ProtocolError(f"Control frame too large ({length} bytes)")
+    return frame_type, request_id, length
+
+
+def encode_payload(payload):
+    if payload is None:
+        return b""
+    if isinstance(payload, (bytes, bytearray, memoryview)):
+        return payload
+    return json.dumps(payload, separators=(",", ":")).encode()
+
+
+def decode_payload(payload):
+    if not payload:
+        return {}
+    return json.loads(bytes(payload).decode())
+
+
+def encode_frame(frame_type, request_id, payload=None):
+    body = encode_payload(payload)
+    return pack_header(frame_type, request_id, len(body)) + bytes(body)
+
+
+def advertises_framing(greeting):
+    return FRAMED_MARKER in greeting
+
+
+def looks_like_hello(data):
+    # magic + version + HELLO type, the two control bytes can't appear in a legacy username
+    return len(data) >= 4 and data[:2] == MAGIC and data[2] in SUPPORTED_VERSIONS and data[3] == HELLO
+
+
+class Frame:
+    def __init__(self, frame_type, request_id, payload):
+        self.type = frame_type
+        self.request_id = request_id
+        self.payload = payload
+
+    def json(self):
+        return decode_payload(self.payload)
+
+    def message(self):
+        # ok/error/notification frames carry a human readable message
+        if self.type == DATA:
+            return ""
+        return self.json().get("message", "")
+
+    def __repr__(self):
+        return f"Frame({FRAME_NAMES.get(self.type, self.type)}, id={self.request_id}, {len(self.payload)} bytes)"
+
+
+class FrameSocket:
+    # blocking frame reader/writer used by the client side. partial reads are kept in
+    # self.buffer so a socket timeout in the middle of a frame does not lose bytes
+    def __init__(self, sock, buffer_size=RECV_BUFFER_SIZE):
+        self.sock = sock
+        self.buffer = bytearray()
+        self.view = memoryview(bytearray(buffer_size))  # reused by every data payload
+        self.request_ids = itertools.count(1)
+
+    def next_request_id(self):
+        return next(self.request_ids)
+
+    def send_frame(self, frame_type, request_id, payload=None):
+        self.sock.sendall(encode_frame(frame_type, request_id, payload))
+
+    def send_data_header(self, request_id, length):
+        # used before streaming raw bytes straight from a file
+        self.sock.sendall(pack_header(DATA, request_id, length))
+
+    def fill(self, size):
+        while len(self.buffer) < size:
+            chunk = self.sock.recv(max(65536, size - len(self.buffer)))
+            if not chunk:
+                raise ConnectionError("Connection closed by server.")
+            self.buffer += chunk
+
+    def recv_exact(self, size):
+        self.fill(size)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def recv_header(self):
+        return unpack_header(self.recv_exact(HEADER_SIZE))
+
+    def recv_frame(self):
+        # nothing is consumed until the whole frame is buffered, safe to call with a timeout
+        self.fill(HEADER_SIZE)
+        frame_type, request_id, length = unpack_header(bytes(self.buffer[:HEADER_SIZE]))
+        self.fill(HEADER_SIZE + length)
+        del self.buffer[:HEADER_SIZE]
+        return self.recv_frame_body(frame_type, request_id, length)
+
+    def recv_frame_body(self, frame_type, request_id, length):
+        return Frame(frame_type, request_id, self.recv_exact(length))
+
+    def recv_payload_into(self, length, f):
+        # copy a data payload straight into a file without holding all of it in memory
+        return recv_into_file(self.sock, f, length, self.view, self.buffer)
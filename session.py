@@ -0,0 +1,747 @@
+import asyncio
+import base64
+import hashlib
+import json
+
+from cas import MissingChunks, is_digest
+from catalog import LIST_BATCH, SORT_COLUMNS, sort_key
+from compression import MAX_BLOCK_PAYLOAD, CodecError, decode_block, get_codec, looks_compressible
+from delta import SIGNATURE, block_size, signatures
+from filecache import read_pieces
+from protocol import (COMMAND, DATA, DATA_FRAME_SIZE, END, ENTRIES, ERROR, FRAME_NAMES, META, OK, READY,
+                      ProtocolError, RequestError, decode_payload)
+from transfer import HASH_READ_SIZE, hash_file_range, open_upload
+
+
+class FramedSession:
+    # serves one client that negotiated the length prefixed protocol. commands are read
+    # back to back, so a client can pipeline several of them without waiting for replies
+    def __init__(self, engine, conn, username):
+        self.engine = engine
+        self.conn = conn
+        self.username = username
+        self.errors = 0  # ERROR replies sent, tells the metrics which commands failed
+        self.handlers = {
+            "list": self.cmd_list,
+            "upload": self.cmd_upload,
+            "delete": self.cmd_delete,
+            "download": self.cmd_download,
+            "stat": self.cmd_stat,
+            "chunks": self.cmd_chunks,
+            "upload_chunks": self.cmd_upload_chunks,
+            "upload_batch": self.cmd_upload_batch,
+            "upload_delta": self.cmd_upload_delta,
+            "download_batch": self.cmd_download_batch,
+        }
+
+    async def run(self):
+        while True:
+            try:
+                frame = await self.conn.read_frame()
+            except ConnectionError:
+                return
+            if frame.type != COMMAND:
+                raise ProtocolError(f"Expected a command, got {FRAME_NAMES[frame.type]}")
+            request = frame.json()
+            handler = self.handlers.get(request.get("cmd"))
+            if handler is None:
+                self.engine.metrics.error("unknown_command")
+                await self.error(frame.request_id, "Invalid command!")
+                continue
+            errors = self.errors
+            with self.engine.timed_command(self.conn, request["cmd"], self.username, frame.request_id,
+                                           failed=lambda: self.errors > errors):
+                await handler(frame.request_id, request)
+
+    async def error(self, request_id, message, **details):
+        self.errors += 1
+        await self.conn.send_frame(ERROR, request_id, dict(details, message=message))
+
+    async def cmd_list(self, request_id, request):
+        # filters "owner", "prefix" and "glob", "sort" by name/owner/size/uploaded and "reverse".
+        # "limit" caps this call, the reply then has a "cursor" that continues after the last entry.
+        # with "stream" the entries come in ENTRIES frames followed by END, otherwise in one OK frame
+        # of at most LIST_BATCH entries unless "limit" asks for more
+        try:
+            query, after, limit = parse_list(request)
+        except RequestError as e:
+            await self.error(request_id, str(e))
+            return
+        stream = bool(request.get("stream"))
+        if not stream and limit is None:
+            limit = LIST_BATCH  # one reply holds the whole answer, keep it a page
+        files = []
+        count = 0
+        while limit is None or count < limit:
+            batch = LIST_BATCH if limit is None else min(LIST_BATCH, limit - count)
+            entries, after = await self.engine.disk.run(self.engine.catalog.page, after=after, limit=batch, **query)
+            count += len(entries)
+            entries = [entry_info(entry) for entry in entries]
+            if not stream:
+                files += entries
+            elif entries:
+                await self.conn.send_frame(ENTRIES, request_id, {"files": entries})
+            if after is None:
+                break
+        cursor = encode_cursor(query, after) if after is not None else None
+        if stream:
+            await self.conn.send_frame(END, request_id, {"count": count, "cursor": cursor})
+        else:
+            await self.conn.send_frame(OK, request_id, {"files": files, "cursor": cursor})
+
+    async def cmd_stat(self, request_id, request):
+        # size and version of a stored file, and its sha256 when the server already knows it so a
+        # client can verify a download. "hash" has it computed when it isn't known yet
+        try:
+            filename, owner = request.get("name", ""), request.get("owner", "")
+            async with await self.engine.locate_file(filename, owner) as stored:
+                info = {"size": stored.size, "version": stored.version}
+                if request.get("hash"):
+                    info["sha256"] = await self.engine.file_hash(stored, filename, owner)
+                elif stored.known_sha256:
+                    info["sha256"] = stored.known_sha256
+        except RequestError as e:
+            await self.error(request_id, str(e))
+            return
+        await self.conn.send_frame(OK, request_id, info)
+
+    async def cmd_delete(self, request_id, request):
+        try:
+            await self.engine.remove_file(request.get("name", ""), self.username)
+            await self.conn.send_frame(OK, request_id, {"message": "File deleted successfully."})
+        except RequestError as e:
+            await self.error(request_id, str(e))
+
+    async def cmd_upload(self, request_id, request):
+        # the command is followed by DATA frames and one END frame for the same request id.
+        # with "resume" the server first answers READY with the bytes it already holds.
+        # with "codec" every DATA frame is one block as described in compression.py.
+        # END may carry the client's "sha256" of the whole file, checked against the one hashed here
+        filename = request.get("name", "")
+        file_size = request.get("size")
+        resume = bool(request.get("resume"))
+        codec = get_codec(request.get("codec"))
+        try:
+            if not isinstance(file_size, int) or file_size < 0:
+                raise RequestError(f"Invalid file size received: {file_size}")
+            if request.get("codec") is not None and codec is None:
+                raise RequestError(f"Unsupported codec {request.get('codec')}.")
+            await self.engine.prepare_upload(filename, self.username)
+            await self.engine.claim_upload(filename, self.username)
+        except RequestError as e:
+            if not resume:
+                await self.drain(request_id)  # data is already on the way
+            await self.error(request_id, str(e))
+            self.engine.log_message(f"Error receiving file {filename} from {self.username}: {e}")
+            return
+        try:
+            await self.receive_upload(request_id, filename, file_size, resume, request.get("mtime"), codec)
+        finally:
+            self.engine.release_upload(filename, self.username)
+
+    async def receive_upload(self, request_id, filename, file_size, resume, mtime, codec=None):
+        partial = self.engine.partial_path(filename, self.username)
+        offset = 0
+        if resume:
+            offset = await self.engine.partial_offset(filename, self.username, file_size, mtime)
+            if offset:
+                self.engine.log_message(f"Resuming upload of {filename} by {self.username} at byte {offset}.")
+            await self.conn.send_frame(READY, request_id, {"offset": offset})
+        else:
+            await self.engine.discard_partial(filename, self.username)
+
+        received = 0
+        view = self.engine.buffers.acquire()
+        digest = hashlib.sha256()  # fed by the disk threads as they write, see diskio.py
+        try:
+            if offset:
+                await self.engine.disk.run(hash_file_range, digest, partial, 0, offset)
+            writer = self.engine.disk.writer(await self.engine.disk.run(open_upload, partial, file_size, offset),
+                                             hasher=digest)
+            try:
+                count, end = await self.receive_stream(request_id, writer, view, codec)
+                received = offset + count
+            finally:
+                await writer.close()  # whatever arrived stays, a later upload can resume from it
+            sha256 = digest.hexdigest()
+        except ConnectionError:
+            self.engine.log_message(f"Connection error for file {filename} from {self.username}, partial upload kept.")
+            raise
+        except ProtocolError:
+            raise  # the rest of the request can't be followed, the connection is dropped
+        except Exception as e:
+            await self.error(request_id, "File upload failed.")
+            self.engine.log_message(f"Unexpected error receiving file {filename} from {self.username}: {e}")
+            return
+        finally:
+            self.engine.buffers.release(view)
+
+        if received != file_size:
+            await self.engine.discard_partial(filename, self.username)
+            await self.error(request_id, f"File size mismatch: expected {file_size}, received {received}")
+            self.engine.log_message(f"Error receiving file {filename} from {self.username}: size mismatch.")
+            return
+        if end.get("sha256") not in (None, sha256):
+            await self.engine.discard_partial(filename, self.username)  # the kept part can't be trusted either
+            await self.error(request_id, "File failed verification, the sha256 doesn't match.")
+            self.engine.log_message(f"Error receiving file {filename} from {self.username}: sha256 mismatch.")
+            return
+        await self.engine.commit_upload(filename, self.username, partial, sha256)
+        await self.conn.send_frame(OK, request_id, {"message": "File received successfully."})
+
+    async def cmd_upload_delta(self, request_id, request):
+        # rsync style re-upload of a file the user already stored, see delta.py. the server answers
+        # META {"base_size", "block_size", "blocks"} followed by the packed block signatures in DATA
+        # frames. the client then sends the new file as META {"copy": [first block, count]}
+        # instructions and DATA frames with the bytes in between ("codec" works like for upload),
+        # and END with the sha256 of the new file, or {"cancel": true} when a full upload is cheaper.
+        # ERROR with "no_base" when there's nothing to diff against
+        filename = request.get("name", "")
+        file_size = request.get("size")
+        codec = get_codec(request.get("codec"))
+        try:
+            if not isinstance(file_size, int) or file_size < 0:
+                raise RequestError(f"Invalid file size received: {file_size}")
+            if request.get("codec") is not None and codec is None:
+                raise RequestError(f"Unsupported codec {request.get('codec')}.")
+            await self.engine.prepare_upload(filename, self.username)
+            await self.engine.claim_upload(filename, self.username)
+        except RequestError as e:
+            await self.error(request_id, str(e))
+            return
+        try:
+            # claimed first, an opened (and with dedup pinned) copy is always closed by the with
+            try:
+                stored = await self.engine.locate_file(filename, self.username, log_missing=False)
+            except RequestError:
+                await self.error(request_id, "No stored copy to compare with.", no_base=True)
+                return
+            async with stored:
+                await self.receive_delta(request_id, filename, file_size, stored, codec)
+        finally:
+            self.engine.release_upload(filename, self.username)
+
+    async def receive_delta(self, request_id, filename, file_size, stored, codec):
+        block = block_size(stored.size)
+        try:
+            records = await self.engine.disk.run(signatures, stored.pieces(0, stored.size), stored.size, block)
+        except OSError as e:
+            await self.error(request_id, "File upload failed.")
+            self.engine.log_message(f"Error reading {filename} of {self.username} for a delta upload: {e}")
+            return
+        blocks = len(records) // SIGNATURE.size
+        await self.conn.send_frame(META, request_id, {"base_size": stored.size, "version": stored.version,
+                                                      "block_size": block, "blocks": blocks})
+        step = DATA_FRAME_SIZE // SIGNATURE.size * SIGNATURE.size
+        for start in range(0, len(records), step):
+            await self.conn.send_frame(DATA, request_id, records[start:start + step])
+
+        temp = self.engine.upload_temp_path(filename, self.username)
+        digest = hashlib.sha256()
+        sent = copied = 0
+        view = self.engine.buffers.acquire()
+        try:
+            writer = self.engine.disk.writer(await self.engine.disk.run(open_upload, temp, file_size), hasher=digest)
+            try:
+                while True:
+                    frame_type, frame_id, length = await self.conn.read_header()
+                    if frame_id != request_id or frame_type not in (META, DATA, END):
+                        raise ProtocolError(f"Unexpected {FRAME_NAMES[frame_type]} frame during delta upload")
+                    if frame_type == DATA:
+                        sent += await self.receive_data(writer, length, view, codec,
+                                                        limit=file_size - sent - copied)
+                        continue
+                    header = parse_end(await self.conn.recv_exact(length))
+                    if frame_type == END:
+                        break
+                    first, count = parse_copy(header, blocks)
+                    offset = first * block
+                    length = min(count * block, stored.size - offset)
+                    if length > file_size - sent - copied:
+                        raise ProtocolError("Delta upload runs past the announced size")
+                    copied += await self.copy_stored(writer, stored, offset, length)
+            finally:
+                await writer.close()
+            if header.get("cancel"):
+                await self.error(request_id, "Delta upload cancelled.")
+                return
+            sha256 = digest.hexdigest()
+            if sent + copied != file_size:
+                await self.error(request_id, f"File size mismatch: expected {file_size}, "
+                                             f"received {sent + copied}")
+                self.engine.log_message(f"Error receiving file {filename} from {self.username}: size mismatch.")
+                return
+            if header.get("sha256") not in (None, sha256):
+                await self.error(request_id, "File failed verification, the sha256 doesn't match.")
+                self.engine.log_message(f"Error receiving file {filename} from {self.username}: sha256 mismatch.")
+                return
+            await self.engine.commit_upload(filename, self.username, temp, sha256)
+        except (ConnectionError, ProtocolError):
+            raise
+        except Exception as e:
+            await self.error(request_id, "File upload failed.")
+            self.engine.log_message(f"Unexpected error receiving file {filename} from {self.username}: {e}")
+            return
+        finally:
+            self.engine.buffers.release(view)
+            await self.engine.remove_temp(temp)
+        self.engine.log_message(f"Delta upload of {filename} by {self.username}: {sent} bytes sent, "
+                                f"{copied} reused.")
+        await self.conn.send_frame(OK, request_id, {"message": "File received successfully.", "sent": sent,
+                                                    "copied": copied})
+
+    async def copy_stored(self, writer, stored, offset, length):
+        # a range of the old version into the new one, read on the disk threads a slice at a time
+        end = offset + length
+        while offset < end:
+            n = min(HASH_READ_SIZE, end - offset)
+            writer.write(await self.engine.disk.run(read_pieces, stored.pieces(offset, n), n))
+            await writer.drain()
+            offset += n
+        return length
+
+    async def cmd_chunks(self, request_id, request):
+        # which of the given chunk hashes the server doesn't hold, asked before upload_chunks
+        try:
+            store = self.require_chunks()
+            digests = request.get("hashes")
+            if not isinstance(digests, list) or not all(is_digest(digest) for digest in digests):
+                raise RequestError("Invalid chunk hash list.")
+        except RequestError as e:
+            await self.error(request_id, str(e))
+            return
+        missing = await self.engine.disk.run(store.missing, digests)
+        await self.conn.send_frame(OK, request_id, {"missing": missing})
+
+    async def cmd_upload_chunks(self, request_id, request):
+        # dedup upload: the command lists every [hash, length] of the file, the DATA frames that follow
+        # carry only the chunks the server was missing, one chunk per frame, then END
+        filename = request.get("name", "")
+        try:
+            store = self.require_chunks()
+            await self.engine.prepare_upload(filename, self.username)
+            chunks = parse_chunks(request.get("chunks"), request.get("size"), store.chunk_size)
+            await self.engine.claim_upload(filename, self.username)
+        except RequestError as e:
+            await self.drain(request_id)
+            await self.error(request_id, str(e))
+            self.engine.log_message(f"Error receiving file {filename} from {self.username}: {e}")
+            return
+        try:
+            await self.receive_chunks(request_id, filename, store, chunks)
+        finally:
+            self.engine.release_upload(filename, self.username)
+
+    async def receive_chunks(self, request_id, filename, store, chunks):
+        wanted = {digest for digest, _ in chunks}
+        largest = max((length for _, length in chunks), default=0)
+        stray = 0
+        while True:
+            frame_type, frame_id, length = await self.conn.read_header()
+            if frame_id != request_id or frame_type not in (DATA, END):
+                raise ProtocolError(f"Unexpected {FRAME_NAMES[frame_type]} frame during upload")
+            if frame_type == DATA and length > largest:
+                raise ProtocolError(f"Chunk of {length} bytes is larger than any chunk of the file")
+            data = await self.conn.recv_exact(length)
+            if frame_type == END:
+                end = parse_end(data)
+                break
+            await self.conn.pace(length)
+            if await self.engine.disk.run(store.put_chunk, data, wanted) is None:
+                stray += 1
+
+        try:
+            if stray:
+                raise RequestError(f"{stray} chunks don't belong to file {filename}.")
+            expected = end.get("sha256")  # of the whole file, from the client
+            if expected is not None and not is_digest(expected):
+                raise RequestError("Invalid file hash.")
+            # every chunk matched its own hash, the whole file's is recomputed before it is served to anyone
+            sha256 = await self.engine.disk.run(store.hash_chunks, chunks)
+            if expected is not None and sha256 != expected:
+                await self.error(request_id, "File failed verification, the sha256 doesn't match.")
+                self.engine.log_message(f"Error receiving file {filename} from {self.username}: sha256 mismatch.")
+                return
+            await self.engine.commit_manifest(filename, self.username, chunks, sha256)
+        except MissingChunks as e:
+            # collected by a concurrent delete, the client asks again and sends them
+            await self.error(request_id, str(e), missing=e.digests)
+            return
+        except RequestError as e:
+            await self.error(request_id, str(e))
+            return
+        await self.conn.send_frame(OK, request_id, {"message": "File received successfully."})
+
+    def require_chunks(self):
+        if not self.engine.dedup:
+            raise RequestError("Deduplication is not enabled on this server.")
+        return self.engine.chunks
+
+    async def receive_stream(self, request_id, f, view, codec=None):
+        # returns the raw bytes written to f and the END payload
+        received = 0
+        while True:
+            frame_type, frame_id, length = await self.conn.read_header()
+            if frame_id != request_id or frame_type not in (DATA, END):
+                raise ProtocolError(f"Unexpected {FRAME_NAMES[frame_type]} frame during upload")
+            if frame_type == END:
+                return received, parse_end(await self.conn.recv_exact(length))
+            received += await self.receive_data(f, length, view, codec)
+
+    async def receive_data(self, f, length, view, codec=None, limit=None):
+        # one DATA payload into f, returns the raw bytes written. limit is what may still come
+        if codec is None:
+            if limit is not None and length > limit:
+                raise ProtocolError(f"DATA frame of {length} bytes where {limit} were left")
+            return await self.conn.recv_into_file(f, length, view)
+        if length > MAX_BLOCK_PAYLOAD:
+            raise ProtocolError(f"Compressed block of {length} bytes is too large")
+        payload = await self.conn.recv_exact(length)
+        await self.conn.pace(length)
+        try:
+            data = await self.conn.loop.run_in_executor(None, decode_block, codec, payload)
+        except CodecError as e:
+            raise ProtocolError(str(e))
+        if limit is not None and len(data) > limit:
+            raise ProtocolError(f"Block of {len(data)} bytes where {limit} were left")
+        f.write(data)
+        if getattr(f, "drain", None) is not None:
+            await f.drain()
+        return len(data)
+
+    async def drain(self, request_id):
+        # skip the data of a rejected upload so the stream stays in sync
+        view = self.engine.buffers.acquire()
+        try:
+            await self.receive_stream(request_id, _NullWriter(), view)
+        finally:
+            self.engine.buffers.release(view)
+
+    async def cmd_upload_batch(self, request_id, request):
+        # many files in one request, like a tar stream: each file is a META header {"name", "size"}
+        # followed by its DATA frames, END closes the batch. files are stored as they arrive, one
+        # failing doesn't stop the others. the results, one per file with the sha256 of what was
+        # stored, follow END in ENTRIES frames (the client may still be sending while they pile up),
+        # then OK with the counts. "codec" works like for upload
+        codec = get_codec(request.get("codec"))
+        supported = request.get("codec") is None or codec is not None
+        results = []
+        view = self.engine.buffers.acquire()
+        try:
+            while True:
+                frame_type, frame_id, length = await self.conn.read_header()
+                if frame_id != request_id or frame_type not in (META, END, DATA):
+                    raise ProtocolError(f"Unexpected {FRAME_NAMES[frame_type]} frame during batch upload")
+                if not supported:
+                    if frame_type == END:
+                        break
+                    await self.conn.recv_into_file(_NullWriter(), length, view)  # skipped until END
+                    continue
+                if frame_type == DATA:
+                    raise ProtocolError("DATA frame outside of a batch entry")
+                header = parse_end(await self.conn.recv_exact(length))
+                if frame_type == END:
+                    break
+                results.append(await self.receive_batch_entry(request_id, header, view, codec))
+        finally:
+            self.engine.buffers.release(view)
+        if not supported:
+            await self.error(request_id, f"Unsupported codec {request.get('codec')}.")
+            return
+        for start in range(0, len(results), LIST_BATCH):
+            await self.conn.send_frame(ENTRIES, request_id, {"files": results[start:start + LIST_BATCH]})
+        failed = sum(not result["ok"] for result in results)
+        await self.conn.send_frame(OK, request_id, {"message": f"{len(results) - failed} of {len(results)} files "
+                                                               f"received successfully.",
+                                                    "count": len(results), "failed": failed})
+
+    async def receive_batch_entry(self, request_id, header, view, codec):
+        filename = header.get("name", "")
+        size = header.get("size")
+        if not isinstance(size, int) or size < 0:
+            raise ProtocolError(f"Invalid size in batch entry {filename!r}")  # the stream can't be followed
+        try:
+            if not isinstance(filename, str):
+                raise RequestError(f"Invalid file name: {filename}")
+            await self.engine.prepare_upload(filename, self.username)
+            await self.engine.claim_upload(filename, self.username)
+        except RequestError as e:
+            await self.receive_entry_data(request_id, _NullWriter(), size, view, codec)
+            self.engine.log_message(f"Error receiving file {filename} from {self.username}: {e}")
+            return {"name": str(filename), "ok": False, "message": str(e)}
+
+        temp = self.engine.upload_temp_path(filename, self.username)
+        digest = hashlib.sha256()  # fed on the disk threads as the entry is written, like a single upload
+        committed = False
+        try:
+            f = self.engine.disk.writer(await self.engine.disk.run(open_upload, temp, size), hasher=digest)
+            try:
+                await self.receive_entry_data(request_id, f, size, view, codec)
+            finally:
+                await f.close()
+            sha256 = digest.hexdigest()
+            await self.engine.commit_upload(filename, self.username, temp, sha256)
+            committed = True
+        except (ConnectionError, ProtocolError):
+            raise
+        except Exception as e:
+            self.engine.log_message(f"Unexpected error receiving file {filename} from {self.username}: {e}")
+            return {"name": filename, "ok": False, "message": "File upload failed."}
+        finally:
+            self.engine.release_upload(filename, self.username)
+            if not committed:  # a committed temp was renamed away, no need to ask the disk
+                await self.engine.remove_temp(temp)
+        return {"name": filename, "ok": True, "sha256": sha256}
+
+    async def receive_entry_data(self, request_id, f, size, view, codec):
+        # exactly size raw bytes of one batch entry
+        received = 0
+        while received < size:
+            frame_type, frame_id, length = await self.conn.read_header()
+            if frame_id != request_id or frame_type != DATA:
+                raise ProtocolError(f"Batch entry ended {size - received} bytes early")
+            received += await self.receive_data(f, length, view, codec, limit=size - received)
+
+    async def cmd_download_batch(self, request_id, request):
+        # "files" lists {"name", "owner"} pairs, without it every file matching the list filters
+        # ("owner", "prefix", "glob", "limit") is sent. each file is a META header followed by its DATA frames,
+        # or a META with only "error" when it can't be sent. a file may carry "if_version"/"if_sha256"
+        # like a download, its META then says "not_modified" and no data follows. END carries the counts
+        files = request.get("files")
+        try:
+            if files is None:
+                query, _, limit = parse_list(dict(request, cursor=None))
+                files = self.engine.iter_entries(limit=limit, **query)
+            elif not isinstance(files, list) or not all(isinstance(entry, dict) for entry in files):
+                raise RequestError("Invalid file list.")
+            else:
+                files = iterate(files)
+            codec = get_codec(request.get("codec"))
+            if request.get("codec") is not None and codec is None:
+                raise RequestError(f"Unsupported codec {request.get('codec')}.")
+        except RequestError as e:
+            await self.error(request_id, str(e))
+            return
+        count = failed = 0
+        async for entry in files:
+            sent = await self.send_batch_entry(request_id, entry, codec)
+            if sent is None:
+                return  # broke off half way, the client got an ERROR
+            count += 1
+            failed += not sent
+        await self.conn.send_frame(END, request_id, {"count": count, "failed": failed})
+
+    async def send_batch_entry(self, request_id, entry, codec):
+        # True when sent, False when the file was skipped, None when the batch can't go on
+        filename, owner = str(entry.get("name", "")), str(entry.get("owner", ""))
+        try:
+            stored = await self.engine.locate_file(filename, owner, cache=True)
+        except RequestError as e:
+            await self.conn.send_frame(META, request_id, {"name": filename, "owner": owner, "error": str(e)})
+            return False
+        async with stored:
+            try:
+                if await self.not_modified(entry, stored, filename, owner):
+                    await self.conn.send_frame(META, request_id, {"name": filename, "owner": owner,
+                                                                  "size": stored.size, "version": stored.version,
+                                                                  "not_modified": True})
+                    self.engine.log_message(f"File {filename} from {owner} not modified for {self.username}.")
+                    return True
+                await self.engine.cache_file(stored)
+                pieces = stored.pieces(0, stored.size)
+                if codec and not await self.conn.loop.run_in_executor(None, looks_compressible, pieces, stored.size):
+                    codec = None
+                meta = {"name": filename, "owner": owner, "size": stored.size, "version": stored.version}
+                if stored.known_sha256:
+                    meta["sha256"] = stored.known_sha256
+                if codec:
+                    meta["codec"] = codec.name
+                await self.conn.send_frame(META, request_id, meta)
+                if codec:
+                    await self.conn.send_blocks(request_id, pieces, codec)
+                else:
+                    await self.conn.send_pieces(pieces, request_id, DATA_FRAME_SIZE)  # small frames, kept in memory
+            except ConnectionError:
+                raise
+            except Exception as e:
+                await self.error(request_id, "File transfer failed.")
+                self.engine.log_message(f"Error sending file {filename} from {owner}: {e}")
+                return None
+        self.engine.log_message(f"File {filename} sent to {self.username} from {owner}.")
+        await self.engine.notify_owner(owner, filename, self.username)
+        return True
+
+    async def not_modified(self, request, stored, filename, owner):
+        # the version is free to compare, the hash may have to be computed once
+        if request.get("if_version") is not None and request["if_version"] == stored.version:
+            return True
+        if isinstance(request.get("if_sha256"), str):
+            return request["if_sha256"] == await self.engine.file_hash(stored, filename, owner)
+        return False
+
+    async def cmd_download(self, request_id, request):
+        # optional "offset"/"length" select a byte range, the default is the whole file. "codec" asks for
+        # compressed blocks, META names the codec when the server agreed (not for already compressed data).
+        # "if_version"/"if_sha256" make it conditional, OK with "not_modified" instead of META when the
+        # client already holds this content
+        filename = request.get("name", "")
+        owner = request.get("owner", "")
+        try:
+            stored = await self.engine.locate_file(filename, owner, cache=True)
+        except RequestError as e:
+            await self.error(request_id, str(e))
+            return
+        hashing = None
+        async with stored:
+            try:
+                unchanged = await self.not_modified(request, stored, filename, owner)
+            except OSError as e:
+                await self.error(request_id, "File transfer failed.")
+                self.engine.log_message(f"Error hashing file {filename} from {owner}: {e}")
+                return
+            if unchanged:
+                await self.conn.send_frame(OK, request_id, {"message": "File not modified.", "not_modified": True,
+                                                            "size": stored.size, "version": stored.version})
+                self.engine.log_message(f"File {filename} from {owner} not modified for {self.username}.")
+                return
+            await self.engine.cache_file(stored)
+            file_size, version = stored.size, stored.version
+            if request.get("version") not in (None, version):
+                request = dict(request, offset=0, length=None)  # file changed since the partial download
+            try:
+                offset, length = parse_range(request, file_size)
+            except RequestError as e:
+                await self.error(request_id, str(e))
+                return
+
+            try:
+                pieces = stored.pieces(offset, length)
+                codec = get_codec(request.get("codec"))
+                if codec and not await self.conn.loop.run_in_executor(None, looks_compressible, pieces, length):
+                    codec = None
+                meta = {"size": file_size, "offset": offset, "length": length, "version": version}
+                if codec:
+                    meta["codec"] = codec.name
+                if offset + length == file_size:
+                    # END of a download reaching the end of the file carries the sha256 of the whole file.
+                    # files stored before hashes were kept get hashed while the data is being sent
+                    hashing = asyncio.ensure_future(self.engine.file_hash(stored, filename, owner))
+                await self.conn.send_frame(META, request_id, meta)
+                if codec:
+                    await self.conn.send_blocks(request_id, pieces, codec)
+                else:
+                    await self.conn.send_pieces(pieces, request_id)
+                end = {"message": "File sent successfully."}
+                if hashing is not None:
+                    end["sha256"] = await hashing
+            except ConnectionError:
+                raise
+            except Exception as e:
+                await self.error(request_id, "File transfer failed.")
+                self.engine.log_message(f"Error sending file {filename} from {owner}: {e}")
+                return
+            finally:
+                if hashing is not None and not hashing.done():
+                    # the hash reads stored, which has to stay open until it's done. it still ends up
+                    # in the catalog for the next download
+                    await asyncio.gather(hashing, return_exceptions=True)
+
+        await self.conn.send_frame(END, request_id, end)
+        if offset + length < file_size:
+            return  # only the piece reaching the end of the file counts as a finished download
+        self.engine.log_message(f"File {filename} sent to {self.username} from {owner}.")
+        await self.engine.notify_owner(owner, filename, self.username)
+
+
+def parse_end(payload):
+    try:
+        end = decode_payload(payload)
+    except ValueError:
+        end = None
+    if not isinstance(end, dict):
+        raise ProtocolError("Invalid END frame")
+    return end
+
+
+def parse_copy(header, blocks):
+    copy = header.get("copy")
+    if (not isinstance(copy, list) or len(copy) != 2 or not all(isinstance(n, int) for n in copy)
+            or copy[0] < 0 or copy[1] <= 0 or copy[0] + copy[1] > blocks):
+        raise ProtocolError(f"Invalid copy instruction {copy}")
+    return copy
+
+
+def parse_range(request, file_size):
+    offset = request.get("offset", 0)
+    length = request.get("length")
+    if not isinstance(offset, int) or offset < 0 or offset > file_size:
+        raise RequestError(f"Invalid offset {offset} for a file of {file_size} bytes.")
+    if length is None:
+        length = file_size - offset
+    if not isinstance(length, int) or length < 0:
+        raise RequestError(f"Invalid length {length}.")
+    return offset, min(length, file_size - offset)
+
+
+def entry_info(entry):
+    return {"name": entry["name"], "owner": entry["owner"], "size": entry["size"], "version": entry["mtime"],
+            "uploaded": entry["uploaded_at"]}
+
+
+def parse_list(request):
+    query = {"sort": request.get("sort", "name"), "reverse": bool(request.get("reverse"))}
+    if query["sort"] not in SORT_COLUMNS:
+        raise RequestError(f"Invalid sort order {query['sort']}.")
+    for field, argument in (("owner", "owner"), ("prefix", "prefix"), ("glob", "pattern")):
+        value = request.get(field)
+        if value is not None:
+            if not isinstance(value, str):
+                raise RequestError(f"Invalid {field} filter.")
+            query[argument] = value
+    limit = request.get("limit")
+    if limit is not None and (not isinstance(limit, int) or limit <= 0):
+        raise RequestError(f"Invalid limit {limit}.")
+    after = decode_cursor(request["cursor"], query) if request.get("cursor") else None
+    return query, after, limit
+
+
+def encode_cursor(query, after):
+    # opaque to the client, the sort key of the last entry sent
+    state = {"sort": query["sort"], "reverse": query["reverse"], "after": after}
+    return base64.urlsafe_b64encode(json.dumps(state, separators=(",", ":")).encode()).decode()
+
+
+def decode_cursor(cursor, query):
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        sort, reverse, after = state["sort"], state["reverse"], state["after"]
+    except (AttributeError, TypeError, ValueError, KeyError):
+        raise RequestError("Invalid list cursor.")
+    if sort != query["sort"] or reverse != query["reverse"]:
+        raise RequestError("List cursor belongs to a different sort order.")
+    if not isinstance(after, list) or len(after) != len(sort_key(sort)):
+        raise RequestError("Invalid list cursor.")
+    return after
+
+
+def parse_chunks(chunks, file_size, chunk_size):
+    if not isinstance(chunks, list) or not isinstance(file_size, int):
+        raise RequestError("Invalid chunk list.")
+    for chunk in chunks:
+        if (not isinstance(chunk, list) or len(chunk) != 2 or not is_digest(chunk[0])
+                or not isinstance(chunk[1], int) or not 0 < chunk[1] <= chunk_size):
+            raise RequestError("Invalid chunk list.")
+    if sum(length for _, length in chunks) != file_size:
+        raise RequestError(f"Chunk list doesn't add up to {file_size} bytes.")
+    return chunks
+
+
+async def iterate(items):
+    # a list where the catalog's async iterator could be
+    for item in items:
+        yield item
+
+
+class _NullWriter:
+    def write(self, data):
+        return len(data)
@@ -0,0 +1,104 @@
+import asyncio
+import weakref
+from collections import deque
+
+# bandwidth limits for file data. a token bucket per connection, per user and one for the whole server,
+# a transfer takes tokens for every slice of data it moves, from the most specific bucket to the global
+# one. waiters are served first come first served in slices of QUANTUM bytes, so transfers sharing a
+# bucket take turns and each gets an equal share. commands, replies and notifications never wait for
+# tokens and, since throttled data goes out in small frames, they get in between two slices right away.
+# limits count both directions together
+
+QUANTUM = 256 * 1024  # bytes a throttled transfer moves per turn
+BURST_SECONDS = 0.25  # a bucket holds this much of its rate, a burst after an idle moment stays short
+MIN_WAIT = 0.001
+
+
+class TokenBucket:
+    # only used from the event loop thread
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = max(burst or self.rate * BURST_SECONDS, QUANTUM)
+        self.tokens = self.burst
+        self.stamp = None
+        self.waiters = deque()  # (future, count) in arrival order
+        self.timer = None
+
+    def refill(self, now):
+        if self.stamp is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    async def take(self, count):
+        loop = asyncio.get_running_loop()
+        count = min(count, self.burst)
+        self.refill(loop.time())
+        if not self.waiters and self.tokens >= count:
+            self.tokens -= count
+            return
+        future = loop.create_future()
+        self.waiters.append((future, count))
+        self.schedule(loop)
+        await future
+
+    def schedule(self, loop):
+        if self.timer is None and self.waiters:
+            count = self.waiters[0][1]
+            self.timer = loop.call_later(max(MIN_WAIT, (count - self.tokens) / self.rate), self.wake, loop)
+
+    def wake(self, loop):
+        self.timer = None
+        self.refill(loop.time())
+        while self.waiters:
+            future, count = self.waiters[0]
+            if future.done():  # the transfer was cancelled while waiting
+                self.waiters.popleft()
+                continue
+            if self.tokens < count:
+                break
+            self.tokens -= count
+            self.waiters.popleft()
+            future.set_result(None)
+        self.schedule(loop)
+
+
+class Lane:
+    # the buckets one connection's transfers go through
+    def __init__(self, throttle, buckets):
+        self.throttle = throttle
+        self.buckets = buckets
+
+    async def take(self, count):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        try:
+            for bucket in self.buckets:
+                await bucket.take(count)
+        finally:
+            self.throttle.waited += loop.time() - start
+
+
+class Throttle:
+    def __init__(self, rate=None, user_rate=None, conn_rate=None):
+        self.user_rate = user_rate
+        self.conn_rate = conn_rate
+        self.bucket = TokenBucket(rate) if rate else None
+        self.user_buckets = weakref.WeakValueDictionary()  # username -> bucket, alive while a lane uses it
+        self.waited = 0.0  # seconds transfers spent waiting for tokens, for the metrics
+
+    def enabled(self):
+        return bool(self.bucket or self.user_rate or self.conn_rate)
+
+    def lane(self, username):
+        # for a logged in connection, None when no limit applies
+        buckets = []
+        if self.conn_rate:
+            buckets.append(TokenBucket(self.conn_rate))
+        if self.user_rate:
+            bucket = self.user_buckets.get(username)
+            if bucket is None:
+                bucket = self.user_buckets[username] = TokenBucket(self.user_rate)
+            buckets.append(bucket)
+        if self.bucket:
+            buckets.append(self.bucket)
+        return Lane(self, buckets) if buckets else None
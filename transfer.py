@@ -0,0 +1,311 @@
+import hashlib
+import json
+import os
+import queue
+import threading
+from contextlib import contextmanager
+
+# file transfer helpers shared by the server engine and the client
+
+RECV_BUFFER_SIZE = 1024 * 1024  # default receive window, can be raised to several MiB
+MAX_RECV_BUFFER_SIZE = 64 * 1024 * 1024
+HASH_READ_SIZE = 4 * 1024 * 1024
+HASH_QUEUE_DEPTH = 16  # blocks a StreamHash may fall behind before update() waits
+
+
+def check_buffer_size(size):
+    size = int(size)
+    if size < 4096 or size > MAX_RECV_BUFFER_SIZE:
+        raise ValueError(f"Receive buffer size must be between 4096 and {MAX_RECV_BUFFER_SIZE} bytes")
+    return size
+
+
+def parse_size(text):
+    # "1048576", "512K", "4M" -> bytes, used by the command line options
+    text = str(text).strip().upper().rstrip("B")
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def preallocate(f, size):
+    # reserve the announced size up front so the file doesn't fragment while it grows,
+    # best effort: not every platform or filesystem supports it
+    if size <= 0 or not hasattr(os, "posix_fallocate"):
+        return False
+    try:
+        os.posix_fallocate(f.fileno(), 0, size)
+        return True
+    except OSError:
+        return False
+
+
+def open_upload(path, size, offset=0):
+    # blocking: the file an upload is written to, positioned at offset. a fresh one gets its space
+    # reserved, a resumed one keeps the bytes before offset
+    f = open(path, "r+b" if offset else "wb")
+    if offset:
+        f.seek(offset)
+    else:
+        preallocate(f, size)
+    return f
+
+
+def read_partial_info(partial):
+    try:
+        with open(partial + ".json") as f:
+            info = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return info if isinstance(info, dict) else None
+
+
+def write_partial_info(partial, size, version):
+    with open(partial + ".json", "w") as f:
+        json.dump({"size": size, "version": version}, f)
+
+
+def resume_offset(partial, size, version):
+    # how much of partial can be kept: the sidecar must describe the same file (size and
+    # version) and the data must be shorter than the file, a full size one may be preallocated junk
+    try:
+        held = os.path.getsize(partial)
+    except OSError:
+        held = 0
+    if read_partial_info(partial) != {"size": size, "version": version} or held >= size:
+        held = 0
+        write_partial_info(partial, size, version)
+    return held
+
+
+def remove_partial(partial, keep_data=False):
+    for path in ((partial + ".json",) if keep_data else (partial, partial + ".json")):
+        remove_if_exists(path)
+
+
+def remove_if_exists(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def hash_file(path, algorithm="sha256"):
+    return hash_pieces([(path, 0, None)], algorithm)
+
+
+@contextmanager
+def open_source(source):
+    # a path is opened (and closed) here, an already open file is used as it is
+    if isinstance(source, (str, bytes, os.PathLike)):
+        with open(source, "rb") as f:
+            yield f
+    else:
+        yield source
+
+
+def read_into_at(f, view, position):
+    # positioned read that leaves the file offset alone, so a hash or block reader on an executor
+    # thread can share the open file with a sendfile running at the same time.
+    # a memoryview source is file data kept in memory (filecache.py)
+    if isinstance(f, memoryview):
+        data = f[position:position + len(view)]
+        view[:len(data)] = data
+        return len(data)
+    if not hasattr(os, "preadv"):
+        f.seek(position)
+        return f.readinto(view)
+    total = 0
+    while total < len(view):
+        n = os.preadv(f.fileno(), [view[total:]], position + total)
+        if not n:
+            break
+        total += n
+    return total
+
+
+def read_range(source, offset, size):
+    # blocking: size bytes of a path, open file or memoryview at offset
+    data = bytearray(size)
+    with open_source(source) as f:
+        n = read_into_at(f, memoryview(data), offset)
+    if n != size:
+        raise ConnectionError(f"File ended early ({n} of {size} bytes read).")
+    return data
+
+
+def open_stat(path):
+    # blocking: the file opened for reading and its stat, both of the same inode
+    f = open(path, "rb")
+    try:
+        return f, os.fstat(f.fileno())
+    except OSError:
+        f.close()
+        raise
+
+
+def hash_pieces(pieces, algorithm="sha256"):
+    # one digest over (path or file, offset, count) ranges read in order, count None reads to the end
+    digest = hashlib.new(algorithm)
+    buffer = bytearray(HASH_READ_SIZE)
+    view = memoryview(buffer)
+    for source, offset, count in pieces:
+        with open_source(source) as f:
+            position = offset
+            remaining = count
+            while remaining is None or remaining > 0:
+                n = read_into_at(f, view if remaining is None else view[:min(len(buffer), remaining)], position)
+                if not n:
+                    break
+                digest.update(view[:n])
+                position += n
+                if remaining is not None:
+                    remaining -= n
+    return digest.hexdigest()
+
+
+def hash_file_range(digest, path, offset, count):
+    # blocking: count bytes of path at offset into digest
+    with open(path, "rb") as f:
+        f.seek(offset)
+        while count > 0:
+            data = f.read(min(HASH_READ_SIZE, count))
+            if not data:
+                raise OSError(f"{path} is shorter than expected.")
+            digest.update(data)
+            count -= len(data)
+
+
+class StreamHash:
+    # digest of a transfer computed while it runs: update() only queues a copy of the bytes and a
+    # helper thread hashes them (hashlib drops the GIL for big buffers), so the network side never
+    # waits for the hash and nobody reads the file a second time afterwards. update() blocks when
+    # the helper is behind, for the client's threads. the server's event loop never calls it, its
+    # uploads are hashed by the disk threads that write them (diskio.WriteBehind)
+    def __init__(self, algorithm="sha256", depth=HASH_QUEUE_DEPTH):
+        self.digest = hashlib.new(algorithm)
+        self.pending = queue.Queue(depth)
+        self.error = None
+        self.finished = False
+        self.thread = threading.Thread(target=self.run, name="stream-hash", daemon=True)
+        self.thread.start()
+
+    def update(self, data):
+        self.pending.put(bytes(data))
+
+    def update_file(self, path, offset, count):
+        # bytes already on disk, e.g. the part of a resumed transfer that arrived last time
+        self.pending.put((path, offset, count))
+
+    def run(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            try:
+                if isinstance(item, tuple):
+                    self.hash_file_range(*item)
+                else:
+                    self.digest.update(item)
+            except OSError as e:
+                self.error = e
+
+    def hash_file_range(self, path, offset, count):
+        hash_file_range(self.digest, path, offset, count)
+
+    def hexdigest(self):
+        # blocking until the helper caught up, run it in an executor from async code
+        self.close()
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.digest.hexdigest()
+
+    def close(self):
+        # abandons the hash, the helper exits once it drained the queue
+        if not self.finished:
+            self.finished = True
+            self.pending.put(None)
+
+
+class HashingWriter:
+    # file-like write() that hashes what goes through it
+    def __init__(self, f, hasher):
+        self.f = f
+        self.hasher = hasher
+
+    def write(self, data):
+        self.hasher.update(data)
+        return self.f.write(data)
+
+
+def split_ranges(size, parts, min_part=1):
+    # (offset, length) pieces covering size, none smaller than min_part unless the file is
+    parts = max(1, min(parts, size // max(min_part, 1) or 1))
+    step, extra = divmod(size, parts)
+    ranges = []
+    offset = 0
+    for index in range(parts):
+        length = step + (1 if index < extra else 0)
+        ranges.append((offset, length))
+        offset += length
+    return ranges
+
+
+class PositionalWriter:
+    # file-like write() at a fixed offset of a shared fd, several threads fill disjoint ranges
+    def __init__(self, fd, position, lock=None):
+        self.fd = fd
+        self.position = position
+        self.lock = lock or threading.Lock()
+
+    def write(self, data):
+        written = 0
+        while written < len(data):
+            if hasattr(os, "pwrite"):
+                written += os.pwrite(self.fd, data[written:], self.position + written)
+            else:
+                with self.lock:
+                    os.lseek(self.fd, self.position + written, os.SEEK_SET)
+                    written += os.write(self.fd, data[written:])
+        self.position += written
+        return written
+
+
+class BufferPool:
+    # reusable receive buffers, only connections that are transferring hold one
+    def __init__(self, buffer_size=RECV_BUFFER_SIZE, max_idle=64):
+        self.buffer_size = buffer_size
+        self.max_idle = max_idle
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        return memoryview(bytearray(self.buffer_size))
+
+    def release(self, view):
+        with self.lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append(view)
+
+
+def recv_into_file(sock, f, count, view, leftover=None):
+    # blocking receive loop, the same buffer is refilled every time so nothing is allocated per read
+    remaining = count
+    if leftover:
+        take = min(len(leftover), remaining)
+        f.write(leftover[:take])
+        del leftover[:take]
+        remaining -= take
+    size = len(view)
+    while remaining:
+        n = sock.recv_into(view[:min(size, remaining)])
+        if not n:
+            raise ConnectionError("Connection closed during file transfer.")
+        f.write(view[:n])
+        remaining -= n
+    return count